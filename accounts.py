@@ -0,0 +1,88 @@
+import csv
+import logging
+
+logger = logging.getLogger(__name__)
+
+CLIENT_COLUMNS = ('username', 'password', 'email')
+DRIVER_COLUMNS = ('username', 'password', 'email', 'first_name', 'last_name', 'phone_number', 'vehicle', 'license_plate')
+
+def find_account(db, username, is_driver=None):
+    """
+    Look up an account by username in the clients and drivers tables with a single indexed query.
+    :param db: database connection
+    :param username: username of the account
+    :param is_driver: True or False to only look in one of the tables, None to look in both
+    :return: row of (id, username, password, email, is_driver), or None if there is no such account
+    """
+    if is_driver is None:
+        return db.execute('SELECT id, username, password, email, is_driver FROM accounts WHERE username = ?', (username,)).fetchone()
+    return db.execute('SELECT id, username, password, email, is_driver FROM accounts WHERE username = ? AND is_driver = ?', (username, int(is_driver))).fetchone()
+
+def email_taken(db, email, is_driver):
+    """
+    Check whether an email is already used by an account of the same role.
+    :return: True if the email is taken
+    """
+    table = 'drivers' if is_driver else 'clients'
+    return db.execute(f'SELECT 1 FROM {table} WHERE email = ?', (email,)).fetchone() is not None
+
+def import_accounts(db, rows, is_driver, batch_size=10000):
+    """
+    Insert many accounts, committing every batch_size rows.
+    Rows whose username is taken in either table, or whose email is taken in the same table, are skipped.
+    :param db: database connection
+    :param rows: iterable of dicts with the CLIENT_COLUMNS or DRIVER_COLUMNS keys
+    :param is_driver: True to import drivers, False to import clients
+    :return: tuple of (number of accounts imported, number of rows skipped)
+    """
+    table, other, columns = ('drivers', 'clients', DRIVER_COLUMNS) if is_driver else ('clients', 'drivers', CLIENT_COLUMNS)
+    # The unique indexes reject duplicates within the table, the subquery rejects usernames taken by the other role
+    statement = (f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) SELECT {', '.join('?' for _ in columns)} "
+                 f"WHERE NOT EXISTS (SELECT 1 FROM {other} WHERE username = ?)")
+    imported = skipped = 0
+    batch = []
+
+    def flush():
+        before = db.total_changes
+        db.executemany(statement, batch)
+        db.commit()
+        changes = db.total_changes - before
+        batch.clear()
+        return changes
+
+    for row in rows:
+        batch.append([row[column] for column in columns] + [row['username']])
+        if len(batch) >= batch_size:
+            size = len(batch)
+            changes = flush()
+            imported += changes
+            skipped += size - changes
+    if batch:
+        size = len(batch)
+        changes = flush()
+        imported += changes
+        skipped += size - changes
+    return imported, skipped
+
+if __name__ == '__main__':
+    import argparse
+
+    from database import init_db, pool
+
+    parser = argparse.ArgumentParser(description='Import accounts from a CSV file with a header row naming the columns.')
+    parser.add_argument('role', choices=['client', 'driver'])
+    parser.add_argument('path', help=f"CSV file with the columns {', '.join(CLIENT_COLUMNS)} for clients, {', '.join(DRIVER_COLUMNS)} for drivers")
+    parser.add_argument('--batch-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    # Without its unique index, rows whose email is already taken would be imported rather than skipped
+    missing = init_db()
+    if missing:
+        raise SystemExit(f"Fix the duplicated values of {', '.join(f'{table}.{column}' for table, column in missing)} before importing accounts")
+    db = pool.acquire()
+    try:
+        with open(args.path, newline='') as f:
+            imported, skipped = import_accounts(db, csv.DictReader(f), args.role == 'driver', args.batch_size)
+    finally:
+        pool.release(db)
+    print(f'Imported {imported} {args.role}s, skipped {skipped} rows with a username or email already taken')
@@ -1,122 +1,309 @@
-from bson import ObjectId
-from flask import Flask, url_for, redirect, g, session
-from dotenv import load_dotenv
-import os
+from config import get_config
+
+# The async worker libraries must patch the standard library before anything else is imported
+if get_config().SOCKETIO_ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+elif get_config().SOCKETIO_ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+from flask import Flask, url_for, redirect, request, abort, Response, current_app, jsonify
 from flask_login import current_user
-from flask_socketio import SocketIO, join_room
+from flask_socketio import SocketIO, join_room, emit
 from flask_cors import CORS
 from apscheduler.schedulers.background import BackgroundScheduler
-import time
+from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED
 import logging
+from datetime import datetime, timedelta
 from flask_mail import Mail
-from flask_debugtoolbar import DebugToolbarExtension
 
-from pymongo import MongoClient
+import database
+import logging_queue
+import mongo
+import sessions
+from archiver import OrderArchiver
+from chat import ChatRelay
+from dispatch import Dispatcher
+from driver_locations import DriverLocationIndex
+from earnings import DAY_FORMAT, driver_earnings
+from export import FORMATS, export_query, iter_orders, stream
+from mail_queue import mail_dispatcher
+from metrics import metrics, scheduler_listener
+from order_cache import OrderCache
+from order_watcher import OrderStatusWatcher
+from page_cache import PageCache
+from orders import active_orders
 
+socketio = SocketIO()
+mail = Mail()
+# Socket.IO events are frequent, their INFO records are sampled in production
+logger = logging.getLogger('app.events')
+scheduler = BackgroundScheduler()
+scheduler.add_listener(scheduler_listener, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED)
 
-load_dotenv()
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
-app.config['MAIL_SERVER']=os.getenv('MAIL_SERVER')
-app.config['MAIL_PORT'] = os.getenv('MAIL_PORT')
-app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME')
-app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
-app.config['MAIL_USE_TLS'] = True
-app.config['MAIL_USE_SSL'] = False
+def create_app(config_name=None):
+    """
+    Create the application.
+    :param config_name: 'development' or 'production', defaults to the APP_ENV environment variable
+    :return: the Flask application
+    """
+    app = Flask(__name__)
+    app.config.from_object(get_config(config_name))
 
-db = MongoClient(os.getenv('MONGO_URI'))['uber']
-active_orders = db['active_orders']
+    logging_queue.init_app(app)
 
-toolbar = DebugToolbarExtension(app)
-scheduler = BackgroundScheduler()
+    if app.config['DEBUG_TB_ENABLED']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    # With a message queue (for example redis://localhost:6379/0), emits from any worker or process reach the right room
+    socketio.init_app(app,
+        message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'],
+        channel=app.config['SOCKETIO_CHANNEL'],
+        async_mode=app.config['SOCKETIO_ASYNC_MODE'],
+        Engineio_logger=app.config['SOCKETIO_LOGGER'], logger=app.config['SOCKETIO_LOGGER'])
+    CORS(app, resources={r"/clients/socket.io/*": {"origins": "http://localhost:5000"}})
+    app.wsgi_app = metrics.wsgi_middleware(app.wsgi_app)
+    mail.init_app(app)
+    mail_dispatcher.init_app(app, mail)
+    database.init_app(app)
+    mongo.init_app(app)
+    app.extensions['session_store'] = sessions.init_app(app)
+    if app.extensions['session_store'] is not None:
+        metrics.gauge('sessions', app.extensions['session_store'].stats)
+
+    active_orders.cache = OrderCache(
+        max_size=app.config['ORDER_CACHE_SIZE'],
+        ttl=app.config['ORDER_CACHE_TTL'],
+        completed_ttl=app.config['ORDER_CACHE_COMPLETED_TTL'])
+    metrics.gauge('order_cache', active_orders.cache.stats)
+    app.extensions['page_cache'] = PageCache(
+        max_entries=app.config['PAGE_CACHE_MAX_ENTRIES'],
+        max_bytes=app.config['PAGE_CACHE_MAX_BYTES'],
+        ttl=app.config['PAGE_CACHE_TTL'])
+    metrics.gauge('page_cache', app.extensions['page_cache'].stats)
+
+    # Background services are created here but only start when first used
+    app.extensions['order_watcher'] = OrderStatusWatcher(active_orders, socketio, poll_interval=app.config['ORDER_POLL_INTERVAL'])
+    app.extensions['chat_relay'] = ChatRelay(socketio,
+        max_message_length=app.config['CHAT_MAX_MESSAGE_LENGTH'],
+        room_buffer_size=app.config['CHAT_ROOM_BUFFER_SIZE'],
+        history_size=app.config['CHAT_HISTORY_SIZE'],
+        rate=app.config['CHAT_RATE_PER_SECOND'],
+        burst=app.config['CHAT_BURST'])
+    app.extensions['archiver'] = OrderArchiver(active_orders,
+        batch_size=app.config['ARCHIVE_BATCH_SIZE'],
+        waiting_ttl_minutes=app.config['WAITING_ORDER_TTL_MINUTES'],
+        completed_after_minutes=app.config['ARCHIVE_COMPLETED_AFTER_MINUTES'])
+    app.extensions['driver_locations'] = DriverLocationIndex(
+        cell_size_km=app.config['DRIVER_GRID_CELL_KM'],
+        ttl=app.config['DRIVER_LOCATION_TTL'])
+    metrics.gauge('drivers', app.extensions['driver_locations'].stats)
+    app.extensions['dispatcher'] = Dispatcher(active_orders, app.extensions['driver_locations'], socketio,
+        max_pickup_km=app.config['DISPATCH_MAX_PICKUP_KM'],
+        offer_timeout=app.config['DISPATCH_OFFER_TIMEOUT'])
+    metrics.gauge('dispatch', app.extensions['dispatcher'].stats)
+
+    metrics.gauge('background', lambda: {
+        'scheduled_jobs': len(scheduler.get_jobs()),
+        'watched_orders': len(app.extensions['order_watcher'].watched),
+        'chat_rooms': len(app.extensions['chat_relay'].rooms),
+        'mail_queue': mail_dispatcher.queue.qsize(),
+    })
+
+    app.before_request(record_endpoint)
+    app.add_url_rule('/', 'index', index)
+    app.add_url_rule('/metrics', 'scrape_metrics', scrape_metrics)
+    app.add_url_rule('/reports/earnings', 'earnings_report', earnings_report)
+    app.add_url_rule('/reports/rides', 'export_rides', export_rides)
+
+    from authentication import authentication
+    from clients import clients
+    from drivers import drivers
+    app.register_blueprint(authentication)
+    app.register_blueprint(clients)
+    app.register_blueprint(drivers)
+    return app
+
+def start_services(app):
+    """
+    Prepare the databases and start the scheduled jobs. Called once per worker, before serving requests.
+    """
+    with app.app_context():
+        database.init_db()
+        active_orders.create_indexes()
+        active_orders.backfill_origin_points()
+        app.extensions['chat_relay'].create_indexes()
+        driver_earnings.create_indexes()
+    scheduler.add_job(app.extensions['archiver'].run, 'interval', seconds=app.config['ARCHIVE_INTERVAL_SECONDS'], id='archiver', replace_existing=True)
+    scheduler.add_job(app.extensions['driver_locations'].expire, 'interval', seconds=app.config['DRIVER_LOCATION_TTL'], id='driver_locations', replace_existing=True)
+    if app.extensions['session_store'] is not None:
+        scheduler.add_job(app.extensions['session_store'].expire, 'interval', hours=1, id='sessions', replace_existing=True)
+    if app.config['DISPATCH_ENABLED']:
+        scheduler.add_job(app.extensions['dispatcher'].run, 'interval', seconds=app.config['DISPATCH_INTERVAL_SECONDS'], id='dispatcher', replace_existing=True)
+    if not scheduler.running:
+        scheduler.start()
+
+def record_endpoint():
+    # Read by the metrics middleware once the response has been sent
+    labels = request.environ.get('metrics.labels')
+    if labels is not None:
+        labels['endpoint'] = request.endpoint
 
-class ResponseTimeMiddleware(object):
-    def __init__(self, app):
-        self.app = app
-
-    def __call__(self, environ, start_response):
-        start_time = time.time()
-        response = self.app(environ, start_response)
-        end_time = time.time()
-        response_time = end_time - start_time
-        app.logger.info(f'Response time: {response_time} seconds')
-        return response
-    
-
-socketio = SocketIO(app=app, Engineio_logger=True, logger=True)
-CORS(app, resources={r"/clients/socket.io/*": {"origins": "http://localhost:5000"}})
-app.wsgi_app = ResponseTimeMiddleware(app.wsgi_app)
-logging.basicConfig(filename='app.log', level=logging.INFO)
-logger = logging.getLogger('performance_logger')
-mail = Mail(app)
-
-def fetch_order_status(order_id, user_id):
-    try:
-        order = active_orders.find_one({'_id': ObjectId(order_id)})
-        if order is None:
-            logging.info(f"Order {order_id} not found")
-            scheduler.remove_job(fetch_order_status)
-            return
-        order_status = order['status']
-        logging.info(f"Order {order_id} status: {order_status}")
-        if order_status == 'accepted':
-            order_driver = order['driver_name']
-            scheduler.remove_job(fetch_order_status)
-            socketio.emit("order_accepted", {'order_id': order_id, "order_driver": order_driver}, namespace='/clients', to=user_id)
-    except Exception as e:
-        logging.info(f"Exception: {str(e)}")
-        scheduler.remove_job(fetch_order_status)
-
-@app.route('/')
 def index():
     return redirect(url_for('authentication.login'))
 
+def scrape_metrics():
+    """
+    Expose the metrics in the Prometheus text format. Requires the METRICS_TOKEN bearer token if it is set.
+    """
+    token = current_app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        abort(403)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def require_reports_token():
+    """
+    Abort with a 403 unless the request has the REPORTS_TOKEN bearer token. Reports are disabled if it is not set.
+    """
+    token = current_app.config['REPORTS_TOKEN']
+    if not token or request.headers.get('Authorization') != f'Bearer {token}':
+        abort(403)
+
+def earnings_report():
+    """
+    Operator report of the earnings of every driver between two days, from the earnings rollups.
+    Query parameters: from and to as YYYY-MM-DD days (to excluded, defaults to tomorrow), group_by 'day', 'driver' or 'vehicle_type'.
+    Requires the REPORTS_TOKEN bearer token.
+    """
+    require_reports_token()
+    today = datetime.now()
+    try:
+        start_day = datetime.strptime(request.args.get('from', (today - timedelta(days=current_app.config['EARNINGS_DAYS'] - 1)).strftime(DAY_FORMAT)), DAY_FORMAT)
+        end_day = datetime.strptime(request.args.get('to', (today + timedelta(days=1)).strftime(DAY_FORMAT)), DAY_FORMAT)
+        rows = driver_earnings.report(start_day.strftime(DAY_FORMAT), end_day.strftime(DAY_FORMAT), request.args.get('group_by', 'day'))
+    except ValueError as e:
+        return jsonify({'result': 'error', 'message': str(e)}), 400
+    return jsonify({'result': 'success', 'from': start_day.strftime(DAY_FORMAT), 'to': end_day.strftime(DAY_FORMAT), 'rows': rows})
+
+def export_rides():
+    """
+    Stream the completed rides, active and archived, for accounting.
+    Query parameters: format 'ndjson' or 'csv', gzip=1 to compress, and the optional filters from and to as YYYY-MM-DD days (to excluded),
+    driver as a driver id and vehicle_type. The rides are read and written in batches, so the export uses the same memory whatever its size.
+    Requires the REPORTS_TOKEN bearer token.
+    """
+    require_reports_token()
+    file_format = request.args.get('format', 'ndjson')
+    compress = request.args.get('gzip', '0') not in ('0', '', 'false')
+    if file_format not in FORMATS:
+        return jsonify({'result': 'error', 'message': f"Unknown export format '{file_format}'"}), 400
+    try:
+        start = datetime.strptime(request.args['from'], DAY_FORMAT) if request.args.get('from') else None
+        end = datetime.strptime(request.args['to'], DAY_FORMAT) if request.args.get('to') else None
+    except ValueError as e:
+        return jsonify({'result': 'error', 'message': str(e)}), 400
+    try:
+        driver = int(request.args['driver']) if request.args.get('driver') else None
+    except ValueError:
+        return jsonify({'result': 'error', 'message': f"Invalid driver id '{request.args['driver']}'"}), 400
+    query = export_query(start, end, driver, request.args.get('vehicle_type'))
+    filename = f"rides.{file_format}{'.gz' if compress else ''}"
+    return Response(stream(iter_orders(active_orders, query, current_app.config['EXPORT_BATCH_SIZE']), file_format, compress),
+                    mimetype='application/gzip' if compress else FORMATS[file_format],
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
 @socketio.on('connect', namespace='/clients')
+@metrics.track_event
 def client_connect():
-    print('Client connected')
     room_id = current_user.id
     join_room(room_id)
-    logging.info(f"Client {current_user.username} connected to room {room_id}")
+    logger.info("Client %s connected to room %s", current_user.username, room_id)
 
 @socketio.on('start_status_check', namespace='/clients')
+@metrics.track_event
 def start_status_check(data):
-    logging.info(f"Starting status check for order {data['order_id']}")
-    scheduler.add_job(fetch_order_status, 'interval', seconds=15, args=[data['order_id'], current_user.id])
-    scheduler.start()
+    logger.info("Starting status check for order %s", data['order_id'])
+    current_app.extensions['order_watcher'].watch(data['order_id'], current_user.id)
 
 @socketio.on('connect', namespace='/ride_chat')
+@metrics.track_event
 def handle_connect():
-    logging.info(f"{current_user.username} connected to ride chat")
+    logger.info("%s connected to ride chat", current_user.username)
 
 @socketio.on('join', namespace='/ride_chat')
+@metrics.track_event
 def handle_join(data):
     room = data['room_id']
     join_room(room)
-    logging.info(f"{current_user.username} joined room {room}")
+    logger.info("%s joined room %s", current_user.username, room)
+    # Replay the recent messages to the user who joined
+    emit('receive_messages', {'messages': current_app.extensions['chat_relay'].history(room)})
 
 @socketio.on('send_message', namespace='/ride_chat')
+@metrics.track_event
 def handle_send_message(data):
-    logging.info(f"Sending message to room {data['room_id']}")
-    message = data['message']
-    socketio.emit('receive_message', {'message': message}, namespace='/ride_chat', to=data['room_id'])
+    logger.info("Sending message to room %s", data['room_id'])
+    error = current_app.extensions['chat_relay'].post(data['room_id'], current_user.id, data['message'])
+    if error:
+        emit('chat_error', {'message': error})
 
 @socketio.on('ride_end', namespace='/ride_chat')
+@metrics.track_event
 def handle_ride_end(data):
-    logging.info(f"Ride ended in room {data['room_id']}")
+    logger.info("Ride ended in room %s", data['room_id'])
     socketio.emit('ride_ended', namespace='/ride_chat', to=data['room_id'])
+    current_app.extensions['chat_relay'].close_room(data['room_id'])
+
+@socketio.on('connect', namespace='/drivers')
+@metrics.track_event
+def driver_connect():
+    if not current_user.is_authenticated or not current_user.is_driver:
+        return False
+    if not register_driver():
+        return False
+    # Dispatch offers are sent to this room
+    join_room(current_user.id)
+    logger.info("Driver %s is online", current_user.username)
+
+def register_driver():
+    """
+    Add the current driver to the driver location index.
+    :return: False if the driver no longer exists
+    """
+    cursor = database.get_db().cursor()
+    cursor.execute('SELECT vehicle, license_plate FROM drivers WHERE id=?', (current_user.id,))
+    driver = cursor.fetchone()
+    if driver is None:
+        logger.warning("Driver %s not found", current_user.id)
+        return False
+    vehicle_type, license_plate = driver
+    current_app.extensions['driver_locations'].go_online(current_user.id, current_user.username, license_plate, vehicle_type)
+    return True
+
+@socketio.on('driver_location', namespace='/drivers')
+@metrics.track_event
+def driver_location(data):
+    # Sent every few seconds by every online driver, so it is not logged
+    lat, lng = float(data['lat']), float(data['lng'])
+    if not current_app.extensions['driver_locations'].update(current_user.id, lat, lng):
+        # The driver expired while the socket stayed connected, for example after losing the GPS signal for a while
+        if register_driver():
+            current_app.extensions['driver_locations'].update(current_user.id, lat, lng)
+
+@socketio.on('decline_offer', namespace='/drivers')
+@metrics.track_event
+def decline_offer(data):
+    logger.info("Driver %s declined order %s", current_user.username, data['order_id'])
+    current_app.extensions['dispatcher'].decline(data['order_id'], current_user.id)
+
+@socketio.on('disconnect', namespace='/drivers')
+def driver_disconnect(reason=None):
+    current_app.extensions['driver_locations'].go_offline(current_user.id)
+    logger.info("Driver %s is offline", current_user.username)
 
-@app.teardown_appcontext
-def close_connection(exception):
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
-    
 if __name__ == '__main__':
-    from authentication import authentication
-    from clients import clients
-    from drivers import drivers
-    app.register_blueprint(authentication)
-    app.register_blueprint(clients)
-    app.register_blueprint(drivers)
-    socketio.run(app, log_output=True, debug=True)
+    app = create_app()
+    start_services(app)
+    socketio.run(app, log_output=app.config['DEBUG'], debug=app.config['DEBUG'])
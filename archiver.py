@@ -0,0 +1,34 @@
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+class OrderArchiver(object):
+    """
+    Moves finished orders out of active_orders so that the collection only holds live demand.
+    Completed rides are archived once they are older than completed_after_minutes,
+    and waiting orders that nobody accepted expire after waiting_ttl_minutes.
+    """
+    def __init__(self, repository, batch_size=500, waiting_ttl_minutes=30, completed_after_minutes=60):
+        self.repository = repository
+        self.batch_size = batch_size
+        self.waiting_ttl = timedelta(minutes=waiting_ttl_minutes)
+        self.completed_after = timedelta(minutes=completed_after_minutes)
+
+    def run(self):
+        """
+        Archive completed and expired orders. Scheduled periodically by the application.
+        """
+        now = datetime.now()
+        completed = self.repository.archive({
+            'status': 'completed',
+            '$or': [{'ended_at': {'$lt': now - self.completed_after}}, {'ended_at': {'$exists': False}}]
+        }, self.batch_size)
+        expired = self.repository.archive({
+            'status': 'waiting',
+            'created_at': {'$lt': now - self.waiting_ttl}
+        }, self.batch_size, fields={'status': 'expired'})
+        if completed or expired:
+            logger.info(f"Archived {completed} completed and {expired} expired orders")
+        return completed, expired
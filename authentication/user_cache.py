@@ -0,0 +1,37 @@
+from lru import LRUCache
+
+
+class UserCache(LRUCache):
+    """
+    A bounded LRU cache with a time to live, used by load_user to avoid querying the database on every request.
+    Entries are keyed by (is_driver, user_id).
+    """
+    def __init__(self, max_size=10000, ttl=300):
+        super().__init__(max_size, ttl)
+
+    def get(self, is_driver, user_id):
+        """
+        Get a cached user.
+        :return: the user, or None if it is not cached or has expired
+        """
+        entry = self.lookup((bool(is_driver), str(user_id)))
+        return entry[0] if entry is not None else None
+
+    def set(self, is_driver, user_id, user):
+        """
+        Cache a user, evicting the least recently used entry if the cache is full.
+        """
+        self.store((bool(is_driver), str(user_id)), user)
+
+    def invalidate(self, is_driver, user_id):
+        """
+        Remove a user from the cache, for example after their account has changed.
+        """
+        self.discard((bool(is_driver), str(user_id)))
+
+    def stats(self):
+        """
+        :return: dict with the cache size and the hit and miss counters
+        """
+        with self.lock:
+            return {'size': len(self.entries), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses}
@@ -1,20 +1,41 @@
+import logging
 import sqlite3
-from flask import g, render_template, redirect, url_for, flash, session
+from flask import render_template, redirect, url_for, flash, session
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField, SelectField
 from wtforms.validators import DataRequired, Length, Email, EqualTo, ValidationError
-from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
+from flask_login import LoginManager, login_user, logout_user, login_required, current_user
+from accounts import email_taken, find_account
+from database import get_db
+from metrics import metrics
+from sessions import regenerate
 from . import authentication
+from .user_cache import UserCache
+
+logger = logging.getLogger(__name__)
 
 login_manager = LoginManager()
 login_manager.login_view = "authentication.login"
 login_manager.login_message = 'Please log in to access this page.'
 
+# Users are cached so that authenticated requests do not query the database
+user_cache = UserCache()
+metrics.gauge('user_cache', user_cache.stats)
+
 @authentication.record_once
 def on_load(state):
     login_manager.init_app(state.app)
+    user_cache.max_size = state.app.config['USER_CACHE_SIZE']
+    user_cache.ttl = state.app.config['USER_CACHE_TTL']
+
+class User(object):
+    """
+    A logged in client or driver, kept in the user cache.
+    It implements the flask_login user methods itself rather than inheriting UserMixin,
+    which has no __slots__ and would give every instance a __dict__.
+    """
+    __slots__ = ('id', 'username', 'password', 'email', 'is_driver')
 
-class User(UserMixin):
     def __init__(self, id, username, password, email, is_driver=False):
         self.id = id
         self.username = username
@@ -22,67 +43,67 @@ class User(UserMixin):
         self.email = email
         self.is_driver = is_driver
 
+    @property
+    def is_active(self):
+        return True
+
+    @property
+    def is_authenticated(self):
+        return True
+
+    @property
+    def is_anonymous(self):
+        return False
+
+    def get_id(self):
+        return str(self.id)
+
+    def __eq__(self, other):
+        if isinstance(other, User):
+            return self.get_id() == other.get_id()
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    __hash__ = object.__hash__
+
 @login_manager.user_loader
 def load_user(user_id):
     """
     This function loads a user given their user_id. It checks if the user is a driver or a client and fetches the user from the appropriate table.
+    Users are served from the user cache when possible.
     """
+    is_driver = session.get('is_driver', False)
+    user_obj = user_cache.get(is_driver, user_id)
+    if user_obj is not None:
+        return user_obj
+
     db = get_db()
     cursor = db.cursor()
-    is_driver = session.get('is_driver', False)
     if is_driver:
         cursor.execute(f'SELECT * FROM drivers WHERE id = ?', (user_id,))
         user = cursor.fetchone()
         if user:
-            return User(user[0], user[1], user[2], user[3], is_driver=True)
+            user_obj = User(user[0], user[1], user[2], user[3], is_driver=True)
     else:
         cursor.execute(f'SELECT * FROM clients WHERE id = ?', (user_id,))
         user = cursor.fetchone()
         if user:
-            return User(user[0], user[1], user[2], user[3])
-    return None
-
-def get_db():
-    """
-    This function gets the database connection. If the connection does not exist, it creates one and also creates the clients and drivers tables.
-    """
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = g._database = sqlite3.connect('./uber_application.db')
-        create_clients_table(db)
-        create_drivers_table(db)
-    return db
-
-def create_clients_table(db):
-    """
-    This function creates the clients table in the database if it does not exist.
-    """
-    cursor = db.cursor()
-    cursor.execute('CREATE TABLE IF NOT EXISTS clients (id INTEGER PRIMARY KEY, username TEXT, password TEXT, email TEXT)') 
-    db.commit()
-    cursor.close()
-
-def create_drivers_table(db):
-    """
-    This function creates the drivers table in the database if it does not exist.
-    """
-    cursor = db.cursor()
-    cursor.execute('CREATE TABLE IF NOT EXISTS drivers (id INTEGER PRIMARY KEY, username TEXT, password TEXT, email TEXT, first_name TEXT, last_name TEXT, phone_number TEXT, vehicle TEXT, license_plate TEXT)')
-    db.commit()
-    cursor.close()
+            user_obj = User(user[0], user[1], user[2], user[3])
+    if user_obj is not None:
+        user_cache.set(is_driver, user_id, user_obj)
+    return user_obj
 
 def unique_username(form, field):
     """
     This function checks if the username is unique across both the clients and drivers tables.
     If the username already exists, it raises a ValidationError.
     """
-    db = get_db()
-    cursor = db.cursor()
-    cursor.execute(f'SELECT * FROM clients WHERE username = ?', (field.data,))
-    current_user1 = cursor.fetchone()
-    cursor.execute(f'SELECT * FROM drivers WHERE username = ?', (field.data,))
-    current_user2 = cursor.fetchone()
-    if current_user1 or current_user2:
+    if find_account(get_db(), field.data):
         raise ValidationError('Username already exists')
     
 def unique_email(form, field):
@@ -91,31 +112,23 @@ def unique_email(form, field):
     If the email already exists, it raises a ValidationError.
     """
     # check if request originated from client or driver sign up form
-    is_driver = form.vehicle.data is not None
+    is_driver = isinstance(form, DriverRegistrationForm)
 
-    db = get_db()
-    cursor = db.cursor()
-    if is_driver:
-        cursor.execute(f'SELECT * FROM drivers WHERE email = ?', (field.data,))
-        current_user = cursor.fetchone()
-    else:
-        cursor.execute(f'SELECT * FROM clients WHERE email = ?', (field.data,))
-        current_user = cursor.fetchone()
-    if current_user:
+    if email_taken(get_db(), field.data, is_driver):
         raise ValidationError('Account already exists')
 
 class ClientRegistrationForm(FlaskForm):
-    username = StringField('Username', validators=[DataRequired(), Length(min=4, max=20)])
+    username = StringField('Username', validators=[DataRequired(), Length(min=4, max=20), unique_username])
     password = PasswordField('Password', validators=[DataRequired(), Length(min=4, max=20)])
     confirm_password = PasswordField('Confirm Password', validators=[DataRequired(), EqualTo('password')])
-    email = StringField('Email', validators=[DataRequired(), Email(), Length(min=4, max=20)])
+    email = StringField('Email', validators=[DataRequired(), Email(), Length(min=4, max=20), unique_email])
     submit = SubmitField('Sign Up')
 
 class DriverRegistrationForm(FlaskForm):
-    username = StringField('Username', validators=[DataRequired(), Length(min=1, max=20)])
+    username = StringField('Username', validators=[DataRequired(), Length(min=1, max=20), unique_username])
     password = PasswordField('Password', validators=[DataRequired(), Length(min=4, max=20)])
     confirm_password = PasswordField('Confirm Password', validators=[DataRequired(), EqualTo('password')])
-    email = StringField('Email', validators=[DataRequired(), Email(), Length(min=4, max=20)])
+    email = StringField('Email', validators=[DataRequired(), Email(), Length(min=4, max=20), unique_email])
     first_name = StringField('First Name', validators=[DataRequired(), Length(min=1, max=20)])
     last_name = StringField('Last Name', validators=[DataRequired(), Length(min=2, max=20)])
     phone_number = StringField('Phone Number', validators=[DataRequired(), Length(min=8, max=20)])
@@ -160,13 +173,10 @@ def client_login():
         username = form.username.data
         password = form.password.data
         
-        db = get_db()
-        cursor = db.cursor()
-        cursor.execute('SELECT * FROM clients WHERE username = ? AND password = ?', (username, password))
-        user = cursor.fetchone()
-        cursor.close()
-        if user:
+        user = find_account(get_db(), username, is_driver=False)
+        if user and user[2] == password:
             user_obj = User(user[0], user[1], user[2], user[3])
+            regenerate(session)
             session['is_driver'] = False
             login_user(user_obj)
             return redirect(url_for('clients.home'))
@@ -191,19 +201,16 @@ def driver_login():
     if form.validate_on_submit():
         username = form.username.data
         password = form.password.data
-        db = get_db()
-        cursor = db.cursor()
-        cursor.execute('SELECT * FROM drivers WHERE username = ? AND password = ?', (username, password))
-        user = cursor.fetchone()
-        if user:
-            print(user)
+        user = find_account(get_db(), username, is_driver=True)
+        if user and user[2] == password:
+            logger.info(f"Driver {user[0]} logged in")
             user_obj = User(user[0], user[1], user[2], user[3], is_driver=True)
+            regenerate(session)
             session['is_driver'] = True
             login_user(user_obj)
             return redirect(url_for('drivers.driver_home'))
         else:
             flash('Invalid username or password', 'danger')
-        cursor.close()
     return render_template('driver_login.html', form=form)
 
 @authentication.route('/sign_up/client', methods=['GET', 'POST'])
@@ -221,13 +228,15 @@ def client_sign_up():
         
         db = get_db()
         cursor = db.cursor()
-        cursor.execute('SELECT * FROM clients WHERE username = ?', (username,))
-        current_user = cursor.fetchone()
-        if current_user:
-            flash('User already exists', 'danger')
-        else:
+        # The form already checked the username and email, the unique indexes catch accounts created since
+        try:
             cursor.execute('INSERT INTO clients (username, password, email) VALUES (?, ?, ?)', (username, password, email))
             db.commit()
+        except sqlite3.IntegrityError:
+            db.rollback()
+            flash('User already exists', 'danger')
+        else:
+            user_cache.invalidate(False, cursor.lastrowid)
             cursor.close()
             flash('User added successfully', 'success')
             return redirect(url_for('authentication.client_login'))
@@ -253,13 +262,15 @@ def driver_sign_up():
         
         db = get_db()
         cursor = db.cursor()
-        cursor.execute('SELECT * FROM drivers WHERE username = ?', (username,))
-        current_user = cursor.fetchone()
-        if current_user:
-            flash('User already exists', 'danger')
-        else:
+        # The form already checked the username and email, the unique indexes catch accounts created since
+        try:
             cursor.execute('INSERT INTO drivers (username, password, email, first_name, last_name, phone_number, vehicle, license_plate) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (username, password, email, first_name, last_name, phone_number, vehicle, license_plate))
             db.commit()
+        except sqlite3.IntegrityError:
+            db.rollback()
+            flash('User already exists', 'danger')
+        else:
+            user_cache.invalidate(True, cursor.lastrowid)
             cursor.close()
             flash('User added successfully', 'success')
             return redirect(url_for('authentication.driver_login'))
@@ -273,6 +284,8 @@ def logout():
     Requires login
     This route logs the user out and redirects them to the home page.
     """
+    user_cache.invalidate(current_user.is_driver, current_user.id)
     session.pop('is_driver', None)
     logout_user()
+    regenerate(session)
     return redirect(url_for('authentication.login'))
\ No newline at end of file
@@ -0,0 +1,182 @@
+import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import PyMongoError
+
+from mongo import get_database
+
+logger = logging.getLogger(__name__)
+
+
+class ChatRoom(object):
+    """
+    In-memory state of one ride chat room: messages waiting to be emitted and the most recent messages posted through this process,
+    as (message_id, message) pairs.
+    """
+    __slots__ = ('pending', 'recent', 'closed', 'last_active')
+
+    def __init__(self, history_size):
+        self.pending = []
+        self.recent = deque(maxlen=history_size)
+        self.closed = False
+        self.last_active = time.monotonic()
+
+class ChatRelay(object):
+    """
+    Relays ride chat messages to their rooms.
+    Messages are validated and rate limited per user, buffered per room, and emitted in batches by a background task,
+    which also saves them to MongoDB in bulk so that the recent history can be replayed when someone joins.
+    """
+    def __init__(self, socketio, max_message_length=500, room_buffer_size=100, history_size=50,
+                 rate=5, burst=10, flush_interval=0.05, persist_interval=1.0, room_idle_timeout=3600, collection_name='chat_messages'):
+        self.socketio = socketio
+        self.max_message_length = max_message_length
+        self.room_buffer_size = room_buffer_size
+        self.history_size = history_size
+        self.rate = rate
+        self.burst = burst
+        self.flush_interval = flush_interval
+        self.persist_interval = persist_interval
+        self.room_idle_timeout = room_idle_timeout
+        self.collection_name = collection_name
+        self._collection = None
+        self.rooms = {}
+        self.buckets = {}
+        self.unsaved = []
+        self.last_persist = time.monotonic()
+        self.lock = threading.Lock()
+        self.started = False
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            self._collection = get_database()[self.collection_name]
+        return self._collection
+
+    def create_indexes(self):
+        self.collection.create_index([('room_id', ASCENDING), ('created_at', DESCENDING)], name='room_created_at')
+
+    def post(self, room_id, user_id, message):
+        """
+        Queue a message for a room.
+        :return: None if the message was accepted, otherwise the reason it was rejected
+        """
+        if not isinstance(message, str) or not message.strip():
+            return 'Empty message'
+        if len(message) > self.max_message_length:
+            return f'Messages are limited to {self.max_message_length} characters'
+        now = time.monotonic()
+        message_id = ObjectId()
+        with self.lock:
+            if not self.take_token(user_id, now):
+                return 'You are sending messages too quickly'
+            room = self.get_room(room_id)
+            if len(room.pending) >= self.room_buffer_size:
+                return 'The chat is busy, please try again'
+            room.pending.append((message_id, message))
+            room.recent.append((message_id, message))
+            room.last_active = now
+            self.unsaved.append({'_id': message_id, 'room_id': room_id, 'user_id': user_id, 'message': message, 'created_at': datetime.now()})
+            if not self.started:
+                self.started = True
+                self.socketio.start_background_task(self.run)
+        return None
+
+    def take_token(self, user_id, now):
+        """
+        Token bucket rate limiter, allowing `rate` messages per second with bursts of up to `burst` messages.
+        Must be called with the lock held.
+        """
+        tokens, last = self.buckets.get(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self.buckets[user_id] = (tokens, now)
+            return False
+        self.buckets[user_id] = (tokens - 1, now)
+        return True
+
+    def get_room(self, room_id):
+        room = self.rooms.get(room_id)
+        if room is None:
+            room = self.rooms[room_id] = ChatRoom(self.history_size)
+        return room
+
+    def history(self, room_id):
+        """
+        Get the most recent messages of a room to replay to someone who just joined it.
+        Messages are read from MongoDB, since they may have been posted through other processes, together with the messages
+        posted through this process that are not saved yet. Pending messages are left out, the next flush emits them to the room.
+        """
+        try:
+            saved = list(self.collection.find({'room_id': room_id}, {'message': 1}).sort('created_at', DESCENDING).limit(self.history_size))
+        except PyMongoError as e:
+            logger.warning(f"Exception: {str(e)}")
+            saved = []
+        saved = [(message['_id'], message['message']) for message in reversed(saved)]
+        with self.lock:
+            room = self.rooms.get(room_id)
+            if room is None:
+                return [message for message_id, message in saved]
+            skipped = set(message_id for message_id, message in saved)
+            skipped.update(message_id for message_id, message in room.pending)
+            posted = [entry for entry in room.recent if entry[0] not in skipped]
+        return [message for message_id, message in (saved + posted)[-self.history_size:]]
+
+    def close_room(self, room_id):
+        """
+        Forget a room once its ride has ended. Its pending messages are still emitted and saved.
+        Rooms without messages for room_idle_timeout seconds are forgotten as well.
+        """
+        with self.lock:
+            room = self.rooms.get(room_id)
+            if room is not None:
+                room.closed = True
+
+    def run(self):
+        """
+        Main loop of the background task.
+        """
+        while True:
+            self.socketio.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                # The task is never restarted, so whatever went wrong it carries on with the next flush
+                logger.exception("Chat relay flush failed")
+
+    def flush(self):
+        """
+        Emit the pending messages of every room as one event per room, and save messages in bulk.
+        """
+        now = time.monotonic()
+        batches = []
+        unsaved = []
+        with self.lock:
+            for room_id, room in list(self.rooms.items()):
+                if room.pending:
+                    batches.append((room_id, room.pending))
+                    room.pending = []
+                # Rides that ended, or were abandoned without ending, no longer need their room
+                if room.closed or now - room.last_active > self.room_idle_timeout:
+                    del self.rooms[room_id]
+            if self.unsaved and (now - self.last_persist >= self.persist_interval or len(self.unsaved) >= 1000):
+                unsaved = self.unsaved
+                self.unsaved = []
+                self.last_persist = now
+            # Users with a full bucket do not need to be tracked
+            for user_id, (tokens, last) in list(self.buckets.items()):
+                if tokens + (now - last) * self.rate >= self.burst:
+                    del self.buckets[user_id]
+
+        for room_id, messages in batches:
+            self.socketio.emit('receive_messages', {'messages': [message for message_id, message in messages]}, namespace='/ride_chat', to=room_id)
+        if unsaved:
+            try:
+                self.collection.insert_many(unsaved, ordered=False)
+            except PyMongoError as e:
+                logger.warning(f"Exception: {str(e)}")
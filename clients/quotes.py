@@ -0,0 +1,57 @@
+import secrets
+import threading
+import time
+
+
+class SessionQuotes(object):
+    """
+    Ride quotes kept in the client's session for a time to live, so that an order can be booked at the price it was quoted
+    without computing it again. The sessions are stored on the server and shared by the worker processes,
+    so the quote can be booked through any worker. Each quote is identified by a random token and can only be booked once.
+    """
+    def __init__(self, max_per_session=5, ttl=300):
+        self.max_per_session = max_per_session
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.quoted = 0
+        self.booked = 0
+        self.rejected = 0
+
+    def put(self, session, quote):
+        """
+        Store a quote in a session, dropping its oldest quotes past max_per_session.
+        :return: token of the quote
+        """
+        token = secrets.token_urlsafe(16)
+        now = time.time()
+        quotes = dict((key, value) for key, value in session.get('quotes', {}).items() if value['expires'] >= now)
+        quotes[token] = dict(quote, expires=now + self.ttl)
+        # Dicts keep their insertion order, so the oldest quotes come first
+        session['quotes'] = dict(list(quotes.items())[-self.max_per_session:])
+        with self.lock:
+            self.quoted += 1
+        return token
+
+    def take(self, session, token, client_id):
+        """
+        Remove a quote from a session to book it.
+        :return: the quote, or None if it does not exist, has expired or belongs to another client
+        """
+        quotes = dict(session.get('quotes', {}))
+        quote = quotes.pop(token, None)
+        if quote is not None:
+            session['quotes'] = quotes
+        if quote is None or quote['client_id'] != client_id or quote['expires'] < time.time():
+            with self.lock:
+                self.rejected += 1
+            return None
+        with self.lock:
+            self.booked += 1
+        return quote
+
+    def stats(self):
+        """
+        :return: dict with the quoted, booked and rejected counters of this process
+        """
+        with self.lock:
+            return {'quoted': self.quoted, 'booked': self.booked, 'rejected': self.rejected}
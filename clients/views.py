@@ -1,166 +1,155 @@
 import logging
-from flask import Flask, flash, redirect, render_template, request, session, jsonify, g, url_for
-import folium
+from flask import Flask, flash, redirect, render_template, request, session, jsonify, url_for, current_app
 from flask_login import login_required, current_user
 from flask_mail import Message
-from dotenv import load_dotenv
-import os
-from pymongo import MongoClient
 from datetime import datetime
-import math
 from bson import ObjectId
-import sqlite3
 
-from app import mail
+from mail_queue import mail_dispatcher
+from metrics import metrics
+from orders import active_orders, location_point
+from page_cache import page_response
+from pricing import PRICE_PER_KM, calculate_distance
 from . import clients
+from .quotes import SessionQuotes
 
-load_dotenv()
+logger = logging.getLogger(__name__)
 
-# Connect to MongoDB database
-db = MongoClient(os.getenv('MONGO_URI'))['uber']
-active_orders = db['active_orders']
+# Quotes are kept in the session until they are booked, so that an order is created with a single insert
+quotes = SessionQuotes()
+metrics.gauge('quotes', quotes.stats)
 
-# Set default location
-default_location = [os.getenv('DEFAULT_LAT'), os.getenv('DEFAULT_LNG')]
+@clients.record_once
+def on_load(state):
+    quotes.max_per_session = state.app.config['QUOTES_PER_SESSION']
+    quotes.ttl = state.app.config['QUOTE_TTL']
 
-def calculate_distance(origin, destination):
+def bad_request(message):
     """
-    Calculate the distance between two points on the earth's surface.
-    :param origin: tuple of latitude and longitude of the origin point
-    :param destination: tuple of latitude and longitude of the destination point
-    :return: distance in kilometers
+    Answer a request whose JSON body is missing a field or has an invalid one.
     """
-    # Unpack latitude and longitude from the origin and destination
-    lat1, lon1 = origin
-    lat2, lon2 = destination
-
-    radius = 6371  # Earth's radius in km
-
-    # Calculate the distance between two points on the earth
-    dlat = math.radians(lat2 - lat1)
-    dlon = math.radians(lon2 - lon1)
-    a = (math.sin(dlat / 2) * math.sin(dlat / 2) +
-        math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) *
-        math.sin(dlon / 2) * math.sin(dlon / 2))
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    distance = radius * c
-
-    # Add 10% to the distance to account for further distance due to road layout
-    distance *= 1.1
-
-    return distance # in km
+    return jsonify({'result': 'error', 'message': message}), 400
 
 def calculate_price(distance, vehicle_type):
     """
     Calculate the price of the ride based on the distance and vehicle type.
     :param distance: distance of the ride in kilometers
-    :param vehicle_type: type of the vehicle ('car', 'van', 'horse')
+    :param vehicle_type: type of the vehicle, one of the keys of pricing.PRICE_PER_KM
     :return: price of the ride
     """
-    if vehicle_type == 'car':
-        return distance * 0.5
-    elif vehicle_type == 'van':
-        return distance * 0.75
-    elif vehicle_type == 'horse':
-        return distance * 1.25
+    price_per_km = PRICE_PER_KM.get(vehicle_type)
+    if price_per_km is not None:
+        return distance * price_per_km
 
-def get_db():
+def send_email(message_content, message_title, on_failure=None):
     """
-    Get the database connection.
-    :return: database connection object
-    """
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = g._database = sqlite3.connect('uber_application.db')
-    return db
-
-def send_email(message_content, message_title):
-    """
-    Send an email to the current user.
+    Queue an email to the current user. The email is sent in the background by the mail dispatcher.
     :param message_content: content of the email
     :param message_title: title of the email
+    :param on_failure: optional function called if the email could not be sent
     """
-    try:
-        msg = Message(message_title, sender='recipe-website@noreply.com', recipients=[current_user.email])
-        msg.body = message_content
-        mail.send(msg)
-        flash(f'Your invoice has been sent to {current_user.email}', 'success')
-    except Exception as e:
+    msg = Message(message_title, sender='recipe-website@noreply.com', recipients=[current_user.email])
+    msg.body = message_content
+    if mail_dispatcher.send(msg, on_failure=on_failure):
+        flash(f'Your invoice will be sent to {current_user.email}', 'success')
+    else:
         flash('There was an error sending your confirmation!', 'danger')
-        flash(str(e), 'danger')
-        logging.info(f"SMTP Exception: {str(e)}")
-        
+        if on_failure is not None:
+            on_failure()
+
 @clients.route('/home')
 @login_required
 def home():
     """
     Render the home page.
     """
+    default_location = current_app.config['DEFAULT_LOCATION']
     client_location = session.get('client_location')
     if not client_location:
         client_location = default_location
         fetched_location = False
     else:
         fetched_location = True
-    map = folium.Map(location=client_location, zoom_start=15)
-    folium.Marker(client_location, tooltip=f'<strong>Your location</strong><br>{client_location[0]}, {client_location[1]}').add_to(map)
-    return render_template('home.html', map=map._repr_html_(), fetched_location=fetched_location, default_location=default_location)
+    return render_template('home.html', client_location=client_location, fetched_location=fetched_location, default_location=default_location)
 
 @clients.route('/receive_location', methods=['POST'])
 def receive_location():
     """
     This route receives the client's location from the frontend and stores it in the session.
     """
-    location = request.get_json()['location']
-    session['client_location'] = [location['lat'], location['lng']]
-    print(session['client_location'])
+    try:
+        location = request.get_json(silent=True)['location']
+        session['client_location'] = [float(location['lat']), float(location['lng'])]
+    except (KeyError, TypeError, ValueError):
+        return bad_request('A location with a lat and a lng is required')
+    logger.debug("Client location %s", session['client_location'])
     return jsonify({'result': 'success'})
 
-@clients.route('/receive_destination', methods=['POST'])
-def receive_destination():
+@clients.route('/quote', methods=['POST'])
+@login_required
+def quote():
+    """
+    This route receives the client's destination from the frontend and returns the distance and the price of the ride for each vehicle type.
+    Nothing is written to the database: the quote is kept in the session for QUOTE_TTL seconds and booked with its token.
+    """
+    try:
+        destination = request.get_json(silent=True)['destination']
+        destination = [float(destination['lat']), float(destination['lng'])]
+    except (KeyError, TypeError, ValueError):
+        return bad_request('A destination with a lat and a lng is required')
+    origin = session.get('client_location')
+    if origin is None:
+        return bad_request('Your location is not known yet')
+    distance = calculate_distance([float(origin[0]), float(origin[1])], destination)
+    prices = dict((vehicle_type, calculate_price(distance, vehicle_type)) for vehicle_type in PRICE_PER_KM)
+    token = quotes.put(session, {
+        'client_id': current_user.id,
+        'origin': origin,
+        'destination': destination,
+        'distance': distance,
+        'prices': prices,
+    })
+    return jsonify({'result': 'success', 'token': token, 'distance': distance, 'prices': prices, 'expires_in': quotes.ttl})
+
+@clients.route('/book', methods=['POST'])
+@login_required
+def book():
     """
-    This route receives the client's destination from the frontend and stores it in the database.
+    This route books a quoted ride with the additional information from the frontend, creating the order in a single insert.
+    Returns a 410 gone if the quote has expired or was already booked, so that the client asks for a new quote.
     """
-    destination = request.get_json()['destination']
-    destination_lat = destination['lat']
-    destination_lng = destination['lng']
-    obj = active_orders.insert_one({
+    booking = request.get_json(silent=True)
+    try:
+        vehicle_type = booking['vehicle_type']
+        token = booking['quote_token']
+        departure_time = booking['departure_time']
+        number_of_passengers = booking['number_of_passengers']
+    except (KeyError, TypeError):
+        return bad_request('The vehicle_type, quote_token, departure_time and number_of_passengers are required')
+    if vehicle_type not in PRICE_PER_KM:
+        return bad_request(f'Unknown vehicle type {vehicle_type}')
+    ride_quote = quotes.take(session, token, current_user.id)
+    if ride_quote is None:
+        return jsonify({'result': 'expired', 'message': 'This quote has expired, please enter your destination again'}), 410
+    order_id = active_orders.create({
         'client_id': current_user.id,
         'client_name': current_user.username,
         'driver_id': '',
         'driver_name': '',
-        'vehicle_type': '',
-        'departure_time': '',
-        'number_of_passengers': '',
-        'origin': session['client_location'],
-        'destination': [destination_lat, destination_lng],
-        'distance': calculate_distance(session['client_location'], [float(destination_lat), float(destination_lng)]),
-        'price': 0,
+        'vehicle_type': vehicle_type,
+        'departure_time': departure_time,
+        'number_of_passengers': number_of_passengers,
+        'origin': ride_quote['origin'],
+        'origin_point': location_point(ride_quote['origin']),
+        'destination': ride_quote['destination'],
+        'distance': ride_quote['distance'],
+        'price': ride_quote['prices'][vehicle_type],
         'status': 'waiting',
         'created_at': datetime.now(),
         'completed_at': ''
     })
-    return jsonify({'result': 'success', 'id': str(obj.inserted_id)})
-
-@clients.route('/receive_additional_info', methods=['POST'])
-def receive_additional_info():
-    """
-    This route receives additional information about the order from the frontend and updates the order in the database.
-    """
-    additional_info = request.get_json()['additional_info']
-    obj_id = ObjectId(additional_info['obj_id'])
-    number_of_passengers = additional_info['number_of_passengers']
-    vehicle_type = additional_info['vehicle_type']
-    departure_time = additional_info['departure_time']
-    order = active_orders.find_one({'_id': obj_id})
-    price = calculate_price(order['distance'], vehicle_type)
-    active_orders.update_one({'_id': obj_id}, {'$set': {
-        'number_of_passengers': number_of_passengers,
-        'vehicle_type': vehicle_type,
-        'departure_time': departure_time,
-        'price': price
-    }})
-    return jsonify({'result': 'success', 'id': str(obj_id)})
+    logger.debug("Client %s booked order %s", current_user.id, order_id)
+    return jsonify({'result': 'success', 'id': str(order_id)})
 
 @clients.route('/waiting_page/<order_id>')
 @login_required
@@ -168,19 +157,16 @@ def waiting_page(order_id):
     """
     This route renders the waiting page for the client.
     """
-    order = active_orders.find_one({'_id': ObjectId(order_id)})
+    order = active_orders.get(order_id, ['origin', 'destination', 'vehicle_type'])
     order_origin = order['origin']
     order_destination = order['destination']
     order_vehicle_type = order['vehicle_type']
-    db = get_db()
-    cur = db.cursor()
-    cur.execute("SELECT * FROM drivers WHERE vehicle = ?", (order_vehicle_type,))
-    available_drivers = cur.fetchall()
-    print(f"Available drivers: {available_drivers}")
-    map = folium.Map(location=order_origin, zoom_start=15)
-    folium.Marker(order_origin, tooltip=f'<strong>Origin</strong><br>{order_origin[0]}, {order_origin[1]}').add_to(map)
-    folium.Marker(order_destination, tooltip=f'<strong>Destination</strong><br>{order_destination[0]}, {order_destination[1]}').add_to(map)
-    return render_template('waiting_page.html', client_id=current_user.id, map=map._repr_html_(), available_drivers=available_drivers, order_id=order_id)
+    # Online drivers with the right vehicle, nearest first, from the live index of driver positions
+    available_drivers = current_app.extensions['driver_locations'].nearby(
+        float(order_origin[0]), float(order_origin[1]), current_app.config['ORDER_SEARCH_RADIUS_KM'],
+        vehicle_type=order_vehicle_type, limit=current_app.config['NEARBY_DRIVERS_LIMIT'])
+    logger.debug("%s available drivers for order %s", len(available_drivers), order_id)
+    return render_template('waiting_page.html', client_id=current_user.id, order_origin=order_origin, order_destination=order_destination, available_drivers=available_drivers, order_id=order_id)
 
 @clients.route('/cancel_order/<str_order_id>')
 @login_required
@@ -189,7 +175,7 @@ def cancel_order(str_order_id):
     This route cancels the order and redirects the client to the home page.
     """
     obj_id = ObjectId(str_order_id)
-    active_orders.delete_one({'_id': obj_id})
+    active_orders.delete(obj_id)
     flash('Your order has been cancelled', 'success')
     return redirect(url_for('clients.home'))
 
@@ -200,7 +186,7 @@ def client_ongoing_ride(order_id):
     This route renders the ongoing ride page for the client.
     """
     obj_id = ObjectId(order_id)
-    order = active_orders.find_one({'_id': obj_id})
+    order = active_orders.get(obj_id, ['driver_name', 'origin', 'destination', 'distance'])
     driver_name = order['driver_name']
     origin = order['origin']
     destination = order['destination']
@@ -211,10 +197,17 @@ def client_ongoing_ride(order_id):
 @login_required
 def ride_invoice(order_id):
     """
-    This route renders the ride invoice for the client and sends an email with the invoice.
+    This route renders the ride invoice for the client and sends an email with the invoice the first time it is viewed.
+    The invoice of a completed ride never changes, so it is rendered once and then served from the page cache.
     """
+    page_cache = current_app.extensions['page_cache']
+    key = ('ride_invoice', order_id, False, current_user.id)
+    page = page_cache.get(key)
+    if page is not None:
+        return page_response(page)
+
     obj_id = ObjectId(order_id)
-    order = active_orders.find_one({'_id': obj_id})
+    order = active_orders.get_any(obj_id, ['driver_name', 'vehicle_type', 'origin', 'destination', 'distance', 'departure_time', 'completed_at', 'price', 'status', 'ended_at'])
     driver_name = order['driver_name']
     vehicle = order['vehicle_type']
     origin = order['origin']
@@ -223,5 +216,16 @@ def ride_invoice(order_id):
     departure_time = order['departure_time']
     completed_at = order['completed_at']
     price = round(order['price'], 2)
-    send_email(f"Your ride from {origin} to {destination} has been completed. Your driver was {driver_name}. The total price was {price}.", "Your ride invoice")
-    return render_template('ride_invoice.html', driver_name=driver_name, vehicle=vehicle, origin=origin, destination=destination, distance=distance, price=price, order_id=order_id, client_name=current_user.username, departure_time=departure_time, completed_at=completed_at)
+    if active_orders.claim_invoice(obj_id):
+        def on_failure():
+            # Render the invoice again on the next visit, so that sending it is retried
+            active_orders.release_invoice(obj_id)
+            page_cache.invalidate(key)
+
+        send_email(f"Your ride from {origin} to {destination} has been completed. Your driver was {driver_name}. The total price was {price}.", "Your ride invoice", on_failure=on_failure)
+    # A page showing flashed messages is only rendered once, the next visit renders and caches the invoice without them
+    cacheable = order['status'] == 'completed' and not session.get('_flashes')
+    body = render_template('ride_invoice.html', driver_name=driver_name, vehicle=vehicle, origin=origin, destination=destination, distance=distance, price=price, order_id=order_id, client_name=current_user.username, departure_time=departure_time, completed_at=completed_at)
+    if not cacheable:
+        return body
+    return page_response(page_cache.set(key, body, last_modified=order.get('ended_at')))
@@ -0,0 +1,139 @@
+import os
+
+from dotenv import load_dotenv
+
+# The environment is read once, when this module is first imported
+load_dotenv()
+
+def env_bool(name, default):
+    return os.getenv(name, str(default)) == 'True'
+
+class Config(object):
+    """
+    Settings shared by every profile, read from the environment.
+    """
+    SECRET_KEY = os.getenv('SECRET_KEY')
+    MAX_CONTENT_LENGTH = 16 * 1024 * 1024
+    DEBUG = False
+    DEBUG_TB_ENABLED = False
+    SOCKETIO_LOGGER = False
+    LOG_FILE = None
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'WARNING')
+    # Comma separated logger=level pairs, for example 'chat=DEBUG,engineio=WARNING'
+    LOG_LEVELS = os.getenv('LOG_LEVELS', '')
+    # Comma separated logger=fraction pairs, the fraction of INFO and DEBUG records kept for high-frequency loggers
+    LOG_SAMPLING = os.getenv('LOG_SAMPLING', 'app.events=0.1')
+    LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+
+    MAIL_SERVER = os.getenv('MAIL_SERVER')
+    MAIL_PORT = os.getenv('MAIL_PORT')
+    MAIL_USERNAME = os.getenv('MAIL_USERNAME')
+    MAIL_PASSWORD = os.getenv('MAIL_PASSWORD')
+    MAIL_USE_TLS = env_bool('MAIL_USE_TLS', True)
+    MAIL_USE_SSL = env_bool('MAIL_USE_SSL', False)
+    MAIL_WORKERS = int(os.getenv('MAIL_WORKERS', 2))
+    MAIL_QUEUE_SIZE = int(os.getenv('MAIL_QUEUE_SIZE', 1000))
+    MAIL_BATCH_SIZE = int(os.getenv('MAIL_BATCH_SIZE', 20))
+    MAIL_MAX_RETRIES = int(os.getenv('MAIL_MAX_RETRIES', 5))
+    MAIL_RETRY_DELAY = float(os.getenv('MAIL_RETRY_DELAY', 2))
+
+    SQLITE_PATH = os.getenv('SQLITE_PATH', 'uber_application.db')
+
+    # Where sessions are kept: 'sqlite', 'memory' (one worker process only) or 'cookie'
+    SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'sqlite')
+    SESSION_SQLITE_PATH = os.getenv('SESSION_SQLITE_PATH', 'sessions.db')
+    SESSION_MAX_ENTRIES = int(os.getenv('SESSION_MAX_ENTRIES', 100000))
+    SESSION_TTL = int(os.getenv('SESSION_TTL', 86400))
+
+    MONGO_URI = os.getenv('MONGO_URI')
+    MONGO_DB_NAME = os.getenv('MONGO_DB_NAME', 'uber')
+    MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', 100))
+    MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', 0))
+    MONGO_MAX_IDLE_TIME_MS = int(os.getenv('MONGO_MAX_IDLE_TIME_MS', 60000))
+    MONGO_CONNECT_TIMEOUT_MS = int(os.getenv('MONGO_CONNECT_TIMEOUT_MS', 5000))
+    MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000))
+    MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv('MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000))
+    MONGO_WRITE_CONCERN = os.getenv('MONGO_WRITE_CONCERN', '1')
+    MONGO_READ_CONCERN = os.getenv('MONGO_READ_CONCERN', 'local')
+
+    SOCKETIO_MESSAGE_QUEUE = os.getenv('SOCKETIO_MESSAGE_QUEUE') or None
+    SOCKETIO_CHANNEL = os.getenv('SOCKETIO_CHANNEL', 'flask-socketio')
+    SOCKETIO_ASYNC_MODE = os.getenv('SOCKETIO_ASYNC_MODE') or None
+
+    DEFAULT_LOCATION = [os.getenv('DEFAULT_LAT'), os.getenv('DEFAULT_LNG')]
+    ORDER_POLL_INTERVAL = float(os.getenv('ORDER_POLL_INTERVAL', 1))
+    ORDER_SEARCH_RADIUS_KM = float(os.getenv('ORDER_SEARCH_RADIUS_KM', 10))
+    ORDER_PAGE_SIZE = int(os.getenv('ORDER_PAGE_SIZE', 20))
+    # Orders read by id are cached for a few seconds while in progress, and longer once completed
+    ORDER_CACHE_SIZE = int(os.getenv('ORDER_CACHE_SIZE', 10000))
+    ORDER_CACHE_TTL = float(os.getenv('ORDER_CACHE_TTL', 30))
+    ORDER_CACHE_COMPLETED_TTL = float(os.getenv('ORDER_CACHE_COMPLETED_TTL', 3600))
+    # Rendered summaries and invoices of completed rides, evicted least recently used first past either limit
+    PAGE_CACHE_MAX_ENTRIES = int(os.getenv('PAGE_CACHE_MAX_ENTRIES', 5000))
+    PAGE_CACHE_MAX_BYTES = int(os.getenv('PAGE_CACHE_MAX_BYTES', 50 * 1024 * 1024))
+    PAGE_CACHE_TTL = float(os.getenv('PAGE_CACHE_TTL', 86400))
+
+    # Drivers whose position is older than this are considered offline
+    DRIVER_LOCATION_TTL = int(os.getenv('DRIVER_LOCATION_TTL', 60))
+    # Seconds between two positions sent by a driver's page, even when the driver has not moved
+    DRIVER_LOCATION_HEARTBEAT = int(os.getenv('DRIVER_LOCATION_HEARTBEAT', 20))
+    DRIVER_GRID_CELL_KM = float(os.getenv('DRIVER_GRID_CELL_KM', 1))
+    NEARBY_DRIVERS_LIMIT = int(os.getenv('NEARBY_DRIVERS_LIMIT', 10))
+
+    # Seconds during which a ride quote can be booked at its price
+    QUOTE_TTL = int(os.getenv('QUOTE_TTL', 300))
+    QUOTES_PER_SESSION = int(os.getenv('QUOTES_PER_SESSION', 5))
+
+    # Optional dispatch mode: waiting orders are offered to the nearest available drivers
+    DISPATCH_ENABLED = env_bool('DISPATCH_ENABLED', False)
+    DISPATCH_INTERVAL_SECONDS = int(os.getenv('DISPATCH_INTERVAL_SECONDS', 5))
+    DISPATCH_MAX_PICKUP_KM = float(os.getenv('DISPATCH_MAX_PICKUP_KM', 5))
+    DISPATCH_OFFER_TIMEOUT = int(os.getenv('DISPATCH_OFFER_TIMEOUT', 20))
+
+    USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+    USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 300))
+
+    CHAT_MAX_MESSAGE_LENGTH = int(os.getenv('CHAT_MAX_MESSAGE_LENGTH', 500))
+    CHAT_ROOM_BUFFER_SIZE = int(os.getenv('CHAT_ROOM_BUFFER_SIZE', 100))
+    CHAT_HISTORY_SIZE = int(os.getenv('CHAT_HISTORY_SIZE', 50))
+    CHAT_RATE_PER_SECOND = float(os.getenv('CHAT_RATE_PER_SECOND', 5))
+    CHAT_BURST = int(os.getenv('CHAT_BURST', 10))
+
+    ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', 500))
+    ARCHIVE_INTERVAL_SECONDS = int(os.getenv('ARCHIVE_INTERVAL_SECONDS', 60))
+    ARCHIVE_COMPLETED_AFTER_MINUTES = float(os.getenv('ARCHIVE_COMPLETED_AFTER_MINUTES', 60))
+    WAITING_ORDER_TTL_MINUTES = float(os.getenv('WAITING_ORDER_TTL_MINUTES', 30))
+
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+    # Bearer token required by the operator earnings report, which is disabled when it is not set
+    REPORTS_TOKEN = os.getenv('REPORTS_TOKEN')
+    EARNINGS_DAYS = int(os.getenv('EARNINGS_DAYS', 30))
+    # Orders fetched per round trip when exporting the ride history
+    EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+
+class DevelopmentConfig(Config):
+    """
+    Local development: debug mode, debug toolbar, Socket.IO logging and an unsampled log file.
+    """
+    DEBUG = True
+    DEBUG_TB_ENABLED = True
+    SOCKETIO_LOGGER = True
+    LOG_FILE = 'app.log'
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+    LOG_SAMPLING = os.getenv('LOG_SAMPLING', '')
+
+class ProductionConfig(Config):
+    """
+    Production: no debug tooling, warnings and errors logged to stderr as JSON.
+    """
+
+configs = {
+    'development': DevelopmentConfig,
+    'production': ProductionConfig,
+}
+
+def get_config(name=None):
+    """
+    Get the settings of a profile. Defaults to the APP_ENV environment variable, then to development.
+    """
+    return configs[name or os.getenv('APP_ENV', 'development')]
@@ -0,0 +1,209 @@
+import logging
+import queue
+import sqlite3
+
+from flask import g
+
+from config import Config
+from metrics import TimedConnection
+
+logger = logging.getLogger(__name__)
+
+# Pragmas applied to every new connection
+PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-16000',
+]
+
+class MigrationError(Exception):
+    """
+    Raised when a schema migration cannot be applied, for example because existing accounts share a username.
+    """
+
+def find_duplicates(db, table, column):
+    """
+    :return: list of (value, comma separated ids) of the values of a column shared by several rows of a table
+    """
+    return db.execute(f'SELECT {column}, GROUP_CONCAT(id) FROM {table} WHERE {column} IS NOT NULL '
+                      f'GROUP BY {column} HAVING COUNT(*) > 1 ORDER BY {column}').fetchall()
+
+def describe_duplicates(duplicates):
+    """
+    :return: the first duplicated values returned by find_duplicates and their ids, for a log or an error message
+    """
+    listed = '; '.join(f"{value!r} (ids {ids})" for value, ids in duplicates[:20])
+    return f"{listed}{' ...' if len(duplicates) > 20 else ''}"
+
+def check_unique(table, column):
+    """
+    Build a migration step that fails if several rows of a table share a value of a column, before a unique index is created on it.
+    The error lists the duplicated values and the ids of their rows, so that the accounts can be merged or fixed by hand.
+    """
+    def check(db):
+        duplicates = find_duplicates(db, table, column)
+        if duplicates:
+            raise MigrationError(f"{table}.{column} has {len(duplicates)} duplicated values, "
+                                 f"fix them before restarting: {describe_duplicates(duplicates)}")
+    return check
+
+# Schema changes applied in order by init_db. The database's user_version is the number of changes already applied.
+# A step is either an SQL statement or a function called with the connection.
+MIGRATIONS = [
+    # Look up a username in both tables with a single query
+    [
+        'CREATE VIEW IF NOT EXISTS accounts AS '
+        'SELECT id, username, password, email, 0 AS is_driver FROM clients '
+        'UNION ALL SELECT id, username, password, email, 1 AS is_driver FROM drivers',
+    ],
+    # Index the usernames used by sign-up and login, which were always checked for uniqueness
+    [
+        check_unique('clients', 'username'),
+        check_unique('drivers', 'username'),
+        'CREATE UNIQUE INDEX IF NOT EXISTS clients_username ON clients (username)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS drivers_username ON drivers (username)',
+    ],
+    # The unique email indexes, now created by create_unique_indexes. Kept so that the numbers of the later migrations do not change
+    [],
+]
+
+# Unique indexes on columns that were not unique before, so that existing rows may share a value.
+# They are created at startup once there are no duplicates, and until then only sign-up keeps the values unique.
+UNIQUE_INDEXES = [
+    ('clients', 'email'),
+    ('drivers', 'email'),
+]
+
+class ConnectionPool(object):
+    """
+    A pool of SQLite connections shared by all the blueprints.
+    Connections are reused across requests so that their prepared statement cache stays warm.
+    """
+    def __init__(self, path, max_idle=16, cached_statements=256):
+        self.path = path
+        self.max_idle = max_idle
+        self.cached_statements = cached_statements
+        self.idle = queue.LifoQueue(maxsize=max_idle)
+
+    def connect(self):
+        """
+        Open a new connection and apply the pragmas.
+        """
+        connection = sqlite3.connect(self.path, check_same_thread=False, cached_statements=self.cached_statements, factory=TimedConnection)
+        for pragma in PRAGMAS:
+            connection.execute(pragma)
+        return connection
+
+    def acquire(self):
+        """
+        Take an idle connection from the pool, or open a new one if there is none.
+        """
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self.connect()
+
+    def release(self, connection):
+        """
+        Return a connection to the pool, closing it if the pool is full.
+        """
+        if connection.in_transaction:
+            connection.rollback()
+        try:
+            self.idle.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+pool = ConnectionPool(Config.SQLITE_PATH)
+
+def init_app(app):
+    """
+    Point the pool at the configured database file and return connections to it after each request.
+    """
+    if pool.path != app.config['SQLITE_PATH']:
+        while not pool.idle.empty():
+            pool.idle.get_nowait().close()
+        pool.path = app.config['SQLITE_PATH']
+    app.teardown_appcontext(lambda exception: release_db())
+
+def get_db():
+    """
+    Get the database connection for the current request, taking it from the pool if needed.
+    :return: database connection object
+    """
+    db = getattr(g, '_database', None)
+    if db is None:
+        db = g._database = pool.acquire()
+    return db
+
+def release_db():
+    """
+    Return the current request's database connection to the pool.
+    """
+    db = g.pop('_database', None)
+    if db is not None:
+        pool.release(db)
+
+def init_db():
+    """
+    Create the clients and drivers tables if they do not exist, apply the pending migrations and create the missing unique indexes. Called once at startup.
+    :return: list of the (table, column) pairs left without their unique index because of duplicated values
+    """
+    db = pool.acquire()
+    try:
+        db.execute('CREATE TABLE IF NOT EXISTS clients (id INTEGER PRIMARY KEY, username TEXT, password TEXT, email TEXT)')
+        db.execute('CREATE TABLE IF NOT EXISTS drivers (id INTEGER PRIMARY KEY, username TEXT, password TEXT, email TEXT, first_name TEXT, last_name TEXT, phone_number TEXT, vehicle TEXT, license_plate TEXT)')
+        db.commit()
+        migrate(db)
+        return create_unique_indexes(db)
+    finally:
+        pool.release(db)
+
+def migrate(db):
+    """
+    Apply the migrations the database has not seen yet, each in its own transaction.
+    A migration that fails, for example because existing accounts share a username, is rolled back and raises a MigrationError,
+    so that the application does not start on a schema the code does not expect. It is retried at the next startup.
+    """
+    version = db.execute('PRAGMA user_version').fetchone()[0]
+    for number, steps in enumerate(MIGRATIONS[version:], start=version + 1):
+        try:
+            db.execute('BEGIN')
+            for step in steps:
+                if callable(step):
+                    step(db)
+                else:
+                    db.execute(step)
+            db.execute(f'PRAGMA user_version = {number}')
+            db.commit()
+        except (sqlite3.Error, MigrationError) as e:
+            db.rollback()
+            logger.error(f"Schema migration {number} failed, the database stays at version {number - 1}: {e}")
+            if isinstance(e, MigrationError):
+                raise
+            raise MigrationError(f"Schema migration {number} failed: {e}") from e
+        logger.info(f"Applied schema migration {number}")
+
+def create_unique_indexes(db):
+    """
+    Create the UNIQUE_INDEXES that do not exist yet. A column whose values are duplicated is logged with the ids of the rows sharing them
+    and left without its index, rather than stopping the application. The index is created at the first startup after the rows are fixed.
+    :return: list of the (table, column) pairs still without their index
+    """
+    missing = []
+    for table, column in UNIQUE_INDEXES:
+        name = f'{table}_{column}'
+        if db.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (name,)).fetchone() is not None:
+            continue
+        duplicates = find_duplicates(db, table, column)
+        if duplicates:
+            logger.warning("%s.%s has %s duplicated values, its unique index is not created until they are fixed: %s",
+                           table, column, len(duplicates), describe_duplicates(duplicates))
+            missing.append((table, column))
+            continue
+        db.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {name} ON {table} ({column})')
+        db.commit()
+        logger.info("Created the unique index %s", name)
+    return missing
@@ -0,0 +1,237 @@
+import logging
+import threading
+import time
+
+import numpy as np
+
+from metrics import metrics
+from pricing import batch_distance
+
+logger = logging.getLogger(__name__)
+
+# Cost given to pairs that must not be matched, larger than any real pickup distance
+UNMATCHABLE = 1e6
+
+
+def pickup_distances(order_points, driver_points):
+    """
+    Calculate the distance from every driver to every order's pickup point, with the same formula as pricing.calculate_distance.
+    :param order_points: array-like of shape (n, 2) with the latitude and longitude of each pickup point
+    :param driver_points: array-like of shape (m, 2) with the latitude and longitude of each driver
+    :return: (n, m) matrix of distances in kilometers
+    """
+    order_points = np.asarray(order_points, dtype=np.float64).reshape(-1, 1, 2)
+    driver_points = np.asarray(driver_points, dtype=np.float64).reshape(1, -1, 2)
+    return batch_distance(order_points, driver_points)
+
+def solve_assignment(costs):
+    """
+    Find the assignment of rows to columns with the smallest total cost, with the shortest augmenting path method.
+    Every row is assigned, so there must be at least as many columns as rows.
+    :param costs: (n, m) matrix of finite costs, n <= m
+    :return: array of n column indexes
+    """
+    n, m = costs.shape
+    u = np.zeros(n)
+    v = np.zeros(m)
+    col_for_row = np.full(n, -1)
+    row_for_col = np.full(m, -1)
+    for current_row in range(n):
+        shortest = np.full(m, np.inf)
+        path = np.full(m, -1)
+        remaining = np.ones(m, dtype=bool)
+        scanned_rows = []
+        min_value = 0.0
+        row = current_row
+        sink = -1
+        # Dijkstra on the reduced costs until a free column is reached
+        while sink == -1:
+            scanned_rows.append(row)
+            reduced = min_value + costs[row] - u[row] - v
+            better = remaining & (reduced < shortest)
+            path[better] = row
+            shortest[better] = reduced[better]
+            candidates = np.where(remaining, shortest, np.inf)
+            column = int(np.argmin(candidates))
+            min_value = candidates[column]
+            # On a tie, prefer a free column to end the search early
+            free = np.flatnonzero((candidates == min_value) & (row_for_col == -1))
+            if free.size:
+                column = int(free[0])
+            remaining[column] = False
+            if row_for_col[column] == -1:
+                sink = column
+            else:
+                row = row_for_col[column]
+
+        u[current_row] += min_value
+        others = np.array(scanned_rows[1:], dtype=int)
+        u[others] += min_value - shortest[col_for_row[others]]
+        scanned = ~remaining
+        v[scanned] -= min_value - shortest[scanned]
+
+        column = sink
+        while True:
+            row = path[column]
+            row_for_col[column] = row
+            col_for_row[row], column = column, col_for_row[row]
+            if row == current_row:
+                break
+    return col_for_row
+
+def match(distances, max_pickup_km):
+    """
+    Pair orders with drivers so that as many orders as possible get a driver within max_pickup_km,
+    with the smallest total pickup distance.
+    :param distances: (n, m) matrix of pickup distances, np.inf for pairs that must not be matched
+    :return: list of (order index, driver index, distance) tuples
+    """
+    n, m = distances.shape
+    if n == 0 or m == 0:
+        return []
+    costs = np.where(distances <= max_pickup_km, distances, UNMATCHABLE)
+    if n <= m:
+        pairs = enumerate(solve_assignment(costs))
+    else:
+        pairs = ((order, driver) for driver, order in enumerate(solve_assignment(costs.T)))
+    return [(order, int(driver), float(distances[order, driver])) for order, driver in pairs if costs[order, driver] < UNMATCHABLE]
+
+class Dispatcher(object):
+    """
+    Offers waiting orders to nearby available drivers.
+    Every run takes all the waiting orders and the available drivers of each vehicle type, and pairs them
+    with the smallest total pickup distance. Each driver is sent one offer at a time over socket.io and accepts it
+    through the usual accept_order route, so offers and manual accepts cannot both win the same order.
+    """
+    def __init__(self, repository, driver_locations, socketio, max_pickup_km=5, offer_timeout=20):
+        self.repository = repository
+        self.driver_locations = driver_locations
+        self.socketio = socketio
+        self.max_pickup_km = max_pickup_km
+        self.offer_timeout = offer_timeout
+        self.offers = {}
+        self.declined = set()
+        self.lock = threading.Lock()
+
+    def decline(self, order_id, driver_id):
+        """
+        Withdraw an offer declined by a driver. The order is not offered to the same driver again.
+        """
+        with self.lock:
+            offer = self.offers.get(order_id)
+            if offer is not None and offer[0] == driver_id:
+                del self.offers[order_id]
+            self.declined.add((order_id, driver_id))
+
+    def run(self):
+        """
+        Match the waiting orders that have no pending offer, and send the offers.
+        """
+        with metrics.timer('dispatch_seconds'):
+            orders = [order for order in self.repository.find_waiting(['origin', 'destination', 'vehicle_type', 'distance', 'price'])]
+            waiting = set(str(order['_id']) for order in orders)
+            now = time.monotonic()
+            with self.lock:
+                self.offers = dict((order_id, offer) for order_id, offer in self.offers.items() if order_id in waiting and offer[1] > now)
+                self.declined = set(pair for pair in self.declined if pair[0] in waiting)
+                offered_drivers = set(offer[0] for offer in self.offers.values())
+                declined = set(self.declined)
+                orders = [order for order in orders if str(order['_id']) not in self.offers]
+
+            by_vehicle_type = {}
+            for order in orders:
+                by_vehicle_type.setdefault(order['vehicle_type'], []).append(order)
+            offers = []
+            for vehicle_type, group in by_vehicle_type.items():
+                drivers = [driver for driver in self.driver_locations.available(vehicle_type) if driver[0] not in offered_drivers]
+                if not drivers:
+                    continue
+                distances = pickup_distances([[float(value) for value in order['origin']] for order in group], [driver[1:] for driver in drivers])
+                order_index = dict((str(order['_id']), i) for i, order in enumerate(group))
+                driver_index = dict((driver[0], j) for j, driver in enumerate(drivers))
+                for order_id, driver_id in declined:
+                    if order_id in order_index and driver_id in driver_index:
+                        distances[order_index[order_id], driver_index[driver_id]] = np.inf
+                for i, j, distance in match(distances, self.max_pickup_km):
+                    offers.append((group[i], drivers[j][0], distance))
+
+            expires = time.monotonic() + self.offer_timeout
+            with self.lock:
+                for order, driver_id, distance in offers:
+                    self.offers[str(order['_id'])] = (driver_id, expires)
+        for order, driver_id, distance in offers:
+            self.socketio.emit('order_offer', {
+                'order_id': str(order['_id']),
+                'origin': order['origin'],
+                'destination': order['destination'],
+                'pickup_distance': round(distance, 2),
+                'distance': round(order['distance'], 2),
+                'price': round(order['price'], 2),
+                'timeout': self.offer_timeout,
+            }, namespace='/drivers', to=driver_id)
+        metrics.increment('dispatch_offers_total', len(offers))
+        if offers:
+            logger.info(f"Sent {len(offers)} offers for {len(orders)} unassigned orders")
+
+    def stats(self):
+        with self.lock:
+            return {'pending_offers': len(self.offers)}
+
+def simulate(orders=1000, drivers=1200, radius_km=10, max_pickup_km=5, seed=0):
+    """
+    Compare the dispatcher's matching with drivers picking orders themselves, on random orders and drivers around a city centre.
+    First come: each order in turn takes the nearest free driver, as when drivers accept the orders they see first.
+    Greedy: the closest remaining order and driver pair is matched first.
+    """
+    rng = np.random.default_rng(seed)
+    centre = np.array([48.8566, 2.3522])
+    spread = radius_km / 111.0
+    order_points = centre + rng.uniform(-spread, spread, (orders, 2))
+    driver_points = centre + rng.uniform(-spread, spread, (drivers, 2))
+
+    start = time.perf_counter()
+    distances = pickup_distances(order_points, driver_points)
+    matrix_time = time.perf_counter() - start
+
+    results = {}
+    start = time.perf_counter()
+    results['dispatcher'] = ([distance for _, _, distance in match(distances, max_pickup_km)], time.perf_counter() - start)
+
+    start = time.perf_counter()
+    free = np.ones(drivers, dtype=bool)
+    picked = []
+    for i in range(orders):
+        candidates = np.where(free, distances[i], np.inf)
+        j = int(np.argmin(candidates))
+        if candidates[j] <= max_pickup_km:
+            free[j] = False
+            picked.append(candidates[j])
+    results['first come'] = (picked, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    order_free = np.ones(orders, dtype=bool)
+    free = np.ones(drivers, dtype=bool)
+    picked = []
+    for flat in np.argsort(distances, axis=None):
+        i, j = divmod(int(flat), drivers)
+        if distances[i, j] > max_pickup_km:
+            break
+        if order_free[i] and free[j]:
+            order_free[i] = free[j] = False
+            picked.append(distances[i, j])
+    results['greedy'] = (picked, time.perf_counter() - start)
+
+    print(f'{orders} orders, {drivers} drivers within {radius_km} km, max pickup {max_pickup_km} km, distance matrix {matrix_time * 1000:.0f} ms')
+    for name, (picked, seconds) in results.items():
+        print(f'{name:>10}: {len(picked)} matched, total pickup {sum(picked):.0f} km, mean {np.mean(picked) if picked else 0:.2f} km, {seconds * 1000:.0f} ms')
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Simulate the dispatcher on random orders and drivers.')
+    parser.add_argument('--orders', type=int, default=1000)
+    parser.add_argument('--drivers', type=int, default=1200)
+    parser.add_argument('--radius-km', type=float, default=10)
+    parser.add_argument('--max-pickup-km', type=float, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    simulate(args.orders, args.drivers, args.radius_km, args.max_pickup_km, args.seed)
@@ -0,0 +1,161 @@
+import math
+import threading
+import time
+
+from pricing import EARTH_RADIUS_KM, calculate_distance
+
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+class OnlineDriver(object):
+    """
+    Last known position of an online driver.
+    """
+    __slots__ = ('driver_id', 'name', 'license_plate', 'vehicle_type', 'lat', 'lng', 'cell', 'available', 'updated')
+
+    def __init__(self, driver_id, name, license_plate, vehicle_type):
+        self.driver_id = driver_id
+        self.name = name
+        self.license_plate = license_plate
+        self.vehicle_type = vehicle_type
+        self.lat = None
+        self.lng = None
+        self.cell = None
+        self.available = True
+        self.updated = time.monotonic()
+
+class DriverLocationIndex(object):
+    """
+    In-memory grid index of the positions of online drivers.
+    The map is divided into cells of cell_size_km degrees of latitude and longitude, each cell holding the ids of the drivers in it.
+    A position update only moves a driver between two cells, and a nearby search only looks at the cells around the point.
+    Drivers that have not sent their position for ttl seconds are ignored by searches and removed by expire.
+    The index lives in the process memory, so every Socket.IO worker has its own.
+    """
+    def __init__(self, cell_size_km=1.0, ttl=60):
+        self.cell_degrees = cell_size_km / KM_PER_DEGREE
+        self.ttl = ttl
+        self.drivers = {}
+        self.cells = {}
+        self.lock = threading.Lock()
+
+    def cell(self, lat, lng):
+        return (math.floor(lat / self.cell_degrees), math.floor(lng / self.cell_degrees))
+
+    def go_online(self, driver_id, name, license_plate, vehicle_type):
+        """
+        Add a driver to the index. The driver is found by searches once a position has been received.
+        """
+        with self.lock:
+            if driver_id not in self.drivers:
+                self.drivers[driver_id] = OnlineDriver(driver_id, name, license_plate, vehicle_type)
+
+    def go_offline(self, driver_id):
+        with self.lock:
+            driver = self.drivers.pop(driver_id, None)
+            if driver is not None:
+                self.leave_cell(driver)
+
+    def leave_cell(self, driver):
+        # Called with the lock held
+        if driver.cell is not None:
+            members = self.cells[driver.cell]
+            members.discard(driver.driver_id)
+            if not members:
+                del self.cells[driver.cell]
+            driver.cell = None
+
+    def update(self, driver_id, lat, lng):
+        """
+        Record the position of an online driver.
+        :return: False if the driver is not online
+        """
+        cell = self.cell(lat, lng)
+        with self.lock:
+            driver = self.drivers.get(driver_id)
+            if driver is None:
+                return False
+            if driver.cell != cell:
+                self.leave_cell(driver)
+                members = self.cells.get(cell)
+                if members is None:
+                    members = self.cells[cell] = set()
+                members.add(driver_id)
+                driver.cell = cell
+            driver.lat = lat
+            driver.lng = lng
+            driver.updated = time.monotonic()
+        return True
+
+    def set_available(self, driver_id, available):
+        """
+        Mark a driver as available or busy with a ride. Busy drivers are not returned by nearby.
+        """
+        with self.lock:
+            driver = self.drivers.get(driver_id)
+            if driver is not None:
+                driver.available = available
+
+    def nearby(self, lat, lng, radius_km, vehicle_type=None, limit=10):
+        """
+        Find the nearest available drivers around a point.
+        :param radius_km: search radius in kilometers, by road as for the fares
+        :param vehicle_type: only return drivers with this vehicle type if given
+        :return: list of at most limit dicts with the driver's id, name, license plate, position and distance in kilometers, nearest first
+        """
+        lat_cells = math.ceil(radius_km / KM_PER_DEGREE / self.cell_degrees)
+        # A degree of longitude gets shorter away from the equator
+        lng_cells = math.ceil(radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01)) / self.cell_degrees)
+        lat_cell, lng_cell = self.cell(lat, lng)
+        oldest = time.monotonic() - self.ttl
+        candidates = []
+        with self.lock:
+            for i in range(lat_cell - lat_cells, lat_cell + lat_cells + 1):
+                for j in range(lng_cell - lng_cells, lng_cell + lng_cells + 1):
+                    for driver_id in self.cells.get((i, j), ()):
+                        driver = self.drivers[driver_id]
+                        if driver.available and driver.updated >= oldest and (vehicle_type is None or driver.vehicle_type == vehicle_type):
+                            candidates.append((driver.driver_id, driver.name, driver.license_plate, driver.lat, driver.lng))
+        found = []
+        for driver_id, name, license_plate, driver_lat, driver_lng in candidates:
+            distance = calculate_distance((lat, lng), (driver_lat, driver_lng))
+            if distance <= radius_km:
+                found.append({
+                    'driver_id': driver_id,
+                    'name': name,
+                    'license_plate': license_plate,
+                    'location': [driver_lat, driver_lng],
+                    'distance': distance,
+                })
+        found.sort(key=lambda driver: driver['distance'])
+        return found[:limit]
+
+    def available(self, vehicle_type):
+        """
+        :return: list of (driver id, latitude, longitude) tuples of the available drivers with a recent position and this vehicle type
+        """
+        oldest = time.monotonic() - self.ttl
+        with self.lock:
+            return [(driver.driver_id, driver.lat, driver.lng) for driver in self.drivers.values()
+                    if driver.available and driver.cell is not None and driver.updated >= oldest and driver.vehicle_type == vehicle_type]
+
+    def expire(self):
+        """
+        Remove the drivers whose position is older than the time to live.
+        :return: number of drivers removed
+        """
+        oldest = time.monotonic() - self.ttl
+        with self.lock:
+            stale = [driver for driver in self.drivers.values() if driver.updated < oldest]
+            for driver in stale:
+                self.leave_cell(driver)
+                del self.drivers[driver.driver_id]
+        return len(stale)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'online': len(self.drivers),
+                'available': sum(1 for driver in self.drivers.values() if driver.available),
+                'cells': len(self.cells),
+            }
@@ -1,38 +1,49 @@
-from flask import render_template, request, session, jsonify, g
-import folium
+import logging
+from flask import abort, render_template, request, session, jsonify, current_app
 from flask_login import login_required, current_user
-from dotenv import load_dotenv
-import os
-from pymongo import MongoClient
 from bson import ObjectId
-import sqlite3
+from datetime import datetime, timedelta
+from pymongo.errors import PyMongoError
 
+from database import get_db
+from earnings import driver_earnings, ride_day, totals
+from orders import active_orders
+from page_cache import page_response
 from . import drivers
 
-load_dotenv()
+logger = logging.getLogger(__name__)
 
-# Connect to MongoDB database
-db = MongoClient(os.getenv('MONGO_URI'))['uber']
-active_orders = db['active_orders']
-
-# Set default location from environment variables
-default_location = [os.getenv('DEFAULT_LAT'), os.getenv('DEFAULT_LNG')]
+def bad_request(message):
+    """
+    Answer a request whose JSON body is missing a field or has an invalid one.
+    """
+    return jsonify({'result': 'error', 'message': message}), 400
 
-def get_db():
+def forbidden():
     """
-    Connect to SQLite database and return the connection.
+    Answer a request made by a logged in client to a route reserved to drivers.
+    Client and driver ids come from two tables and overlap, so the id alone does not tell a driver apart.
     """
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = g._database = sqlite3.connect('uber_application.db')
-    return db
+    return jsonify({'result': 'forbidden', 'message': 'Only drivers can do this'}), 403
 
 @drivers.route('/driver_home')
 @login_required
 def driver_home():
     """
-    Render the driver home page with a map and pending orders.
+    Render the driver home page. The map and the nearest pending orders are loaded by the browser from driver_map_data.
+    """
+    page = max(request.args.get('page', 1, type=int), 1)
+    sent_location = session.get('driver_location', None) is not None
+    return render_template('driver_home.html', sent_location=sent_location, default_location=current_app.config['DEFAULT_LOCATION'], driver_name=current_user.username, page=page,
+                           location_heartbeat=current_app.config['DRIVER_LOCATION_HEARTBEAT'])
+
+@drivers.route('/driver_home/map_data')
+@login_required
+def driver_map_data():
     """
+    Return the driver's location and the nearest pending orders as JSON, one page at a time.
+    """
+    page = max(request.args.get('page', 1, type=int), 1)
     db = get_db()
     cursor = db.cursor()
     cursor.execute('SELECT vehicle FROM drivers WHERE id=?', (current_user.id,))
@@ -40,65 +51,60 @@ def driver_home():
 
     driver_location = session.get('driver_location', None)
     if not driver_location:
-        sent_location = False
-        driver_location = default_location
-    else:
-        sent_location = True
-
-    # Create a map centered at driver's location
-    map = folium.Map(location=driver_location, zoom_start=15)
-
-    # Find pending orders for the driver's vehicle type
-    pending_orders = active_orders.find({'status': 'waiting', 'vehicle_type': vehicle_type})
-
-    num_orders = 0
-    for order in pending_orders:
-        num_orders += 1
-        origin = order['origin']
-        destination = order['destination']
-        distance = order['distance']
-        price = order['price']
-        id = str(order['_id'])
-
-        # Create a marker to display the order details on the map
-        order_marker_html = f"""
-            <form action="javascript:;" onsubmit="parent.acceptOrder(\'{id}\')">
-                <input type='hidden' name='order_id' value='{id}'>
-                <strong>Pickup location: </strong>{origin[0]}, {origin[1]}<br>
-                <strong>Destination: </strong>{destination[0]}, {destination[1]}<br>
-                <strong>Distance: </strong>{round(distance,2)}<br>
-                <strong>Price: </strong>{round(price,2)}<br>
-                <input type="submit" value="Accept">
-            </form>"""
-        marker = folium.Marker(origin, popup=order_marker_html, tooltip='<strong>Awaiting order</strong>', icon=folium.Icon(color='green', icon='car', prefix='fa'))
-        marker.add_to(map)
-
-    # Add a marker for the driver's location
-    folium.Marker(driver_location, tooltip=f'<strong>Your location</strong><br>{driver_location[0]},{driver_location[1]}').add_to(map)
-
-    return render_template('driver_home.html', map=map._repr_html_(), sent_location=sent_location, default_location=default_location, driver_name=current_user.username, num_orders=num_orders)
+        driver_location = current_app.config['DEFAULT_LOCATION']
+
+    # Only show the nearest orders within the search radius, one page at a time
+    search_radius_km = current_app.config['ORDER_SEARCH_RADIUS_KM']
+    orders_per_page = current_app.config['ORDER_PAGE_SIZE']
+    # Find pending orders for the driver's vehicle type, nearest first
+    # One extra order is fetched to know whether there is a next page
+    pending_orders = list(active_orders.find_nearby(driver_location, vehicle_type, search_radius_km, orders_per_page + 1, skip=(page - 1) * orders_per_page))
+    has_next = len(pending_orders) > orders_per_page
+
+    orders = []
+    for order in pending_orders[:orders_per_page]:
+        orders.append({
+            'id': str(order['_id']),
+            'origin': order['origin'],
+            'destination': order['destination'],
+            'distance': round(order['distance'], 2),
+            'price': round(order['price'], 2)
+        })
+    return jsonify({'driver_location': driver_location, 'orders': orders, 'page': page, 'has_next': has_next})
 
 @drivers.route('/receive_driver_location', methods=['POST'])
+@login_required
 def receive_driver_location():
     """
     Receive and store the driver's location from a POST request.
     """
-    location = request.get_json()['location']
-    session['driver_location'] = [location['lat'], location['lng']]
+    if not current_user.is_driver:
+        return forbidden()
+    try:
+        location = request.get_json(silent=True)['location']
+        lat, lng = float(location['lat']), float(location['lng'])
+    except (KeyError, TypeError, ValueError):
+        return bad_request('A location with a lat and a lng is required')
+    session['driver_location'] = [lat, lng]
+    current_app.extensions['driver_locations'].update(current_user.id, lat, lng)
     return jsonify({'result': 'success'})
 
 @drivers.route('/accept_order', methods=['POST'])
+@login_required
 def accept_order():
     """
     Accept an order from a POST request.
+    Returns a 409 conflict if another driver accepted the order first, and a 404 if the order expired or was cancelled.
     """
+    if not current_user.is_driver:
+        return forbidden()
     str_id = request.json.get('order_id')
     obj_id = ObjectId(str_id)
-    active_orders.update_one({'_id': obj_id}, {'$set': {
-        'driver': current_user.id,
-        'driver_name': current_user.username,
-        'status': 'accepted',
-    }})
+    if not active_orders.accept(obj_id, current_user.id, current_user.username):
+        if active_orders.get(obj_id, ['status']) is None:
+            return jsonify({'result': 'not_found', 'message': 'This order no longer exists'}), 404
+        return jsonify({'result': 'conflict', 'message': 'This order has already been accepted by another driver'}), 409
+    current_app.extensions['driver_locations'].set_available(current_user.id, False)
     return jsonify({'result': 'success'})
 
 @drivers.route('/driver_ongoing_ride/<order_id>')
@@ -108,7 +114,7 @@ def driver_ongoing_ride(order_id):
     Render the page for an ongoing ride.
     """
     obj_id = ObjectId(order_id)
-    order = active_orders.find_one({'_id': obj_id})
+    order = active_orders.get(obj_id, ['client_name', 'origin', 'destination', 'distance'])
     client_name = order['client_name']
     origin = order['origin']
     destination = order['destination']
@@ -116,28 +122,47 @@ def driver_ongoing_ride(order_id):
     return render_template('driver_ongoing_ride.html', client_name=client_name, origin=origin, destination=destination, distance=distance, driver_name = current_user.username, order_id=order_id)
 
 @drivers.route('/end_ride', methods=['POST'])
+@login_required
 def end_ride():
     """
-    End a ride from a POST request.
+    End a ride of the driver from a POST request and add it to the driver's earnings.
+    Returns a 409 conflict if the driver has no such ride in progress, for example when it has already been ended.
     """
+    if not current_user.is_driver:
+        return forbidden()
     str_id = request.get_json()['order_id']
     completion_time = request.get_json()['time']
     obj_id = ObjectId(str_id)
-    active_orders.update_one({'_id': obj_id}, {'$set': {
-        'status': 'completed',
-        'completed_at': completion_time
-    }})
-    print(f'Order {str_id} completed')
+    order = active_orders.complete(obj_id, current_user.id, {
+        'completed_at': completion_time,
+        'ended_at': datetime.now()
+    })
+    if order is None:
+        return jsonify({'result': 'conflict', 'message': 'This ride is not in progress'}), 409
+    try:
+        driver_earnings.record(order)
+    except PyMongoError as e:
+        # The earnings backfill rebuilds the missing ride from the order
+        logger.warning(f"Could not add order {str_id} to the earnings: {str(e)}")
+    current_app.extensions['driver_locations'].set_available(current_user.id, True)
+    logger.info(f'Order {str_id} completed')
     return jsonify({'result': 'success'})
 
 @drivers.route('/ride_summary/<str_order_id>')
 @login_required
 def ride_summary(str_order_id):
     """
-    Render the summary of a completed ride.
+    Render the summary of a completed ride, which may already have been archived.
+    The summary of a completed ride never changes, so it is rendered once and then served from the page cache.
     """
+    page_cache = current_app.extensions['page_cache']
+    key = ('ride_summary', str_order_id, True, current_user.id)
+    page = page_cache.get(key)
+    if page is not None:
+        return page_response(page)
+
     obj_id = ObjectId(str_order_id)
-    order = active_orders.find_one({'_id': obj_id})
+    order = active_orders.get_any(obj_id, ['client_name', 'vehicle_type', 'origin', 'destination', 'distance', 'departure_time', 'completed_at', 'price', 'status', 'ended_at'])
     client_name = order['client_name']
     vehicle = order['vehicle_type']
     origin = order['origin']
@@ -146,4 +171,28 @@ def ride_summary(str_order_id):
     departure_time = order['departure_time']
     completed_at = order['completed_at']
     price = round(order['price'], 2)
-    return render_template('ride_summary.html', client_name=client_name, origin=origin, destination=destination, distance=distance, price=price, driver_name=current_user.username, vehicle=vehicle, departure_time=departure_time, completed_at=completed_at)
\ No newline at end of file
+    body = render_template('ride_summary.html', client_name=client_name, origin=origin, destination=destination, distance=distance, price=price, driver_name=current_user.username, vehicle=vehicle, departure_time=departure_time, completed_at=completed_at)
+    if order['status'] != 'completed':
+        return body
+    return page_response(page_cache.set(key, body, last_modified=order.get('ended_at')))
+
+@drivers.route('/earnings')
+@login_required
+def earnings():
+    """
+    Render the earnings, ride counts and distances of the driver over the last days, read from the earnings rollups.
+    """
+    if not current_user.is_driver:
+        # A client whose id is also a driver's would see that driver's earnings
+        abort(403)
+    days = min(max(request.args.get('days', current_app.config['EARNINGS_DAYS'], type=int), 1), 366)
+    today = datetime.now()
+    rows = driver_earnings.driver_rows(current_user.id, ride_day(today - timedelta(days=days - 1)), ride_day(today + timedelta(days=1)))
+    by_day = {}
+    by_vehicle_type = {}
+    for row in rows:
+        by_day.setdefault(row['day'], []).append(row)
+        by_vehicle_type.setdefault(row['vehicle_type'], []).append(row)
+    return render_template('earnings.html', driver_name=current_user.username, days=days, total=totals(rows),
+                           by_day=[(day, totals(day_rows)) for day, day_rows in by_day.items()],
+                           by_vehicle_type=sorted((vehicle_type, totals(type_rows)) for vehicle_type, type_rows in by_vehicle_type.items()))
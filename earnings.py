@@ -0,0 +1,146 @@
+import logging
+from datetime import datetime
+
+from pymongo import ASCENDING, DESCENDING
+
+from mongo import get_database
+
+logger = logging.getLogger(__name__)
+
+DAY_FORMAT = '%Y-%m-%d'
+GROUPS = ('driver', 'day', 'vehicle_type')
+
+def ride_day(ended_at):
+    """
+    :param ended_at: datetime at which the ride ended
+    :return: day of the ride as a YYYY-MM-DD string
+    """
+    return ended_at.strftime(DAY_FORMAT)
+
+def totals(rows):
+    """
+    Add up rollup rows.
+    :return: dict with the number of rides, the distance and the earnings
+    """
+    result = {'rides': 0, 'distance': 0.0, 'earnings': 0.0}
+    for row in rows:
+        for field in result:
+            result[field] += row[field]
+    return result
+
+class EarningsRollup(object):
+    """
+    Totals of the completed rides per driver, day and vehicle type, in the driver_earnings collection.
+    end_ride adds every completed ride to its row, so reports read a few precomputed rows instead of scanning the orders.
+    """
+    def __init__(self, collection_name='driver_earnings'):
+        self.collection_name = collection_name
+        self._collection = None
+
+    @property
+    def collection(self):
+        """
+        The underlying collection, looked up on first use.
+        """
+        if self._collection is None:
+            self._collection = get_database()[self.collection_name]
+        return self._collection
+
+    def create_indexes(self):
+        """
+        Create the indexes used to update a row and to read the reports of a driver or of a range of days.
+        """
+        self.collection.create_index([('driver', ASCENDING), ('day', ASCENDING), ('vehicle_type', ASCENDING)], unique=True, name='driver_day_vehicle_type')
+        self.collection.create_index([('day', ASCENDING)], name='day')
+
+    def record(self, order):
+        """
+        Add a completed ride to its row, creating the row if needed.
+        :param order: the completed order, with its driver, driver_name, vehicle_type, distance, price and ended_at fields
+        """
+        self.collection.update_one(
+            {'driver': order['driver'], 'day': ride_day(order['ended_at']), 'vehicle_type': order['vehicle_type']},
+            {'$inc': {'rides': 1, 'distance': order['distance'], 'earnings': order['price']}, '$set': {'driver_name': order['driver_name']}},
+            upsert=True)
+
+    def driver_rows(self, driver_id, start_day, end_day):
+        """
+        Get the rows of a driver, most recent day first.
+        :param start_day: first day included, as a YYYY-MM-DD string
+        :param end_day: day after the last day included, as a YYYY-MM-DD string
+        :return: list of rows with the day, vehicle_type, rides, distance and earnings fields
+        """
+        return list(self.collection.find(
+            {'driver': driver_id, 'day': {'$gte': start_day, '$lt': end_day}},
+            {'_id': 0, 'day': 1, 'vehicle_type': 1, 'rides': 1, 'distance': 1, 'earnings': 1}).sort('day', DESCENDING))
+
+    def report(self, start_day, end_day, group_by='day'):
+        """
+        Add up the rows of every driver for a range of days.
+        :param group_by: 'driver', 'day' or 'vehicle_type'
+        :return: list of dicts with the group, rides, distance and earnings fields, sorted by group
+        """
+        if group_by not in GROUPS:
+            raise ValueError(f"Cannot group earnings by '{group_by}'")
+        group = {'_id': f'${group_by}', 'rides': {'$sum': '$rides'}, 'distance': {'$sum': '$distance'}, 'earnings': {'$sum': '$earnings'}}
+        if group_by == 'driver':
+            group['driver_name'] = {'$last': '$driver_name'}
+        rows = self.collection.aggregate([
+            {'$match': {'day': {'$gte': start_day, '$lt': end_day}}},
+            {'$group': group},
+            {'$sort': {'_id': ASCENDING}},
+        ])
+        return [dict(row, **{group_by: row.pop('_id')}) for row in rows]
+
+    def backfill(self, repository, until=None, batch_size=1000):
+        """
+        Rebuild the rows of the days before until from the completed orders, active and archived,
+        with one aggregation pipeline per collection. Rows of later days are left to end_ride.
+        :param repository: the OrderRepository
+        :param until: first day not rebuilt, as a datetime, defaults to the current day so that no ride can end on a rebuilt day while it runs
+        :return: number of rows written
+        """
+        # Whole days only, so that every rebuilt row covers all the rides of its day
+        until = (until or datetime.now()).replace(hour=0, minute=0, second=0, microsecond=0)
+        pipeline = [
+            {'$match': {'status': 'completed', 'ended_at': {'$lt': until}}},
+            {'$group': {
+                '_id': {'driver': '$driver', 'day': {'$dateToString': {'format': DAY_FORMAT, 'date': '$ended_at'}}, 'vehicle_type': '$vehicle_type'},
+                'driver_name': {'$last': '$driver_name'},
+                'rides': {'$sum': 1},
+                'distance': {'$sum': '$distance'},
+                'earnings': {'$sum': '$price'},
+            }},
+        ]
+        rows = {}
+        for collection in (repository.collection, repository.history):
+            for group in collection.aggregate(pipeline, allowDiskUse=True):
+                key = (group['_id']['driver'], group['_id']['day'], group['_id']['vehicle_type'])
+                row = rows.setdefault(key, {'driver_name': group['driver_name'], 'rides': 0, 'distance': 0.0, 'earnings': 0.0})
+                row['rides'] += group['rides']
+                row['distance'] += group['distance']
+                row['earnings'] += group['earnings']
+
+        # No ride can end on the rebuilt days any more, so their rows are replaced as a whole.
+        # Reports covering these days are incomplete while the rows are being inserted.
+        documents = [dict(row, driver=driver, day=day, vehicle_type=vehicle_type) for (driver, day, vehicle_type), row in rows.items()]
+        self.collection.delete_many({'day': {'$lt': ride_day(until)}})
+        for start in range(0, len(documents), batch_size):
+            self.collection.insert_many(documents[start:start + batch_size], ordered=False)
+        logger.info(f"Rebuilt {len(documents)} earnings rows for the rides ended before {until}")
+        return len(documents)
+
+driver_earnings = EarningsRollup()
+
+if __name__ == '__main__':
+    import argparse
+
+    from orders import active_orders
+
+    parser = argparse.ArgumentParser(description='Rebuild the driver earnings rollups from the completed orders.')
+    parser.add_argument('--until', type=lambda day: datetime.strptime(day, DAY_FORMAT), help='rebuild the days before this YYYY-MM-DD day, defaults to today')
+    args = parser.parse_args()
+
+    driver_earnings.create_indexes()
+    rows = driver_earnings.backfill(active_orders, args.until)
+    print(f'Wrote {rows} earnings rows')
@@ -0,0 +1,165 @@
+import csv
+import io
+import json
+import zlib
+
+from pymongo import ASCENDING
+
+# Columns of the exported rides, in the order of the CSV header
+COLUMNS = ['id', 'client_name', 'driver', 'driver_name', 'vehicle_type', 'origin_lat', 'origin_lng', 'destination_lat', 'destination_lng',
+           'distance', 'price', 'departure_time', 'completed_at', 'ended_at']
+PROJECTION = ['client_name', 'driver', 'driver_name', 'vehicle_type', 'origin', 'destination', 'distance', 'price', 'departure_time', 'completed_at', 'ended_at']
+FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+def export_query(start=None, end=None, driver=None, vehicle_type=None):
+    """
+    Build the filter selecting the completed rides to export.
+    :param start: optional datetime, rides ended before it are excluded
+    :param end: optional datetime, rides ended at or after it are excluded
+    :param driver: optional id of the driver
+    :param vehicle_type: optional type of the vehicle
+    :return: MongoDB filter
+    """
+    query = {'status': 'completed'}
+    if start is not None or end is not None:
+        query['ended_at'] = {}
+        if start is not None:
+            query['ended_at']['$gte'] = start
+        if end is not None:
+            query['ended_at']['$lt'] = end
+    if driver is not None:
+        query['driver'] = driver
+    if vehicle_type:
+        query['vehicle_type'] = vehicle_type
+    return query
+
+def iter_orders(repository, query, batch_size=1000):
+    """
+    Iterate over the matching orders of the active orders and then of the history, oldest first in each.
+    The cursors fetch batch_size orders at a time, so only one batch is held in memory.
+    An order archived during the export is copied to the history before it leaves the active orders, so reading the active orders first
+    never misses it. It may be read from both collections, the ids of the active orders are kept to skip it in the history.
+    """
+    # The archiver keeps the active orders to the last hour or so of rides, so these ids stay few
+    exported = set()
+    for order in repository.collection.find(query, PROJECTION, batch_size=batch_size).sort('ended_at', ASCENDING):
+        exported.add(order['_id'])
+        yield order
+    for order in repository.history.find(query, PROJECTION, batch_size=batch_size).sort('ended_at', ASCENDING):
+        if order['_id'] not in exported:
+            yield order
+
+def export_row(order):
+    """
+    Flatten an order into a dict with the COLUMNS keys.
+    """
+    origin = order.get('origin') or ['', '']
+    destination = order.get('destination') or ['', '']
+    ended_at = order.get('ended_at')
+    return {
+        'id': str(order['_id']),
+        'client_name': order.get('client_name', ''),
+        'driver': order.get('driver', ''),
+        'driver_name': order.get('driver_name', ''),
+        'vehicle_type': order.get('vehicle_type', ''),
+        'origin_lat': origin[0],
+        'origin_lng': origin[1],
+        'destination_lat': destination[0],
+        'destination_lng': destination[1],
+        'distance': order.get('distance', ''),
+        'price': order.get('price', ''),
+        'departure_time': order.get('departure_time', ''),
+        'completed_at': order.get('completed_at', ''),
+        'ended_at': ended_at.isoformat() if ended_at else '',
+    }
+
+def ndjson_lines(orders):
+    """
+    Format orders as newline delimited JSON, one line per order.
+    """
+    for order in orders:
+        yield json.dumps(export_row(order)) + '\n'
+
+def csv_lines(orders):
+    """
+    Format orders as CSV lines, starting with the header.
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, COLUMNS)
+    writer.writeheader()
+    for order in orders:
+        writer.writerow(export_row(order))
+        # Hand over what has been written so far, so that the buffer never holds more than a line
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+def chunked(lines, chunk_size=65536):
+    """
+    Group lines into encoded chunks of about chunk_size bytes, so that the response is not written one line at a time.
+    """
+    chunk = []
+    size = 0
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield ''.join(chunk).encode()
+            chunk = []
+            size = 0
+    if chunk:
+        yield ''.join(chunk).encode()
+
+def gzipped(chunks, level=6):
+    """
+    Compress a stream of chunks into a gzip file, without holding more than one chunk.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def stream(orders, file_format='ndjson', compress=False, chunk_size=65536):
+    """
+    Format orders as NDJSON or CSV, optionally gzip compressed.
+    :param orders: iterable of orders, consumed lazily
+    :return: generator of bytes chunks
+    """
+    if file_format not in FORMATS:
+        raise ValueError(f"Unknown export format '{file_format}'")
+    lines = ndjson_lines(orders) if file_format == 'ndjson' else csv_lines(orders)
+    chunks = chunked(lines, chunk_size)
+    return gzipped(chunks) if compress else chunks
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    from datetime import datetime
+
+    from config import Config
+    from earnings import DAY_FORMAT
+    from orders import active_orders
+
+    day = lambda value: datetime.strptime(value, DAY_FORMAT)
+    parser = argparse.ArgumentParser(description='Export the completed rides, active and archived, as NDJSON or CSV.')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='ndjson')
+    parser.add_argument('--from', dest='start', type=day, help='first day exported, as YYYY-MM-DD')
+    parser.add_argument('--to', dest='end', type=day, help='day after the last day exported, as YYYY-MM-DD')
+    parser.add_argument('--driver', type=int, help='id of the driver')
+    parser.add_argument('--vehicle-type')
+    parser.add_argument('--gzip', action='store_true', help='compress the output')
+    parser.add_argument('--batch-size', type=int, default=Config.EXPORT_BATCH_SIZE)
+    parser.add_argument('--output', help='file to write, defaults to the standard output')
+    args = parser.parse_args()
+
+    query = export_query(args.start, args.end, args.driver, args.vehicle_type)
+    output = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        for chunk in stream(iter_orders(active_orders, query, args.batch_size), args.format, args.gzip):
+            output.write(chunk)
+    finally:
+        if args.output:
+            output.close()
@@ -0,0 +1,2 @@
+# Load tests driving the real application end to end against local stand-ins.
+# Run from the repository root, for example: python -m loadtest.lifecycle --rides 200 --concurrency 8
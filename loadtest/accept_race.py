@@ -0,0 +1,88 @@
+import argparse
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from bson import ObjectId
+
+from loadtest.environment import Recorder, add_arguments, create_app, finish
+
+OUTCOMES = {200: 'accept_won', 409: 'accept_lost', 404: 'accept_gone'}
+
+
+def sign_in(flask_app, number):
+    """
+    Sign up and log in a driver.
+    :return: test client of the driver
+    """
+    name = f'racer{number:04d}'
+    client = flask_app.test_client()
+    client.post('/sign_up/driver', data=dict(username=name, password='password', confirm_password='password', email=f'{name}@ex.io',
+                                             first_name='Load', last_name='Test', phone_number='0123456789', vehicle='car', license_plate=f'R{number:04d}'))
+    client.post('/login/driver', data=dict(username=name, password='password'))
+    return client
+
+def race(drivers, order_id, recorder, executor):
+    """
+    Make every driver accept the same order at the same time.
+    :return: list of the response status codes, in the order of the drivers
+    """
+    barrier = threading.Barrier(len(drivers))
+
+    def accept(driver):
+        barrier.wait()
+        start = time.perf_counter()
+        response = driver.post('/accept_order', json={'order_id': order_id})
+        elapsed = time.perf_counter() - start
+        recorder.record('accept', elapsed)
+        if response.status_code in OUTCOMES:
+            recorder.record(OUTCOMES[response.status_code], elapsed)
+        return response.status_code
+
+    return list(executor.map(accept, drivers))
+
+def main():
+    parser = argparse.ArgumentParser(description='Stress test of drivers accepting the same waiting order at the same time.')
+    parser.add_argument('--drivers', type=int, default=16, help='drivers accepting each order simultaneously')
+    parser.add_argument('--orders', type=int, default=200)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    application, flask_app, _ = create_app(args)
+    from orders import active_orders
+
+    with ThreadPoolExecutor(max_workers=args.drivers) as executor:
+        drivers = list(executor.map(lambda number: sign_in(flask_app, number), range(args.drivers)))
+    usernames = [f'racer{number:04d}' for number in range(args.drivers)]
+
+    recorder = Recorder()
+    failures = 0
+    with flask_app.app_context(), ThreadPoolExecutor(max_workers=args.drivers) as executor:
+        for _ in range(args.orders):
+            order_id = str(active_orders.create({'status': 'waiting', 'vehicle_type': 'car', 'client_name': 'racer', 'created_at': datetime.now()}))
+            statuses = race(drivers, order_id, recorder, executor)
+            winners = [usernames[i] for i, status in enumerate(statuses) if status == 200]
+            stored = active_orders.collection.find_one({'_id': ObjectId(order_id)})
+            if len(winners) != 1 or statuses.count(409) != args.drivers - 1 or stored.get('driver_name') != winners[0]:
+                failures += 1
+                recorder.error('accept')
+                print(f"Order {order_id}: {len(winners)} winners {winners}, stored driver {stored.get('driver_name')}")
+
+        # A driver accepting an order that expired or was cancelled is told it no longer exists
+        for _ in range(args.orders // 10 or 1):
+            order_id = str(active_orders.create({'status': 'waiting', 'vehicle_type': 'car', 'client_name': 'racer', 'created_at': datetime.now()}))
+            active_orders.delete(order_id)
+            statuses = race(drivers[:2], order_id, recorder, executor)
+            if statuses != [404, 404]:
+                failures += 1
+                recorder.error('accept_gone')
+                print(f'Deleted order {order_id}: {statuses}')
+
+    print(f'{args.orders} orders accepted by {args.drivers} drivers at once, {failures} failures')
+    code = finish(args, recorder.summary(), ['accept'] + list(OUTCOMES.values()))
+    return 1 if failures else code
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+import argparse
+import sys
+
+import numpy as np
+
+from loadtest.environment import Recorder, add_arguments, create_app, finish
+
+
+def seed(count, start):
+    """
+    Import clients and drivers until each table holds count accounts, as a bulk import would.
+    """
+    from accounts import import_accounts
+    from database import pool
+
+    db = pool.acquire()
+    try:
+        import_accounts(db, ({'username': f'c{number:07d}', 'password': 'password', 'email': f'c{number:07d}@ex.io'}
+                             for number in range(start, count)), False)
+        import_accounts(db, ({'username': f'd{number:07d}', 'password': 'password', 'email': f'd{number:07d}@ex.io', 'first_name': 'Load',
+                              'last_name': 'Test', 'phone_number': '0123456789', 'vehicle': 'car', 'license_plate': f'P{number:07d}'}
+                             for number in range(start, count)), True)
+    finally:
+        pool.release(db)
+
+def main():
+    parser = argparse.ArgumentParser(description='Latency of the sign-up and login forms as the clients and drivers tables grow.')
+    parser.add_argument('--sizes', default='1000,100000,1000000', help='comma separated numbers of accounts in each table')
+    parser.add_argument('--requests', type=int, default=200, help='requests of each kind per table size')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    application, flask_app, _ = create_app(args)
+    rng = np.random.default_rng(args.seed)
+    recorder = Recorder()
+    steps = []
+    seeded = 0
+    for round_number, size in enumerate(sorted(int(size) for size in args.sizes.split(','))):
+        seed(size, seeded)
+        seeded = size
+        steps += [f'{step}_{size}' for step in ('client_sign_up', 'client_login', 'driver_sign_up', 'driver_login')]
+        for number in range(args.requests):
+            client, driver = flask_app.test_client(), flask_app.test_client()
+            # New accounts, the prefix keeps them apart from the seeded ones and from the other sizes
+            name = f'n{round_number:02d}{number:05d}'
+            with recorder.timed(f'client_sign_up_{size}'):
+                response = client.post('/sign_up/client', data=dict(username=f'c{name}', password='password', confirm_password='password',
+                                                                     email=f'c{name}@ex.io'))
+            if response.status_code != 302:
+                recorder.error(f'client_sign_up_{size}')
+            with recorder.timed(f'driver_sign_up_{size}'):
+                response = driver.post('/sign_up/driver', data=dict(username=f'd{name}', password='password', confirm_password='password',
+                                                                    email=f'd{name}@ex.io', first_name='Load', last_name='Test',
+                                                                    phone_number='0123456789', vehicle='car', license_plate=f'N{name}'))
+            if response.status_code != 302:
+                recorder.error(f'driver_sign_up_{size}')
+            # Existing accounts picked anywhere in the tables
+            existing = int(rng.integers(size))
+            with recorder.timed(f'client_login_{size}'):
+                response = flask_app.test_client().post('/login/client', data=dict(username=f'c{existing:07d}', password='password'))
+            if response.status_code != 302:
+                recorder.error(f'client_login_{size}')
+            with recorder.timed(f'driver_login_{size}'):
+                response = flask_app.test_client().post('/login/driver', data=dict(username=f'd{existing:07d}', password='password'))
+            if response.status_code != 302:
+                recorder.error(f'driver_login_{size}')
+        print(f'{size} accounts in each table')
+    return finish(args, recorder.summary(), steps)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+import argparse
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from loadtest.environment import Recorder, add_arguments, create_app, finish
+
+
+class Participant(object):
+    """
+    A logged in user connected to the ride chat of one room.
+    """
+    def __init__(self, application, flask_app, name, room_id):
+        self.name = name
+        self.room_id = room_id
+        self.sent = 0
+        http_client = flask_app.test_client()
+        http_client.post('/sign_up/client', data=dict(username=name, password='password', confirm_password='password', email=f'{name}@ex.io'))
+        http_client.post('/login/client', data=dict(username=name, password='password'))
+        self.socket = application.socketio.test_client(flask_app, namespace='/ride_chat', flask_test_client=http_client)
+        self.socket.emit('join', {'room_id': room_id}, namespace='/ride_chat')
+        self.socket.get_received('/ride_chat')
+
+    def send(self, recorder):
+        # The send time travels in the message so that the other participant can measure the delivery latency
+        message = f'{self.name}|{time.perf_counter()}'
+        with recorder.timed('send_message'):
+            self.socket.emit('send_message', {'room_id': self.room_id, 'message': message}, namespace='/ride_chat')
+        self.sent += 1
+
+    def receive(self, recorder):
+        """
+        Record the delivery latency of the messages sent by the other participant.
+        :return: number of messages received
+        """
+        received = 0
+        now = time.perf_counter()
+        for event in self.socket.get_received('/ride_chat'):
+            if event['name'] == 'chat_error':
+                recorder.error('send_message')
+                continue
+            for message in event['args'][0]['messages']:
+                sender, sent_at = message.rsplit('|', 1)
+                if sender != self.name:
+                    recorder.record('delivery', now - float(sent_at))
+                    received += 1
+        return received
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of concurrent ride chat rooms on one node, two participants per room.')
+    parser.add_argument('--rooms', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=20, help='messages sent by each participant')
+    parser.add_argument('--interval', type=float, default=0.2, help='seconds between two messages of a participant')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of threads sending messages')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    application, flask_app, _ = create_app(args)
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        participants = list(executor.map(lambda i: Participant(application, flask_app, f'chat{i:06d}', f'room{i // 2}'), range(args.rooms * 2)))
+
+    recorder = Recorder()
+    stop = threading.Event()
+    delivered = [0]
+
+    def collect():
+        while not stop.is_set():
+            for participant in participants:
+                delivered[0] += participant.receive(recorder)
+            time.sleep(0.001)
+
+    collector = threading.Thread(target=collect, daemon=True)
+    collector.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for round_number in range(args.messages):
+            round_start = time.perf_counter()
+            list(executor.map(lambda participant: participant.send(recorder), participants))
+            time.sleep(max(0.0, args.interval - (time.perf_counter() - round_start)))
+    sent = sum(participant.sent for participant in participants)
+    deadline = time.perf_counter() + 5
+    while delivered[0] < sent and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    collector.join()
+
+    print(f'{args.rooms} rooms, {len(participants)} participants, {sent} messages sent, {delivered[0]} delivered in {elapsed:.1f} s, '
+          f'{delivered[0] / elapsed:.0f} deliveries/s')
+    code = finish(args, recorder.summary(), ['send_message', 'delivery'])
+    return 1 if delivered[0] < sent else code
+
+if __name__ == '__main__':
+    sys.exit(main())
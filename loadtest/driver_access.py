@@ -0,0 +1,68 @@
+import argparse
+import sys
+from datetime import datetime
+
+from bson import ObjectId
+
+from loadtest.environment import add_arguments, create_app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that a client whose id is also a driver id cannot use the routes of that driver.')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    application, flask_app, _ = create_app(args)
+    from database import pool
+    from orders import active_orders
+
+    client, driver = flask_app.test_client(), flask_app.test_client()
+    client.post('/sign_up/client', data=dict(username='sharedid', password='password', confirm_password='password', email='sharedc@ex.io'))
+    client.post('/login/client', data=dict(username='sharedid', password='password'))
+    driver.post('/sign_up/driver', data=dict(username='sharedidd', password='password', confirm_password='password', email='sharedd@ex.io',
+                                             first_name='Load', last_name='Test', phone_number='0123456789', vehicle='car', license_plate='SHARED'))
+    driver.post('/login/driver', data=dict(username='sharedidd', password='password'))
+
+    db = pool.acquire()
+    try:
+        client_id = db.execute("SELECT id FROM clients WHERE username = 'sharedid'").fetchone()[0]
+        driver_id = db.execute("SELECT id FROM drivers WHERE username = 'sharedidd'").fetchone()[0]
+    finally:
+        pool.release(db)
+    print(f'client id {client_id}, driver id {driver_id}')
+    if client_id != driver_id:
+        print('The ids differ, the check needs an empty database')
+        return 1
+
+    failures = []
+
+    def expect(name, response, status):
+        print(f'{name}: {response.status_code}')
+        if response.status_code != status:
+            failures.append(f'{name} answered {response.status_code}, expected {status}')
+
+    # No application context around the requests: each one must get its own, or flask_login would keep the first user in g
+    order_id = str(active_orders.create({'status': 'waiting', 'vehicle_type': 'car', 'client_name': 'sharedid', 'created_at': datetime.now(),
+                                         'origin': [48.85, 2.35], 'destination': [48.86, 2.36], 'distance': 1.5, 'price': 0.75}))
+    expect('driver accept_order', driver.post('/accept_order', json={'order_id': order_id}), 200)
+    expect('client receive_driver_location', client.post('/receive_driver_location', json={'location': {'lat': 48.0, 'lng': 2.0}}), 403)
+    expect('client end_ride', client.post('/end_ride', json={'order_id': order_id, 'time': '12:00'}), 403)
+    expect('client earnings', client.get('/earnings'), 403)
+    other_order_id = str(active_orders.create({'status': 'waiting', 'vehicle_type': 'car', 'client_name': 'sharedid', 'created_at': datetime.now()}))
+    expect('client accept_order', client.post('/accept_order', json={'order_id': other_order_id}), 403)
+
+    order = active_orders.collection.find_one({'_id': ObjectId(order_id)})
+    if order['status'] != 'accepted' or order['driver'] != driver_id:
+        failures.append(f"the ride is {order['status']} with driver {order.get('driver')} after the client's requests")
+    if active_orders.collection.find_one({'_id': ObjectId(other_order_id)})['status'] != 'waiting':
+        failures.append('the client accepted an order')
+
+    expect('driver end_ride', driver.post('/end_ride', json={'order_id': order_id, 'time': '12:00'}), 200)
+    expect('driver earnings', driver.get('/earnings'), 200)
+
+    for failure in failures:
+        print(f'FAILED {failure}')
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
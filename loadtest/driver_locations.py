@@ -0,0 +1,64 @@
+import argparse
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from loadtest.environment import Recorder, finish
+from driver_locations import DriverLocationIndex
+from pricing import PRICE_PER_KM
+
+VEHICLE_TYPES = sorted(PRICE_PER_KM)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput of the driver position updates of the in-memory index, and latency of the nearby driver searches.')
+    parser.add_argument('--drivers', type=int, default=10000, help='online drivers')
+    parser.add_argument('--updates', type=int, default=1000000, help='position updates in total')
+    parser.add_argument('--threads', type=int, default=4, help='threads sending the updates, like the Socket.IO workers of one node')
+    parser.add_argument('--queries', type=int, default=2000, help='nearby searches')
+    parser.add_argument('--radius', type=float, default=5.0, help='search radius in kilometers')
+    parser.add_argument('--target', type=float, default=50000, help='fail below this number of updates per second')
+    parser.add_argument('--json', help='write the search latencies to this JSON file, to be used as a baseline later')
+    parser.add_argument('--baseline', help='fail if the searches are slower than in this JSON file by more than the tolerance')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    center = np.array([48.85, 2.35])
+    index = DriverLocationIndex()
+    for driver_id in range(args.drivers):
+        index.go_online(driver_id, f'driver{driver_id}', f'LT{driver_id:05d}', VEHICLE_TYPES[driver_id % len(VEHICLE_TYPES)])
+
+    # Positions are drawn up front so that only the index is measured: each driver moves a little from one update to the next
+    positions = rng.uniform(-0.2, 0.2, (args.drivers, 2)) + center
+    steps = args.updates // args.drivers
+    moves = positions + np.cumsum(rng.normal(0, 0.0005, (steps, args.drivers, 2)), axis=0)
+    updates = [(driver_id, float(lat), float(lng)) for step in moves.tolist() for driver_id, (lat, lng) in enumerate(step)]
+
+    def send(chunk):
+        for driver_id, lat, lng in chunk:
+            index.update(driver_id, lat, lng)
+
+    chunks = [updates[i::args.threads] for i in range(args.threads)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        list(executor.map(send, chunks))
+    seconds = time.perf_counter() - start
+    per_second = len(updates) / seconds
+
+    recorder = Recorder()
+    for lat, lng in (rng.uniform(-0.2, 0.2, (args.queries, 2)) + center).tolist():
+        vehicle_type = VEHICLE_TYPES[int(rng.integers(len(VEHICLE_TYPES)))]
+        with recorder.timed('nearby'):
+            index.nearby(lat, lng, args.radius, vehicle_type=vehicle_type)
+
+    print(f"{len(updates)} updates of {args.drivers} drivers from {args.threads} threads in {seconds:.3f} s: {per_second:.0f} updates/s, target {args.target:.0f}")
+    print(index.stats())
+    code = finish(args, recorder.summary(), ['nearby'])
+    return 1 if per_second < args.target else code
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+import argparse
+import math
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from loadtest.environment import Recorder, add_arguments, create_app, finish
+
+STEPS = ['backfill', 'driver_dashboard', 'driver_dashboard_scan', 'operator_report', 'operator_report_scan']
+VEHICLE_TYPES = ['car', 'van', 'horse']
+
+
+def seed(collection, rides, drivers, days, batch_size, rng):
+    """
+    Insert completed rides spread over the last days, each driver always using the same vehicle type.
+    """
+    start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days)
+    for offset in range(0, rides, batch_size):
+        size = min(batch_size, rides - offset)
+        driver_ids = rng.integers(1, drivers + 1, size)
+        distances = rng.gamma(2.0, 3.0, size)
+        seconds = rng.integers(0, days * 86400, size)
+        collection.insert_many([{
+            'status': 'completed',
+            'driver': int(driver_id),
+            'driver_name': f'driver{driver_id}',
+            'vehicle_type': VEHICLE_TYPES[driver_id % len(VEHICLE_TYPES)],
+            'distance': float(distance),
+            'price': float(distance) * 0.5,
+            'ended_at': start + timedelta(seconds=int(second)),
+        } for driver_id, distance, second in zip(driver_ids, distances, seconds)], ordered=False)
+
+def scan_driver(collection, driver_id, start, end):
+    """
+    The same data as the driver dashboard, computed from the rides rather than the rollups.
+    """
+    return list(collection.aggregate([
+        {'$match': {'status': 'completed', 'driver': driver_id, 'ended_at': {'$gte': start, '$lt': end}}},
+        {'$group': {'_id': {'day': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$ended_at'}}, 'vehicle_type': '$vehicle_type'},
+                    'rides': {'$sum': 1}, 'distance': {'$sum': '$distance'}, 'earnings': {'$sum': '$price'}}},
+    ]))
+
+def scan_report(collection, start, end):
+    """
+    The same data as the operator report by day, computed from the rides rather than the rollups.
+    """
+    return list(collection.aggregate([
+        {'$match': {'status': 'completed', 'ended_at': {'$gte': start, '$lt': end}}},
+        {'$group': {'_id': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$ended_at'}},
+                    'rides': {'$sum': 1}, 'distance': {'$sum': '$distance'}, 'earnings': {'$sum': '$price'}}},
+    ], allowDiskUse=True))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the driver earnings rollups against scanning the historical rides.')
+    parser.add_argument('--rides', type=int, default=10000000, help='historical rides to seed, use --mongo-uri for the default 10 million')
+    parser.add_argument('--drivers', type=int, default=2000)
+    parser.add_argument('--days', type=int, default=365, help='the rides are spread over this many days')
+    parser.add_argument('--queries', type=int, default=20, help='dashboard and report queries of each kind')
+    parser.add_argument('--batch-size', type=int, default=10000)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    application, flask_app, _ = create_app(args)
+    from earnings import driver_earnings, ride_day, totals
+    from orders import active_orders
+
+    rng = np.random.default_rng(args.seed)
+    recorder = Recorder()
+    with flask_app.app_context():
+        history = active_orders.history
+        history.delete_many({})
+        active_orders.collection.delete_many({})
+        start = time.perf_counter()
+        seed(history, args.rides, args.drivers, args.days, args.batch_size, rng)
+        print(f'Seeded {args.rides} rides for {args.drivers} drivers over {args.days} days in {time.perf_counter() - start:.1f} s')
+        # The scans get the index a deployment would add to make them usable at all
+        history.create_index([('status', 1), ('driver', 1), ('ended_at', 1)], name='status_driver_ended_at')
+
+        with recorder.timed('backfill'):
+            rows = driver_earnings.backfill(active_orders)
+        print(f'Backfill wrote {rows} rows, {args.rides / max(rows, 1):.1f} rides per row')
+
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        month_start, month_end = today - timedelta(days=30), today
+        for driver_id in rng.integers(1, args.drivers + 1, args.queries):
+            driver_id = int(driver_id)
+            with recorder.timed('driver_dashboard'):
+                rollup = totals(driver_earnings.driver_rows(driver_id, ride_day(month_start), ride_day(month_end)))
+            with recorder.timed('driver_dashboard_scan'):
+                scanned = totals(scan_driver(history, driver_id, month_start, month_end))
+            if rollup['rides'] != scanned['rides'] or not math.isclose(rollup['earnings'], scanned['earnings'], rel_tol=1e-9, abs_tol=1e-6):
+                recorder.error('driver_dashboard')
+        for _ in range(args.queries):
+            with recorder.timed('operator_report'):
+                rollup = totals(driver_earnings.report(ride_day(month_start), ride_day(month_end), 'day'))
+            with recorder.timed('operator_report_scan'):
+                scanned = totals(scan_report(history, month_start, month_end))
+            if rollup['rides'] != scanned['rides']:
+                recorder.error('operator_report')
+    return finish(args, recorder.summary(), STEPS)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,199 @@
+import json
+import os
+import socketserver
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+    """
+    Minimal local SMTP server that accepts and counts every message, standing in for the real mail server.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SmtpHandler)
+        self.received = 0
+        self.lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.reply('220 localhost ESMTP load test sink')
+        for line in self.rfile:
+            command = line.decode(errors='replace').strip().upper()
+            if command.startswith('EHLO') or command.startswith('HELO'):
+                self.reply('250 localhost')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                for data in self.rfile:
+                    if data in (b'.\r\n', b'.\n'):
+                        break
+                with self.server.lock:
+                    self.server.received += 1
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+class Recorder(object):
+    """
+    Thread-safe collection of the latencies of each step of a load test.
+    """
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def timed(self, step):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.error(step)
+            raise
+        self.record(step, time.perf_counter() - start)
+
+    def error(self, step):
+        with self.lock:
+            self.errors[step] = self.errors.get(step, 0) + 1
+
+    def record(self, step, seconds):
+        with self.lock:
+            self.latencies.setdefault(step, []).append(seconds)
+
+    def summary(self):
+        """
+        :return: dict of step to count, errors, throughput per second and latency percentiles in milliseconds
+        """
+        elapsed = time.perf_counter() - self.started
+        summary = {}
+        with self.lock:
+            steps = dict((step, list(values)) for step, values in self.latencies.items())
+            errors = dict(self.errors)
+        for step, values in steps.items():
+            values = np.array(values) * 1000
+            summary[step] = {
+                'count': len(values),
+                'errors': errors.get(step, 0),
+                'per_second': round(len(values) / elapsed, 1),
+                'p50_ms': round(float(np.percentile(values, 50)), 3),
+                'p95_ms': round(float(np.percentile(values, 95)), 3),
+                'p99_ms': round(float(np.percentile(values, 99)), 3),
+                'max_ms': round(float(values.max()), 3),
+            }
+        for step, count in errors.items():
+            summary.setdefault(step, {'count': 0, 'errors': count, 'per_second': 0, 'p50_ms': 0, 'p95_ms': 0, 'p99_ms': 0, 'max_ms': 0})
+        return summary
+
+def print_summary(summary, order=None):
+    steps = [step for step in (order or []) if step in summary] + sorted(step for step in summary if step not in (order or []))
+    print(f"{'step':<30}{'count':>8}{'errors':>8}{'per s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for step in steps:
+        s = summary[step]
+        print(f"{step:<30}{s['count']:>8}{s['errors']:>8}{s['per_second']:>10}{s['p50_ms']:>10}{s['p95_ms']:>10}{s['p99_ms']:>10}{s['max_ms']:>10}")
+
+def compare(summary, baseline_path, tolerance):
+    """
+    Compare the p95 latencies with a baseline saved by an earlier run.
+    :return: list of regression messages, empty if every step is within the tolerance
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    regressions = []
+    for step, before in baseline.items():
+        after = summary.get(step)
+        if after is None:
+            regressions.append(f'{step}: missing from this run')
+        elif after['errors'] > before['errors']:
+            regressions.append(f"{step}: {after['errors']} errors, baseline had {before['errors']}")
+        elif after['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{step}: p95 {after['p95_ms']} ms, baseline {before['p95_ms']} ms")
+    return regressions
+
+def add_arguments(parser):
+    parser.add_argument('--mongo-uri', help='use this MongoDB server instead of the in-memory mongomock stand-in')
+    parser.add_argument('--json', help='write the results to this JSON file, to be used as a baseline later')
+    parser.add_argument('--baseline', help='fail if a step is slower than in this JSON file by more than the tolerance')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed p95 regression against the baseline, 0.25 for 25%%')
+    parser.add_argument('--seed', type=int, default=0)
+
+def create_app(args, settings=None):
+    """
+    Create the real application against local stand-ins: a temporary SQLite directory, mongomock or a local mongod,
+    and a local SMTP sink. Must be called before anything imports the application modules.
+    :return: tuple of (app module, Flask application, SMTP sink)
+    """
+    directory = tempfile.mkdtemp(prefix='uber_loadtest_')
+    sink = SmtpSink().start()
+    environment = {
+        'APP_ENV': 'production',
+        'SECRET_KEY': 'load-test',
+        'SQLITE_PATH': os.path.join(directory, 'uber_application.db'),
+        'SESSION_SQLITE_PATH': os.path.join(directory, 'sessions.db'),
+        'MAIL_SERVER': '127.0.0.1',
+        'MAIL_PORT': str(sink.port),
+        'MAIL_USE_TLS': 'False',
+        'MAIL_USE_SSL': 'False',
+        'MAIL_USERNAME': '',
+        'MAIL_PASSWORD': '',
+        'MONGO_DB_NAME': 'uber_loadtest',
+        # The Socket.IO test client does not work with a message queue
+        'SOCKETIO_MESSAGE_QUEUE': '',
+    }
+    environment.update(settings or {})
+    if args.mongo_uri:
+        environment['MONGO_URI'] = args.mongo_uri
+    else:
+        import mongomock
+        import pymongo
+        from pymongo.errors import OperationFailure
+
+        def watch(collection, *args, **kwargs):
+            # Like a standalone mongod, so that the order status watcher falls back to polling
+            raise OperationFailure('The $changeStream stage is only supported on replica sets', code=40573)
+
+        mongomock.Collection.watch = watch
+        pymongo.MongoClient = mongomock.MongoClient
+    os.environ.update(environment)
+
+    import app as application
+    flask_app = application.create_app('production')
+    flask_app.config['WTF_CSRF_ENABLED'] = False
+    application.start_services(flask_app)
+    return application, flask_app, sink
+
+def finish(args, summary, order=None):
+    """
+    Print the results, save them and compare them with the baseline.
+    :return: process exit code
+    """
+    print_summary(summary, order)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2)
+    if args.baseline:
+        regressions = compare(summary, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        return 1 if regressions else 0
+    return 0
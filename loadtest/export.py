@@ -0,0 +1,102 @@
+import argparse
+import resource
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from bson import ObjectId
+
+from loadtest.environment import add_arguments, create_app
+
+VEHICLE_TYPES = ['car', 'van', 'horse']
+
+
+def generate_orders(rides, drivers, seed, batch_size=10000):
+    """
+    Generate completed orders lazily, batch by batch, as they are stored by the application.
+    """
+    rng = np.random.default_rng(seed)
+    start = datetime.now() - timedelta(days=365)
+    for offset in range(0, rides, batch_size):
+        size = min(batch_size, rides - offset)
+        driver_ids = rng.integers(1, drivers + 1, size)
+        client_ids = rng.integers(0, 100000, size)
+        points = rng.uniform(-0.05, 0.05, (size, 4)) + [48.85, 2.35, 48.85, 2.35]
+        distances = rng.gamma(2.0, 3.0, size)
+        seconds = np.sort(rng.integers(0, 86400, size)) + offset * 365 * 86400 // rides
+        for driver_id, client_id, point, distance, second in zip(driver_ids, client_ids, points, distances, seconds):
+            yield {
+                '_id': ObjectId(),
+                'status': 'completed',
+                'client_name': f'client{client_id}',
+                'driver': int(driver_id),
+                'driver_name': f'driver{driver_id}',
+                'vehicle_type': VEHICLE_TYPES[driver_id % len(VEHICLE_TYPES)],
+                'origin': [float(point[0]), float(point[1])],
+                'destination': [float(point[2]), float(point[3])],
+                'distance': float(distance),
+                'price': float(distance) * 0.5,
+                'departure_time': '10:00',
+                'completed_at': '10:30',
+                'ended_at': start + timedelta(seconds=int(second)),
+            }
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def measure(name, chunks, rides):
+    """
+    Consume an export, printing its throughput and how much it raised the peak memory of the process.
+    """
+    rss = peak_rss_mb()
+    start = time.perf_counter()
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+    elapsed = time.perf_counter() - start
+    print(f'{name:<12}{rides:>12}{elapsed:>10.1f}{rides / elapsed:>14.0f}{size / elapsed / 1e6:>10.1f}{size / 1e6:>12.1f}{peak_rss_mb() - rss:>16.1f}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput and memory of the ride history export.')
+    parser.add_argument('--rides', type=int, default=2000000)
+    parser.add_argument('--drivers', type=int, default=2000)
+    parser.add_argument('--formats', default='ndjson,csv,csv.gz')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    print(f"{'format':<12}{'rides':>12}{'seconds':>10}{'rides/s':>14}{'MB/s':>10}{'MB':>12}{'peak RSS +MB':>16}")
+    if args.mongo_uri:
+        # Stream from MongoDB through the export endpoint
+        application, flask_app, _ = create_app(args, {'REPORTS_TOKEN': 'load-test'})
+        from orders import active_orders
+        with flask_app.app_context():
+            active_orders.history.delete_many({})
+            batch = []
+            for order in generate_orders(args.rides, args.drivers, args.seed):
+                batch.append(order)
+                if len(batch) == 10000:
+                    active_orders.history.insert_many(batch, ordered=False)
+                    batch = []
+            if batch:
+                active_orders.history.insert_many(batch, ordered=False)
+        client = flask_app.test_client()
+        for name in args.formats.split(','):
+            file_format, _, compressed = name.partition('.')
+            response = client.get(f"/reports/rides?format={file_format}&gzip={1 if compressed else 0}",
+                                  headers={'Authorization': 'Bearer load-test'}, buffered=False)
+            measure(name, response.response, args.rides)
+    else:
+        # mongomock materializes every cursor, so the rides are generated on the fly and fed to the same export pipeline
+        from export import stream
+        print('mongomock loads whole result sets in memory, streaming generated rides instead, use --mongo-uri to read from MongoDB')
+        # Generating the rides alone, to be subtracted from the export times
+        measure('generate', (b'' for _ in generate_orders(args.rides, args.drivers, args.seed)), args.rides)
+        for name in args.formats.split(','):
+            file_format, _, compressed = name.partition('.')
+            measure(name, stream(generate_orders(args.rides, args.drivers, args.seed), file_format, bool(compressed)), args.rides)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
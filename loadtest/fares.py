@@ -0,0 +1,42 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from pricing import PRICE_PER_KM, batch_quote
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput of the batch fare engine against the scalar fare functions, and check that they agree.')
+    parser.add_argument('--pairs', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    from clients.views import calculate_distance, calculate_price
+
+    rng = np.random.default_rng(args.seed)
+    origins = rng.uniform([48.7, 2.2], [49.0, 2.5], (args.pairs, 2))
+    destinations = rng.uniform([48.7, 2.2], [49.0, 2.5], (args.pairs, 2))
+    vehicle_types = rng.choice(sorted(PRICE_PER_KM), args.pairs)
+
+    start = time.perf_counter()
+    distances, prices = batch_quote(origins, destinations, vehicle_types)
+    batch_seconds = time.perf_counter() - start
+
+    # Plain Python lists, as the request handlers get them
+    origin_list, destination_list, type_list = origins.tolist(), destinations.tolist(), vehicle_types.tolist()
+    start = time.perf_counter()
+    scalar_distances = [calculate_distance(origin, destination) for origin, destination in zip(origin_list, destination_list)]
+    scalar_prices = [calculate_price(distance, vehicle_type) for distance, vehicle_type in zip(scalar_distances, type_list)]
+    scalar_seconds = time.perf_counter() - start
+
+    match = np.allclose(distances, scalar_distances, rtol=1e-9, atol=1e-9) and np.allclose(prices, scalar_prices, rtol=1e-9, atol=1e-9)
+    print(f"{'engine':<10}{'pairs':>10}{'seconds':>10}{'pairs/s':>14}")
+    print(f"{'batch':<10}{args.pairs:>10}{batch_seconds:>10.3f}{args.pairs / batch_seconds:>14.0f}")
+    print(f"{'scalar':<10}{args.pairs:>10}{scalar_seconds:>10.3f}{args.pairs / scalar_seconds:>14.0f}")
+    print(f"Results match the scalar functions: {match}, max distance difference {np.abs(distances - scalar_distances).max():.3g} km")
+    return 0 if match else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,161 @@
+import argparse
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from loadtest.environment import Recorder, add_arguments, create_app, finish
+
+CLIENT_STEPS = ['client_sign_up', 'client_login', 'receive_location', 'quote', 'book', 'waiting_page', 'status_check']
+DRIVER_STEPS = ['driver_sign_up', 'driver_login', 'driver_home', 'driver_map_data', 'driver_location', 'accept_order',
+                'order_accepted_notification', 'chat_join', 'chat_message', 'end_ride', 'ride_summary', 'ride_invoice']
+
+
+class RideSimulation(object):
+    """
+    One client and one driver going through a whole ride, recording the latency of every step.
+    """
+    def __init__(self, application, flask_app, recorder, number, rng, timeout, geo_queries=True):
+        self.application = application
+        self.geo_queries = geo_queries
+        self.flask_app = flask_app
+        self.recorder = recorder
+        self.number = number
+        self.rng = rng
+        self.timeout = timeout
+        self.sockets = []
+
+    def check(self, response, *statuses):
+        if response.status_code not in statuses:
+            raise AssertionError(f'{response.request.path} returned {response.status_code}')
+        return response
+
+    def socket(self, namespace, http_client):
+        socket = self.application.socketio.test_client(self.flask_app, namespace=namespace, flask_test_client=http_client)
+        self.sockets.append(socket)
+        if not socket.is_connected(namespace):
+            raise AssertionError(f'could not connect to {namespace}')
+        return socket
+
+    def wait_for(self, socket, namespace, event, predicate=lambda args: True):
+        """
+        Wait until the socket receives an event, checking every millisecond.
+        """
+        deadline = time.perf_counter() + self.timeout
+        while time.perf_counter() < deadline:
+            for message in socket.get_received(namespace):
+                if message['name'] == event and predicate(message['args'][0]):
+                    return message['args'][0]
+            time.sleep(0.001)
+        raise TimeoutError(f'no {event} event after {self.timeout} seconds')
+
+    def run(self):
+        timed = self.recorder.timed
+        client = self.flask_app.test_client()
+        driver = self.flask_app.test_client()
+        name = f'{self.number:06d}'
+        origin = [48.85 + self.rng.uniform(-0.05, 0.05), 2.35 + self.rng.uniform(-0.05, 0.05)]
+        destination = [48.85 + self.rng.uniform(-0.05, 0.05), 2.35 + self.rng.uniform(-0.05, 0.05)]
+        try:
+            with timed('client_sign_up'):
+                self.check(client.post('/sign_up/client', data=dict(username=f'client{name}', password='password', confirm_password='password', email=f'c{name}@ex.io')), 302)
+            with timed('client_login'):
+                self.check(client.post('/login/client', data=dict(username=f'client{name}', password='password')), 302)
+            with timed('receive_location'):
+                self.check(client.post('/receive_location', json={'location': {'lat': origin[0], 'lng': origin[1]}}), 200)
+            with timed('quote'):
+                token = self.check(client.post('/quote', json={'destination': {'lat': str(destination[0]), 'lng': str(destination[1])}}), 200).json['token']
+            with timed('book'):
+                order_id = self.check(client.post('/book', json={'quote_token': token, 'vehicle_type': 'car', 'number_of_passengers': '1', 'departure_time': '10:00'}), 200).json['id']
+            with timed('waiting_page'):
+                self.check(client.get(f'/waiting_page/{order_id}'), 200)
+            with timed('status_check'):
+                client_socket = self.socket('/clients', client)
+                client_socket.emit('start_status_check', {'order_id': order_id}, namespace='/clients')
+
+            with timed('driver_sign_up'):
+                self.check(driver.post('/sign_up/driver', data=dict(username=f'driver{name}', password='password', confirm_password='password', email=f'd{name}@ex.io',
+                                                                    first_name='Load', last_name='Test', phone_number='0123456789', vehicle='car', license_plate=f'LT{name}')), 302)
+            with timed('driver_login'):
+                self.check(driver.post('/login/driver', data=dict(username=f'driver{name}', password='password')), 302)
+            with timed('driver_home'):
+                self.check(driver.get('/driver_home'), 200)
+            if self.geo_queries:
+                with timed('driver_map_data'):
+                    self.check(driver.get('/driver_home/map_data'), 200)
+            with timed('driver_location'):
+                driver_socket = self.socket('/drivers', driver)
+                driver_socket.emit('driver_location', {'lat': origin[0] + 0.001, 'lng': origin[1]}, namespace='/drivers')
+            with timed('accept_order'):
+                self.check(driver.post('/accept_order', json={'order_id': order_id}), 200)
+            # Time from the accept until the waiting client is told, through the order status watcher
+            with timed('order_accepted_notification'):
+                self.wait_for(client_socket, '/clients', 'order_accepted', lambda data: data['order_id'] == order_id)
+
+            with timed('chat_join'):
+                client_chat = self.socket('/ride_chat', client)
+                driver_chat = self.socket('/ride_chat', driver)
+                client_chat.emit('join', {'room_id': order_id}, namespace='/ride_chat')
+                driver_chat.emit('join', {'room_id': order_id}, namespace='/ride_chat')
+            # Time from sending a message until the other participant receives it
+            with timed('chat_message'):
+                text = f'driver{name}: on my way'
+                driver_chat.emit('send_message', {'room_id': order_id, 'message': text}, namespace='/ride_chat')
+                self.wait_for(client_chat, '/ride_chat', 'receive_messages', lambda data: text in data['messages'])
+
+            with timed('end_ride'):
+                self.check(driver.post('/end_ride', json={'order_id': order_id, 'time': '10:30'}), 200)
+            with timed('ride_summary'):
+                self.check(driver.get(f'/ride_summary/{order_id}'), 200)
+            with timed('ride_invoice'):
+                self.check(client.get(f'/ride_invoice/{order_id}'), 200)
+        finally:
+            for socket in self.sockets:
+                for namespace in ('/clients', '/drivers', '/ride_chat'):
+                    if socket.is_connected(namespace):
+                        socket.disconnect(namespace=namespace)
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the whole ride lifecycle, one simulated client and driver per ride.')
+    parser.add_argument('--rides', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8, help='number of rides in progress at the same time')
+    parser.add_argument('--timeout', type=float, default=10, help='seconds to wait for a socket.io event')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    # Poll often so that the notification latency measures the application rather than the polling interval
+    application, flask_app, sink = create_app(args, {'ORDER_POLL_INTERVAL': '0.05', 'CHAT_RATE_PER_SECOND': '1000', 'CHAT_BURST': '1000'})
+    recorder = Recorder()
+    rng_lock = threading.Lock()
+    rng = random.Random(args.seed)
+    failures = []
+
+    def ride(number):
+        with rng_lock:
+            ride_rng = random.Random(rng.random())
+        try:
+            RideSimulation(application, flask_app, recorder, number, ride_rng, args.timeout, geo_queries=bool(args.mongo_uri)).run()
+        except Exception as e:
+            failures.append(f'ride {number}: {e!r}')
+
+    if not args.mongo_uri:
+        print('mongomock does not support $near queries, driver_map_data is only measured with --mongo-uri')
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(ride, range(args.rides)))
+    elapsed = time.perf_counter() - start
+
+    # Invoices are sent in the background, give the mail dispatcher a moment to drain its queue
+    deadline = time.perf_counter() + args.timeout
+    while sink.received < args.rides - len(failures) and time.perf_counter() < deadline:
+        time.sleep(0.05)
+
+    print(f'{args.rides} rides, {args.concurrency} at a time, {elapsed:.1f} s, {(args.rides - len(failures)) / elapsed:.1f} completed rides/s, {sink.received} invoices received by the SMTP sink')
+    for failure in failures[:10]:
+        print(f'FAILED {failure}')
+    code = finish(args, recorder.summary(), CLIENT_STEPS + DRIVER_STEPS)
+    return 1 if failures else code
+
+if __name__ == '__main__':
+    sys.exit(main())
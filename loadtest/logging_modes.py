@@ -0,0 +1,104 @@
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from loadtest.environment import Recorder, add_arguments, create_app, finish
+
+
+class SlowFileHandler(logging.FileHandler):
+    """
+    File handler that waits before each write, standing in for a slow or busy disk.
+    """
+    def __init__(self, path, delay):
+        super().__init__(path)
+        self.write_delay = delay
+
+    def emit(self, record):
+        if self.write_delay:
+            time.sleep(self.write_delay)
+        super().emit(record)
+
+def use_queue(flask_app, target):
+    """
+    Log through the bounded queue and its writer thread, as the application does.
+    """
+    import logging_queue
+
+    logging_queue.init_app(flask_app)
+    # Same target as the direct mode, so that only the place where the write happens differs
+    logging_queue._listener.stop()
+    logging_queue._listener.handlers = (target,)
+    logging_queue._listener.start()
+
+def use_direct(flask_app, target):
+    """
+    Log from the request thread, straight to the file.
+    """
+    import logging_queue
+
+    logging_queue.stop()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(target)
+    root.setLevel(flask_app.config['LOG_LEVEL'])
+
+def run(clients, recorder, step, requests, executor):
+    def post(index):
+        client = clients[index % len(clients)]
+        with recorder.timed(step):
+            response = client.post('/receive_location', json={'location': {'lat': 48.85 + index * 1e-6, 'lng': 2.35}})
+        if response.status_code != 200:
+            recorder.error(step)
+
+    list(executor.map(post, range(requests)))
+
+def main():
+    parser = argparse.ArgumentParser(description='Request latency when log records go through the queue to a writer thread, and when the request thread writes them.')
+    parser.add_argument('--requests', type=int, default=5000, help='requests per logging mode')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--write-delay', type=float, default=0.0, help='seconds added to each log write, to emulate a slow disk')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    application, flask_app, _ = create_app(args)
+    # Every location post writes one DEBUG record
+    flask_app.config['LOG_LEVEL'] = 'DEBUG'
+    flask_app.config['LOG_SAMPLING'] = ''
+    directory = tempfile.mkdtemp(prefix='uber_logging_')
+    flask_app.config['LOG_FILE'] = os.path.join(directory, 'app.log')
+    target = SlowFileHandler(flask_app.config['LOG_FILE'], args.write_delay)
+    from logging_queue import JsonFormatter
+    target.setFormatter(JsonFormatter())
+
+    clients = []
+    for number in range(args.concurrency):
+        client = flask_app.test_client()
+        name = f'logger{number:03d}'
+        client.post('/sign_up/client', data=dict(username=name, password='password', confirm_password='password', email=f'{name}@ex.io'))
+        client.post('/login/client', data=dict(username=name, password='password'))
+        clients.append(client)
+
+    summary = {}
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        # Warm up the sessions and the user cache, so that the first mode is not penalised
+        run(clients, Recorder(), 'warm_up', args.concurrency * 20, executor)
+        for mode, setup in (('queued', use_queue), ('direct', use_direct)):
+            setup(flask_app, target)
+            # One recorder per mode, so that the throughput only counts the time spent in that mode
+            recorder = Recorder()
+            run(clients, recorder, f'location_{mode}', args.requests, executor)
+            summary.update(recorder.summary())
+    use_queue(flask_app, target)
+
+    with open(flask_app.config['LOG_FILE']) as f:
+        written = sum(1 for line in f if 'Client location' in line)
+    print(f'{written} location records written for {2 * args.requests} requests')
+    return finish(args, summary, ['location_queued', 'location_direct'])
+
+if __name__ == '__main__':
+    sys.exit(main())
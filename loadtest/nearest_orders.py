@@ -0,0 +1,86 @@
+import argparse
+import sys
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from loadtest.environment import Recorder, add_arguments, create_app, finish
+
+VEHICLE_TYPES = ['car', 'van', 'horse']
+
+
+def seed(repository, count, center, rng, batch_size=10000):
+    """
+    Insert waiting orders picked up around the center of the city, as booked by the clients.
+    """
+    from orders import location_point
+
+    created_at = datetime.now() - timedelta(minutes=5)
+    for offset in range(0, count, batch_size):
+        size = min(batch_size, count - offset)
+        origins = rng.uniform(-0.3, 0.3, (size, 2)) + center
+        destinations = rng.uniform(-0.3, 0.3, (size, 2)) + center
+        distances = rng.gamma(2.0, 3.0, size)
+        repository.collection.insert_many([{
+            'status': 'waiting',
+            'client_name': 'backlog',
+            'vehicle_type': VEHICLE_TYPES[i % len(VEHICLE_TYPES)],
+            'origin': [float(origin[0]), float(origin[1])],
+            'origin_point': location_point(origin),
+            'destination': [float(destination[0]), float(destination[1])],
+            'distance': float(distance),
+            'price': float(distance) * 0.5,
+            'created_at': created_at,
+        } for i, origin, destination, distance in zip(range(offset, offset + size), origins, destinations, distances)], ordered=False)
+
+def main():
+    parser = argparse.ArgumentParser(description='Latency of the nearest waiting orders shown to drivers, as the backlog of waiting orders grows.')
+    parser.add_argument('--backlogs', default='1000,10000,100000', help='comma separated numbers of waiting orders')
+    parser.add_argument('--queries', type=int, default=50, help='queries of each kind per backlog size')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    application, flask_app, _ = create_app(args)
+    from orders import active_orders
+
+    rng = np.random.default_rng(args.seed)
+    backlogs = sorted(int(backlog) for backlog in args.backlogs.split(','))
+    center = np.array([48.85, 2.35])
+    radius_km = flask_app.config['ORDER_SEARCH_RADIUS_KM']
+    page_size = flask_app.config['ORDER_PAGE_SIZE']
+    if not args.mongo_uri:
+        print('mongomock does not support $near queries, the nearest orders are only measured with --mongo-uri')
+
+    driver = flask_app.test_client()
+    driver.post('/sign_up/driver', data=dict(username='nearest', password='password', confirm_password='password', email='nearest@ex.io',
+                                             first_name='Load', last_name='Test', phone_number='0123456789', vehicle='car', license_plate='NEAREST'))
+    driver.post('/login/driver', data=dict(username='nearest', password='password'))
+
+    recorder = Recorder()
+    steps = []
+    with flask_app.app_context():
+        active_orders.collection.delete_many({})
+        seeded = 0
+        for backlog in backlogs:
+            seed(active_orders, backlog - seeded, center, rng)
+            seeded = backlog
+            steps += [f'map_data_{backlog}', f'nearest_{backlog}', f'scan_{backlog}']
+            for location in rng.uniform(-0.2, 0.2, (args.queries, 2)) + center:
+                location = [float(location[0]), float(location[1])]
+                vehicle_type = VEHICLE_TYPES[int(rng.integers(len(VEHICLE_TYPES)))]
+                if args.mongo_uri:
+                    driver.post('/receive_driver_location', json={'location': {'lat': location[0], 'lng': location[1]}})
+                    with recorder.timed(f'map_data_{backlog}'):
+                        response = driver.get(f'/driver_home/map_data?page={int(rng.integers(1, 4))}')
+                    if response.status_code != 200:
+                        recorder.error(f'map_data_{backlog}')
+                    with recorder.timed(f'nearest_{backlog}'):
+                        list(active_orders.find_nearby(location, vehicle_type, radius_km, page_size + 1))
+                # What driver_home did before: every waiting order of the vehicle type, wherever it is
+                with recorder.timed(f'scan_{backlog}'):
+                    list(active_orders.collection.find({'status': 'waiting', 'vehicle_type': vehicle_type}))
+            print(f'{backlog} waiting orders seeded')
+    return finish(args, recorder.summary(), steps)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,76 @@
+import argparse
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from flask.sessions import SecureCookieSessionInterface
+
+from loadtest.environment import Recorder, add_arguments, create_app, finish
+
+BACKENDS = ['memory', 'sqlite', 'cookie']
+
+
+def use_backend(flask_app, backend):
+    """
+    Switch the application to another session store. Sessions of the previous store are lost, so the drivers log in again.
+    """
+    import sessions
+
+    flask_app.config['SESSION_BACKEND'] = backend
+    store = sessions.init_app(flask_app)
+    if store is None:
+        flask_app.session_interface = SecureCookieSessionInterface()
+    flask_app.extensions['session_store'] = store
+
+def main():
+    parser = argparse.ArgumentParser(description='Latency of drivers posting their location, which rewrites their session on every request, with each session backend.')
+    parser.add_argument('--drivers', type=int, default=8, help='drivers posting at the same time')
+    parser.add_argument('--posts', type=int, default=500, help='location posts of each driver per backend')
+    parser.add_argument('--backends', default=','.join(BACKENDS), help='comma separated session backends to compare')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    application, flask_app, _ = create_app(args)
+    rng = np.random.default_rng(args.seed)
+    usernames = [f'poster{number:03d}' for number in range(args.drivers)]
+    signing_up = flask_app.test_client()
+    for number, name in enumerate(usernames):
+        signing_up.post('/sign_up/driver', data=dict(username=name, password='password', confirm_password='password', email=f'{name}@ex.io',
+                                                     first_name='Load', last_name='Test', phone_number='0123456789', vehicle='car', license_plate=f'S{number:04d}'))
+
+    summary = {}
+    steps = []
+    for backend in args.backends.split(','):
+        use_backend(flask_app, backend)
+        drivers = []
+        for name in usernames:
+            driver = flask_app.test_client()
+            driver.post('/login/driver', data=dict(username=name, password='password'))
+            drivers.append(driver)
+        locations = (rng.uniform(-0.2, 0.2, (args.drivers, args.posts, 2)) + [48.85, 2.35]).tolist()
+        # One recorder per backend, so that the throughput only counts the time spent with that backend
+        recorder = Recorder()
+
+        def post(number):
+            driver = drivers[number]
+            for index, (lat, lng) in enumerate(locations[number]):
+                with recorder.timed(f'location_{backend}'):
+                    response = driver.post('/receive_driver_location', json={'location': {'lat': lat, 'lng': lng}})
+                if response.status_code != 200:
+                    recorder.error(f'location_{backend}')
+                if index % 10 == 9:
+                    # A page that only reads the session
+                    with recorder.timed(f'home_{backend}'):
+                        response = driver.get('/driver_home')
+                    if response.status_code != 200:
+                        recorder.error(f'home_{backend}')
+
+        with ThreadPoolExecutor(max_workers=args.drivers) as executor:
+            list(executor.map(post, range(args.drivers)))
+        summary.update(recorder.summary())
+        steps += [f'location_{backend}', f'home_{backend}']
+        print(f"{backend}: {flask_app.extensions['session_store'].stats() if flask_app.extensions['session_store'] is not None else 'signed cookie'}")
+    return finish(args, summary, steps)
+
+if __name__ == '__main__':
+    sys.exit(main())
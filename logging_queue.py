@@ -0,0 +1,139 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+
+from metrics import metrics
+
+# Attributes set on every LogRecord, anything else was passed through extra= and is added to the JSON record
+STANDARD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_listener = None
+_handler = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line.
+    """
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in STANDARD_ATTRIBUTES and key not in entry:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps only a fraction of the INFO and DEBUG records of high-frequency loggers.
+    Warnings and errors are always kept.
+    """
+    def __init__(self, rates):
+        """
+        :param rates: dict of logger name to the fraction of records to keep, applies to child loggers too
+        """
+        super().__init__()
+        self.rates = rates
+
+    def rate(self, name):
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition('.')[0]
+        return 1.0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate(record.name)
+        if rate >= 1.0 or random.random() < rate:
+            return True
+        metrics.increment('log_records_sampled_out_total', logger=record.name)
+        return False
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that never blocks the calling thread. Records are dropped and counted when the queue is full.
+    """
+    def prepare(self, record):
+        # The message is merged with its arguments here, the JSON formatting happens on the writer thread
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.increment('log_records_dropped_total')
+
+def parse_levels(value):
+    """
+    Parse a setting such as 'engineio=WARNING,chat=DEBUG' into a dict of logger name to value.
+    """
+    levels = {}
+    for item in (value or '').split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels[name.strip()] = level.strip()
+    return levels
+
+def init_app(app):
+    """
+    Route every log record through a bounded in-memory queue to a single writer thread.
+    Request threads only format the message and enqueue it, the writer formats JSON and does the disk I/O.
+    """
+    global _listener, _handler
+    stop()
+
+    if app.config['LOG_FILE']:
+        target = logging.FileHandler(app.config['LOG_FILE'])
+    else:
+        target = logging.StreamHandler(sys.stderr)
+    target.setFormatter(JsonFormatter())
+
+    _handler = DroppingQueueHandler(queue.Queue(maxsize=app.config['LOG_QUEUE_SIZE']))
+    _handler.addFilter(SamplingFilter(dict((name, float(rate)) for name, rate in parse_levels(app.config['LOG_SAMPLING']).items())))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_handler)
+    root.setLevel(app.config['LOG_LEVEL'])
+    # Per subsystem levels, for example 'engineio=WARNING,chat=DEBUG'
+    for name, level in parse_levels(app.config['LOG_LEVELS']).items():
+        logging.getLogger(name).setLevel(level.upper())
+
+    _listener = logging.handlers.QueueListener(_handler.queue, target)
+    _listener.start()
+    metrics.gauge('log_queue', lambda: {'size': _handler.queue.qsize()})
+
+def stop():
+    """
+    Write the queued records and stop the writer thread.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+atexit.register(stop)
@@ -0,0 +1,119 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A thread-safe bounded mapping with a time to live, evicting the least recently used entries first.
+    The cache can also be bounded by the total weight of its values, such as their size in bytes, by setting max_weight and overriding weight.
+    The user, order, page and in-memory session caches are built on it and keep their own get and set methods.
+    """
+    # Clock of the expiry times, subclasses whose expiry times are shown outside the process use the wall clock
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, max_size, ttl, max_weight=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_weight = max_weight
+        self.entries = OrderedDict()
+        self.total_weight = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.removals = 0
+
+    def weight(self, value):
+        """
+        :return: weight of a value counted against max_weight
+        """
+        return 0
+
+    def ttl_for(self, value):
+        """
+        :return: time to live of a value in seconds
+        """
+        return self.ttl
+
+    def lookup(self, key, accept=None):
+        """
+        Get an entry and mark it as the most recently used.
+        :param accept: optional function of the value, the entry counts as a miss when it returns False
+        :return: tuple of (value, expiry time), or None if the entry is missing, has expired or is not accepted
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] < self.clock():
+                self.remove(key)
+                entry = None
+            if entry is None or (accept is not None and not accept(entry[0])):
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def store(self, key, value):
+        """
+        Add or replace an entry, evicting the least recently used entries until the cache is within its limits.
+        A value heavier than max_weight on its own is not stored.
+        """
+        expires = self.clock() + self.ttl_for(value)
+        weight = self.weight(value)
+        with self.lock:
+            self.remove(key)
+            if self.max_weight is not None and weight > self.max_weight:
+                return
+            self.entries[key] = (value, expires)
+            self.total_weight += weight
+            while len(self.entries) > self.max_size or (self.max_weight is not None and self.total_weight > self.max_weight):
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def replace(self, key, function):
+        """
+        Replace the value of an entry by function(value), keeping its place in the LRU order. Nothing happens if the entry is missing.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            value = function(entry[0])
+            self.total_weight += self.weight(value) - self.weight(entry[0])
+            self.entries[key] = (value, self.clock() + self.ttl_for(value))
+
+    def discard(self, key):
+        """
+        Remove an entry.
+        :return: True if there was one
+        """
+        with self.lock:
+            if self.remove(key) is None:
+                return False
+            self.removals += 1
+            return True
+
+    def remove(self, key):
+        # Called with the lock held
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_weight -= self.weight(entry[0])
+        return entry
+
+    def expire(self):
+        """
+        Remove the expired entries.
+        :return: number of entries removed
+        """
+        now = self.clock()
+        with self.lock:
+            stale = [key for key, entry in self.entries.items() if entry[1] < now]
+            for key in stale:
+                self.remove(key)
+        return len(stale)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_weight = 0
@@ -0,0 +1,142 @@
+import logging
+import queue
+import smtplib
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class MailDispatcher(object):
+    """
+    Sends emails from a pool of background workers so that requests never wait on the SMTP server.
+    Messages go through a bounded queue. Each worker sends the messages it finds waiting in a single SMTP session,
+    and failed messages are retried with exponential backoff.
+    """
+    def __init__(self, app=None, mail=None):
+        self.app = None
+        self.mail = None
+        self.queue = None
+        self.workers = []
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, mail)
+
+    def init_app(self, app, mail):
+        """
+        Configure the dispatcher from the application config:
+        MAIL_QUEUE_SIZE, MAIL_WORKERS, MAIL_BATCH_SIZE, MAIL_MAX_RETRIES and MAIL_RETRY_DELAY (in seconds).
+        """
+        self.app = app
+        self.mail = mail
+        self.queue = queue.Queue(maxsize=int(app.config.get('MAIL_QUEUE_SIZE', 1000)))
+        self.num_workers = int(app.config.get('MAIL_WORKERS', 2))
+        self.batch_size = int(app.config.get('MAIL_BATCH_SIZE', 20))
+        self.max_retries = int(app.config.get('MAIL_MAX_RETRIES', 5))
+        self.retry_delay = float(app.config.get('MAIL_RETRY_DELAY', 2))
+
+    def send(self, msg, on_failure=None):
+        """
+        Queue a message to be sent in the background.
+        :param msg: flask_mail Message
+        :param on_failure: optional function called if the message could not be sent after all the retries
+        :return: True if the message was queued, False if the queue is full
+        """
+        self.start()
+        try:
+            self.queue.put_nowait((msg, 0, on_failure))
+            return True
+        except queue.Full:
+            logger.warning(f"Mail queue full, dropping message '{msg.subject}'")
+            return False
+
+    def start(self):
+        """
+        Start the worker threads, if they are not running yet.
+        """
+        with self.lock:
+            if self.workers:
+                return
+            for i in range(self.num_workers):
+                worker = threading.Thread(target=self.work, name=f'mail-worker-{i}', daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def work(self):
+        """
+        Worker loop: wait for a message, then send it together with any other waiting messages.
+        """
+        with self.app.app_context():
+            while True:
+                batch = [self.queue.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                try:
+                    self.deliver(batch)
+                except Exception:
+                    # A worker that dies stalls the queue, so whatever went wrong it carries on with the next batch
+                    logger.exception(f"Could not deliver a batch of {len(batch)} messages")
+
+    def deliver(self, batch):
+        """
+        Send a batch of messages over a single SMTP connection.
+        """
+        pending = list(batch)
+        failed = []
+        try:
+            with self.mail.connect() as connection:
+                while pending:
+                    item = pending.pop(0)
+                    try:
+                        connection.send(item[0])
+                    except (smtplib.SMTPException, OSError) as e:
+                        logger.warning(f"SMTP Exception: {str(e)}")
+                        failed.append(item)
+                    except Exception:
+                        logger.exception(f"Could not send message '{item[0].subject}'")
+                        failed.append(item)
+        except (smtplib.SMTPException, OSError) as e:
+            logger.warning(f"SMTP Exception: {str(e)}")
+            failed.extend(pending)
+        except Exception:
+            logger.exception("Could not open an SMTP connection")
+            failed.extend(pending)
+        for item in failed:
+            self.retry(item)
+
+    def retry(self, item):
+        """
+        Queue a failed message again after a delay, or give up once it has been retried MAIL_MAX_RETRIES times.
+        """
+        msg, attempts, on_failure = item
+        if attempts >= self.max_retries:
+            logger.warning(f"Giving up on message '{msg.subject}' after {attempts} retries")
+            self.fail(item)
+            return
+        delay = self.retry_delay * 2 ** attempts
+        timer = threading.Timer(delay, self.requeue, args=[(msg, attempts + 1, on_failure)])
+        timer.daemon = True
+        timer.start()
+
+    def requeue(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            logger.warning(f"Mail queue full, dropping message '{item[0].subject}'")
+            self.fail(item)
+
+    def fail(self, item):
+        """
+        Call the on_failure function of a message that will not be sent.
+        """
+        msg, attempts, on_failure = item
+        if on_failure is None:
+            return
+        try:
+            on_failure()
+        except Exception:
+            logger.exception(f"on_failure of message '{msg.subject}' failed")
+
+mail_dispatcher = MailDispatcher()
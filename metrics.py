@@ -0,0 +1,240 @@
+import bisect
+import functools
+import inspect
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from apscheduler.events import EVENT_JOB_MISSED
+from pymongo.monitoring import CommandListener
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+QUANTILES = [0.5, 0.95, 0.99]
+
+
+class Histogram(object):
+    """
+    Latency histogram with fixed buckets. Quantiles are estimated from the buckets.
+    """
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Estimate a quantile by linear interpolation inside the bucket that contains it.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return BUCKETS[-1]
+
+class Metrics(object):
+    """
+    In-memory registry of counters and latency histograms, exposed in the Prometheus text format.
+    Metrics are identified by a name and a tuple of (label, value) pairs.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def gauge(self, name, function):
+        """
+        Register a function returning a dict of values, read every time the metrics are scraped.
+        """
+        self.gauges[name] = function
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def track_event(self, function):
+        """
+        Decorator counting and timing a socket.io event handler.
+        """
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            # Flask-SocketIO calls connect handlers again without arguments when they raise TypeError
+            signature.bind(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                self.increment('socketio_event_errors_total', event=function.__name__)
+                raise
+            finally:
+                self.observe('socketio_event_seconds', time.perf_counter() - start, event=function.__name__)
+        return wrapper
+
+    def wsgi_middleware(self, wsgi_app):
+        return MetricsMiddleware(wsgi_app, self)
+
+    def render(self):
+        """
+        :return: all the metrics in the Prometheus text exposition format
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = dict((key, (list(h.counts), h.total, h.count, [h.quantile(q) for q in QUANTILES])) for key, h in self.histograms.items())
+        lines = []
+        for (name, labels), value in sorted(counters.items()):
+            lines.append(f'{name}{format_labels(labels)} {value}')
+        for (name, labels), (counts, total, count, quantiles) in sorted(histograms.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS + ['+Inf'], counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {total}')
+            lines.append(f'{name}_count{format_labels(labels)} {count}')
+            for q, value in zip(QUANTILES, quantiles):
+                lines.append(f'{name}_quantile{format_labels(labels + (("quantile", q),))} {value}')
+        for name, function in sorted(self.gauges.items()):
+            for key, value in sorted(function().items()):
+                lines.append(f'{name}{format_labels((("name", key),))} {value}')
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+class MetricsMiddleware(object):
+    """
+    WSGI middleware recording the latency of each request, including the time spent streaming the response body.
+    The application sets the endpoint name in environ['metrics.labels'].
+    """
+    def __init__(self, app, metrics):
+        self.app = app
+        self.metrics = metrics
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        status = []
+        # Inner middlewares may copy the environ, so the application fills in this shared dict instead
+        labels = environ['metrics.labels'] = {}
+
+        def recording_start_response(status_line, headers, exc_info=None):
+            status.append(status_line[:3])
+            return start_response(status_line, headers, exc_info)
+
+        try:
+            body = self.app(environ, recording_start_response)
+        except Exception:
+            self.record(labels, start, '500')
+            raise
+        return ClosingIterator(body, lambda: self.record(labels, start, status[0] if status else '500'))
+
+    def record(self, labels, start, status):
+        endpoint = labels.get('endpoint') or 'unknown'
+        self.metrics.observe('http_request_seconds', time.perf_counter() - start, endpoint=endpoint)
+        self.metrics.increment('http_requests_total', endpoint=endpoint, status=status)
+        if status.startswith('5'):
+            self.metrics.increment('http_request_errors_total', endpoint=endpoint)
+
+class ClosingIterator(object):
+    """
+    Wraps a response body and calls a function once the server has consumed and closed it.
+    """
+    def __init__(self, body, on_close):
+        self.body = body
+        self.on_close = on_close
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.on_close()
+
+class MongoCommandMetrics(CommandListener):
+    """
+    Records the duration of every MongoDB command, by command name.
+    """
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.metrics.observe('mongo_command_seconds', event.duration_micros / 1e6, command=event.command_name)
+
+    def failed(self, event):
+        self.metrics.observe('mongo_command_seconds', event.duration_micros / 1e6, command=event.command_name)
+        self.metrics.increment('mongo_command_errors_total', command=event.command_name)
+
+class TimedCursor(sqlite3.Cursor):
+    """
+    SQLite cursor recording the duration of each statement, by statement type.
+    """
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            metrics.observe('sqlite_statement_seconds', time.perf_counter() - start, statement=sql.split(None, 1)[0].upper())
+
+class TimedConnection(sqlite3.Connection):
+    """
+    SQLite connection whose cursors record statement durations.
+    """
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+def scheduler_listener(event):
+    """
+    APScheduler listener counting job runs by job id and outcome.
+    """
+    if getattr(event, 'exception', None):
+        outcome = 'error'
+    elif event.code & EVENT_JOB_MISSED:
+        outcome = 'missed'
+    else:
+        outcome = 'executed'
+    metrics.increment('scheduler_jobs_total', job=event.job_id, outcome=outcome)
+
+metrics = Metrics()
@@ -0,0 +1,129 @@
+import threading
+
+from pymongo import MongoClient
+from pymongo.monitoring import ConnectionPoolListener
+from pymongo.read_concern import ReadConcern
+from pymongo.write_concern import WriteConcern
+
+from config import Config
+from metrics import MongoCommandMetrics, metrics
+
+class PoolMetrics(ConnectionPoolListener):
+    """
+    Counts connection pool events so that the state of the pool can be inspected.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {
+            'pools_created': 0,
+            'connections_created': 0,
+            'connections_closed': 0,
+            'checked_out': 0,
+            'checked_in': 0,
+            'checkout_failures': 0,
+        }
+
+    def increment(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def snapshot(self):
+        """
+        :return: dict with the event counters, plus the number of open and in-use connections
+        """
+        with self.lock:
+            counters = dict(self.counters)
+        counters['open'] = counters['connections_created'] - counters['connections_closed']
+        counters['in_use'] = counters['checked_out'] - counters['checked_in']
+        return counters
+
+    def pool_created(self, event):
+        self.increment('pools_created')
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.increment('connections_created')
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.increment('connections_closed')
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self.increment('checkout_failures')
+
+    def connection_checked_out(self, event):
+        self.increment('checked_out')
+
+    def connection_checked_in(self, event):
+        self.increment('checked_in')
+
+pool_metrics = PoolMetrics()
+metrics.gauge('mongo_pool', pool_metrics.snapshot)
+
+# Connection settings, replaced by the application configuration in init_app
+settings = dict((name, getattr(Config, name)) for name in dir(Config) if name.startswith('MONGO_'))
+
+_client = None
+_client_lock = threading.Lock()
+
+def init_app(app):
+    """
+    Use the MongoDB settings of the application. The client is still only created on first use.
+    """
+    settings.update((name, app.config[name]) for name in settings if name in app.config)
+
+def get_client():
+    """
+    Get the MongoClient shared by the whole application, creating it on first use.
+    The pool size, timeouts and concerns come from the configuration.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = MongoClient(
+                    settings['MONGO_URI'],
+                    maxPoolSize=settings['MONGO_MAX_POOL_SIZE'],
+                    minPoolSize=settings['MONGO_MIN_POOL_SIZE'],
+                    maxIdleTimeMS=settings['MONGO_MAX_IDLE_TIME_MS'],
+                    connectTimeoutMS=settings['MONGO_CONNECT_TIMEOUT_MS'],
+                    serverSelectionTimeoutMS=settings['MONGO_SERVER_SELECTION_TIMEOUT_MS'],
+                    waitQueueTimeoutMS=settings['MONGO_WAIT_QUEUE_TIMEOUT_MS'],
+                    event_listeners=[pool_metrics, MongoCommandMetrics(metrics)],
+                    connect=False,
+                )
+    return _client
+
+def get_database():
+    """
+    Get the application database with the configured read and write concerns.
+    """
+    write_concern = settings['MONGO_WRITE_CONCERN']
+    return get_client().get_database(
+        settings['MONGO_DB_NAME'],
+        write_concern=WriteConcern(w=int(write_concern) if write_concern.isdigit() else write_concern),
+        read_concern=ReadConcern(settings['MONGO_READ_CONCERN']),
+    )
+
+def close_client():
+    """
+    Close the shared MongoClient, for example when a worker shuts down.
+    """
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
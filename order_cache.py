@@ -0,0 +1,89 @@
+from lru import LRUCache
+
+# Fields written when an order is booked and never changed afterwards.
+# Other processes may change the other fields of an order in progress, such as its status or its driver.
+IMMUTABLE_FIELDS = frozenset(['_id', 'client_id', 'client_name', 'vehicle_type', 'departure_time', 'number_of_passengers',
+                              'origin', 'origin_point', 'destination', 'distance', 'price', 'created_at'])
+
+def immutable(projection):
+    """
+    :return: True if a projection only asks for fields that never change once the order is booked
+    """
+    if projection is None:
+        return False
+    return all(field in IMMUTABLE_FIELDS for field in projection if not isinstance(projection, dict) or projection[field])
+
+
+def project(order, projection):
+    """
+    Apply a MongoDB style projection to a cached order.
+    :param order: the full order document
+    :param projection: None, a list of field names, or a dict of field names to 1
+    :return: a new dict with the requested fields and the _id
+    """
+    if projection is None:
+        return dict(order)
+    fields = [field for field in projection if not isinstance(projection, dict) or projection[field]]
+    projected = dict((field, order[field]) for field in fields if field in order)
+    if '_id' in order and (not isinstance(projection, dict) or projection.get('_id', 1)):
+        projected['_id'] = order['_id']
+    return projected
+
+def completed(order):
+    return order.get('status') == 'completed'
+
+class OrderCache(LRUCache):
+    """
+    A bounded LRU cache of whole order documents keyed by ObjectId, in front of the active_orders and order_history collections.
+    Orders still in progress are kept for a short time, completed orders no longer change and are kept longer.
+    The cache is local to the process, so only completed orders, or the IMMUTABLE_FIELDS of orders in progress, should be read from it.
+    """
+    def __init__(self, max_size=10000, ttl=30, completed_ttl=3600):
+        super().__init__(max_size, ttl)
+        self.completed_ttl = completed_ttl
+
+    def ttl_for(self, order):
+        return self.completed_ttl if completed(order) else self.ttl
+
+    def get(self, order_id, completed_only=False):
+        """
+        Get a cached order.
+        :param completed_only: only return the order if it is completed
+        :return: the order, or None if it is not cached, has expired, or is not completed when completed_only is set
+        """
+        entry = self.lookup(order_id, accept=completed if completed_only else None)
+        return entry[0] if entry is not None else None
+
+    def set(self, order_id, order):
+        """
+        Cache an order, evicting the least recently used entry if the cache is full.
+        """
+        self.store(order_id, order)
+
+    def update(self, order_id, fields):
+        """
+        Apply fields written to an order to its cached copy, if it is cached.
+        The cached document is replaced rather than changed, so orders already returned by get stay consistent.
+        """
+        self.replace(order_id, lambda order: dict(order, **fields))
+
+    def invalidate(self, order_id):
+        """
+        Remove an order from the cache after it has been written.
+        """
+        self.discard(order_id)
+
+    def stats(self):
+        """
+        :return: dict with the cache size, the hit and miss counters and the hit rate
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.removals,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
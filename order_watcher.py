@@ -0,0 +1,162 @@
+import logging
+import threading
+
+from bson import ObjectId
+from pymongo.errors import OperationFailure, PyMongoError
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Error code returned by MongoDB when change streams are used on a standalone server
+CHANGE_STREAM_UNSUPPORTED = 40573
+
+
+class OrderStatusWatcher(object):
+    """
+    Watches the active_orders collection for accepted and deleted orders and notifies the waiting clients.
+    A single background task serves every waiting client. It listens to a MongoDB change stream,
+    and falls back to polling all watched orders in one query when the deployment has no replica set.
+    """
+    def __init__(self, repository, socketio, poll_interval=1.0):
+        self.repository = repository
+        self.socketio = socketio
+        self.poll_interval = poll_interval
+        self.watched = {}
+        self.lock = threading.Lock()
+        self.started = False
+        self.use_change_stream = True
+        # Resume token of the last change seen, so that a reopened change stream starts where the previous one stopped
+        self.resume_token = None
+
+    @property
+    def collection(self):
+        # Resolved on first use so that creating the watcher does not touch the database
+        return self.repository.collection
+
+    def watch(self, order_id, user_id):
+        """
+        Start watching an order on behalf of a client.
+        :param order_id: id of the order as a string
+        :param user_id: id of the client, used as the socket.io room
+        """
+        with self.lock:
+            self.watched[order_id] = user_id
+            if not self.started:
+                self.started = True
+                self.socketio.start_background_task(self.run)
+        # The order may have been accepted before the client started waiting.
+        # Orders accepted between this query and the opening of the change stream are caught by listen.
+        order = self.collection.find_one({'_id': ObjectId(order_id)}, {'status': 1, 'driver_name': 1})
+        if order is None:
+            self.expire(order_id)
+        elif order['status'] == 'accepted':
+            self.notify(order_id, order['driver_name'])
+
+    def unwatch(self, order_id):
+        """
+        Stop watching an order.
+        :param order_id: id of the order as a string
+        :return: id of the client that was waiting for the order, or None
+        """
+        with self.lock:
+            return self.watched.pop(order_id, None)
+
+    def notify(self, order_id, driver_name):
+        """
+        Emit the order_accepted event to the client waiting for the order, at most once.
+        """
+        # The order may have been accepted through another process, so this process' cached copy is out of date
+        self.repository.invalidate(order_id)
+        user_id = self.unwatch(order_id)
+        if user_id is None:
+            return
+        logger.info("Order %s accepted by %s", order_id, driver_name)
+        metrics.increment('order_watcher_notifications_total')
+        self.socketio.emit("order_accepted", {'order_id': order_id, "order_driver": driver_name}, namespace='/clients', to=user_id)
+
+    def expire(self, order_id):
+        """
+        Emit the order_expired event to the client waiting for an order that no longer exists,
+        because it expired and was archived or was cancelled.
+        """
+        self.repository.invalidate(order_id)
+        user_id = self.unwatch(order_id)
+        if user_id is None:
+            return
+        logger.info("Order %s expired or cancelled", order_id)
+        metrics.increment('order_watcher_expirations_total')
+        self.socketio.emit("order_expired", {'order_id': order_id}, namespace='/clients', to=user_id)
+
+    def run(self):
+        """
+        Main loop of the background task.
+        """
+        while True:
+            try:
+                if self.use_change_stream:
+                    self.listen()
+                else:
+                    self.poll()
+                    self.socketio.sleep(self.poll_interval)
+            except Exception:
+                # The task is never restarted, so whatever went wrong it carries on and the waiting clients are still notified
+                logger.exception("Order status watcher failed")
+                self.socketio.sleep(self.poll_interval)
+
+    def listen(self):
+        """
+        Listen to the change stream until it fails.
+        """
+        pipeline = [{'$match': {'$or': [
+            {'operationType': 'delete'},
+            {'operationType': 'update', 'updateDescription.updatedFields.status': 'accepted'}
+        ]}}]
+        try:
+            with self.collection.watch(pipeline, resume_after=self.resume_token) as stream:
+                logger.info("Watching active orders through a change stream")
+                # Orders changed before the stream was opened, or while it was down, produce no event
+                self.poll()
+                for change in stream:
+                    self.resume_token = stream.resume_token
+                    order_id = str(change['documentKey']['_id'])
+                    if change['operationType'] == 'delete':
+                        self.expire(order_id)
+                    else:
+                        updated_fields = change['updateDescription']['updatedFields']
+                        self.notify(order_id, updated_fields.get('driver_name', ''))
+        except OperationFailure as e:
+            if e.code == CHANGE_STREAM_UNSUPPORTED:
+                logger.info("Change streams are not supported, polling active orders instead")
+                self.use_change_stream = False
+            else:
+                # The resume token may have fallen off the oplog, the poll after reopening catches up instead
+                logger.warning("Change stream exception: %s", e)
+                self.resume_token = None
+                self.socketio.sleep(self.poll_interval)
+        except PyMongoError as e:
+            logger.warning("Change stream exception: %s", e)
+            self.socketio.sleep(self.poll_interval)
+
+    def poll(self):
+        """
+        Fetch the status of every watched order with a single query.
+        """
+        with self.lock:
+            order_ids = list(self.watched)
+        if not order_ids:
+            return
+        try:
+            with metrics.timer('order_watcher_poll_seconds'):
+                orders = list(self.collection.find({'_id': {'$in': [ObjectId(order_id) for order_id in order_ids]}}, {'status': 1, 'driver_name': 1}))
+            found = set()
+            for order in orders:
+                order_id = str(order['_id'])
+                found.add(order_id)
+                if order['status'] == 'accepted':
+                    self.notify(order_id, order['driver_name'])
+            for order_id in order_ids:
+                if order_id not in found:
+                    self.expire(order_id)
+        except PyMongoError as e:
+            logger.warning("Exception: %s", e)
@@ -0,0 +1,271 @@
+import logging
+
+from bson import ObjectId
+from pymongo import ASCENDING, GEOSPHERE, ReturnDocument
+
+from mongo import get_database
+from order_cache import immutable, project
+
+logger = logging.getLogger(__name__)
+
+def location_point(location):
+    """
+    Build a GeoJSON point from a [latitude, longitude] pair.
+    :param location: list of latitude and longitude
+    :return: GeoJSON point, which stores coordinates as [longitude, latitude]
+    """
+    return {'type': 'Point', 'coordinates': [float(location[1]), float(location[0])]}
+
+class OrderRepository(object):
+    """
+    Access to the active_orders collection. All the reads and writes of orders go through this object.
+    Orders read by id are served from an optional OrderCache, which the write methods below keep up to date.
+    Other processes write to the same orders, so an order in progress is only served from the cache for the fields that never change.
+    """
+    def __init__(self, collection_name='active_orders', history_collection_name='order_history', cache=None):
+        self.collection_name = collection_name
+        self.history_collection_name = history_collection_name
+        self.cache = cache
+        self._collection = None
+        self._history = None
+
+    @property
+    def collection(self):
+        """
+        The underlying collection, looked up on first use.
+        """
+        if self._collection is None:
+            self._collection = get_database()[self.collection_name]
+        return self._collection
+
+    @property
+    def history(self):
+        """
+        The collection holding archived orders, looked up on first use.
+        """
+        if self._history is None:
+            self._history = get_database()[self.history_collection_name]
+        return self._history
+
+    def create(self, order):
+        """
+        Insert a new order.
+        :return: id of the new order
+        """
+        return self.collection.insert_one(order).inserted_id
+
+    def get(self, order_id, projection=None):
+        """
+        Get an order by id.
+        :param order_id: id of the order, as a string or ObjectId
+        :param projection: optional list or dict of the fields to return
+        :return: the order, or None if it does not exist
+        """
+        order_id = ObjectId(order_id)
+        if self.cache is None:
+            return self.collection.find_one({'_id': order_id}, projection)
+        # The status or the driver of an order in progress may have been changed by another process
+        order = self.cache.get(order_id, completed_only=not immutable(projection))
+        if order is None:
+            # The whole order is cached so that every page can be served from it, whatever fields it needs
+            order = self.collection.find_one({'_id': order_id})
+            if order is None:
+                return None
+            self.cache.set(order_id, order)
+        return project(order, projection)
+
+    def get_any(self, order_id, projection=None):
+        """
+        Get an order by id, from the active orders or from the history if it has been archived.
+        Only completed orders are served from the cache, since the ride may have been ended by another process.
+        :return: the order, or None if it does not exist
+        """
+        order_id = ObjectId(order_id)
+        order = self.cache.get(order_id, completed_only=True) if self.cache is not None else None
+        if order is None:
+            order = self.collection.find_one({'_id': order_id})
+            if order is None:
+                order = self.history.find_one({'_id': order_id})
+            if order is None:
+                return None
+            if self.cache is not None:
+                self.cache.set(order_id, order)
+        return project(order, projection)
+
+    def invalidate(self, order_id):
+        """
+        Drop an order from the cache, for example after another process changed it.
+        """
+        if self.cache is not None:
+            self.cache.invalidate(ObjectId(order_id))
+
+    def find_waiting(self, projection=None):
+        """
+        Get the waiting orders whose vehicle type has been chosen, oldest first.
+        """
+        return self.collection.find({'status': 'waiting', 'vehicle_type': {'$ne': ''}}, projection).sort('created_at', ASCENDING)
+
+    def update(self, order_id, fields):
+        """
+        Set fields on an order.
+        """
+        result = self.collection.update_one({'_id': ObjectId(order_id)}, {'$set': fields})
+        if self.cache is not None:
+            self.cache.update(ObjectId(order_id), fields)
+        return result
+
+    def accept(self, order_id, driver_id, driver_name):
+        """
+        Assign an order to a driver, only if it is still waiting.
+        The check and the update are a single atomic operation, so when several drivers accept the same order exactly one of them wins.
+        :return: True if the driver got the order, False if it was already taken or no longer exists
+        """
+        fields = {
+            'driver': driver_id,
+            'driver_name': driver_name,
+            'status': 'accepted',
+        }
+        result = self.collection.update_one({'_id': ObjectId(order_id), 'status': 'waiting'}, {'$set': fields})
+        if self.cache is not None:
+            if result.modified_count == 1:
+                self.cache.update(ObjectId(order_id), fields)
+            else:
+                # Another driver got the order, possibly through another process
+                self.cache.invalidate(ObjectId(order_id))
+        return result.modified_count == 1
+
+    def complete(self, order_id, driver_id, fields):
+        """
+        Mark an accepted order as completed, only if it is still in progress and assigned to the driver.
+        :param driver_id: id of the driver ending the ride
+        :param fields: fields to set on the order, such as its completion time
+        :return: the completed order, or None if the ride was already ended, never accepted or belongs to another driver
+        """
+        fields = dict(fields, status='completed')
+        order = self.collection.find_one_and_update({'_id': ObjectId(order_id), 'status': 'accepted', 'driver': driver_id}, {'$set': fields},
+                                                    return_document=ReturnDocument.AFTER)
+        if self.cache is not None:
+            if order is not None:
+                self.cache.set(order['_id'], order)
+            else:
+                self.cache.invalidate(ObjectId(order_id))
+        return order
+
+    def claim_invoice(self, order_id):
+        """
+        Mark the invoice of an order as sent, so that it is only sent once.
+        :return: True if the caller should send the invoice, False if it has already been sent
+        """
+        for collection in (self.collection, self.history):
+            result = collection.update_one({'_id': ObjectId(order_id), 'invoice_sent': {'$ne': True}}, {'$set': {'invoice_sent': True}})
+            if result.modified_count == 1:
+                if self.cache is not None:
+                    self.cache.update(ObjectId(order_id), {'invoice_sent': True})
+                return True
+        return False
+
+    def release_invoice(self, order_id):
+        """
+        Undo claim_invoice after the invoice could not be sent, so that it is sent on the next visit.
+        """
+        for collection in (self.collection, self.history):
+            collection.update_one({'_id': ObjectId(order_id)}, {'$set': {'invoice_sent': False}})
+        if self.cache is not None:
+            self.cache.update(ObjectId(order_id), {'invoice_sent': False})
+
+    def delete(self, order_id):
+        """
+        Delete an order.
+        """
+        result = self.collection.delete_one({'_id': ObjectId(order_id)})
+        self.invalidate(order_id)
+        return result
+
+    def find_nearby(self, location, vehicle_type, radius_km, limit, skip=0):
+        """
+        Find the waiting orders closest to a location, nearest first.
+        :param location: list of latitude and longitude of the driver
+        :param vehicle_type: type of the vehicle ('car', 'van', 'horse')
+        :param radius_km: maximum distance between the driver and the pickup location
+        :param limit: maximum number of orders to return
+        :param skip: number of orders to skip, used for pagination
+        :return: cursor over the matching orders
+        """
+        return self.collection.find({
+            'status': 'waiting',
+            'vehicle_type': vehicle_type,
+            'origin_point': {'$near': {'$geometry': location_point(location), '$maxDistance': radius_km * 1000}}
+        }).skip(skip).limit(limit)
+
+    def create_indexes(self):
+        """
+        Create the indexes used to look up waiting orders near a driver, and to find orders by status and age.
+        """
+        self.collection.create_index([('status', ASCENDING), ('vehicle_type', ASCENDING), ('origin_point', GEOSPHERE)], name='status_vehicle_origin_point')
+        # Used by the archiver to find stale waiting orders and finished rides
+        self.collection.create_index([('status', ASCENDING), ('created_at', ASCENDING)], name='status_created_at')
+        self.collection.create_index([('status', ASCENDING), ('ended_at', ASCENDING)], name='status_ended_at')
+        # Used by the ride history export
+        self.history.create_index([('status', ASCENDING), ('ended_at', ASCENDING)], name='status_ended_at')
+
+    def archive(self, query, batch_size, fields=None):
+        """
+        Move the orders matching a query to the history collection, in batches.
+        Orders are copied before they are deleted, so an interrupted run never loses an order.
+        Copies are upserted by id and never deleted unless the order is still active, so several archivers can run at the same time.
+        :param query: filter selecting the orders to archive
+        :param batch_size: number of orders moved per batch
+        :param fields: optional fields to set on the archived orders
+        :return: number of orders archived
+        """
+        archived = 0
+        while True:
+            orders = list(self.collection.find(query).limit(batch_size))
+            if not orders:
+                return archived
+            if fields:
+                for order in orders:
+                    order.update(fields)
+            order_ids = [order['_id'] for order in orders]
+            # A copy left by an interrupted run, or made by another archiver, is kept as it is, it is brought up to date below
+            existing = set()
+            for order in orders:
+                result = self.history.update_one({'_id': order['_id']}, {'$setOnInsert': {key: value for key, value in order.items() if key != '_id'}},
+                                                 upsert=True)
+                if result.upserted_id is None:
+                    existing.add(order['_id'])
+            for copied in orders:
+                # Each order is deleted on its own to get its last version, which may differ from the copy,
+                # for example when its invoice was sent in between
+                deleted = self.collection.find_one_and_delete({'$and': [query, {'_id': copied['_id']}]})
+                if deleted is None:
+                    # Either another archiver moved the order, whose copy must stay, or the order changed while it was being copied
+                    # and no longer matches the query, in which case it stays active and its copy is dropped
+                    if self.collection.find_one({'_id': copied['_id']}, {'_id': 1}) is not None:
+                        self.history.delete_one({'_id': copied['_id']})
+                    continue
+                if fields:
+                    deleted.update(fields)
+                if deleted != copied or copied['_id'] in existing:
+                    # $set rather than a replacement, so that a change made to the copy since the delete is kept.
+                    # Upserted in case another archiver dropped the copy while the order was still active
+                    self.history.update_one({'_id': copied['_id']}, {'$set': {key: value for key, value in deleted.items() if key != '_id'}}, upsert=True)
+                archived += 1
+            if self.cache is not None:
+                for order_id in order_ids:
+                    self.cache.invalidate(order_id)
+            if len(orders) < batch_size:
+                return archived
+
+    def backfill_origin_points(self):
+        """
+        Add the origin_point field to orders created before it existed.
+        """
+        result = self.collection.update_many({'origin_point': {'$exists': False}, 'origin.1': {'$exists': True}}, [{'$set': {'origin_point': {
+            'type': 'Point',
+            'coordinates': [{'$toDouble': {'$arrayElemAt': ['$origin', 1]}}, {'$toDouble': {'$arrayElemAt': ['$origin', 0]}}]
+        }}}])
+        if result.modified_count:
+            logger.info(f"Added origin_point to {result.modified_count} orders")
+
+active_orders = OrderRepository()
@@ -0,0 +1,85 @@
+import hashlib
+from datetime import datetime, timezone
+
+from flask import make_response, request
+
+from lru import LRUCache
+
+
+class CachedPage(object):
+    __slots__ = ('body', 'etag', 'last_modified')
+
+    def __init__(self, body, etag, last_modified):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+
+class PageCache(LRUCache):
+    """
+    A bounded LRU cache of rendered pages that no longer change, such as the summary and invoice of a completed ride.
+    The cache is bounded both by its number of pages and by their total size in bytes, the least recently used pages are evicted first.
+    """
+    def __init__(self, max_entries=5000, max_bytes=50 * 1024 * 1024, ttl=86400):
+        super().__init__(max_entries, ttl, max_weight=max_bytes)
+
+    def weight(self, page):
+        return len(page.body)
+
+    def get(self, key):
+        """
+        Get a cached page.
+        :return: the CachedPage, or None if it is not cached or has expired
+        """
+        entry = self.lookup(key)
+        return entry[0] if entry is not None else None
+
+    def set(self, key, body, last_modified=None):
+        """
+        Cache a rendered page, evicting the least recently used pages until the cache is within its limits.
+        :param key: tuple identifying the page and the user it was rendered for
+        :param body: rendered page, as a string
+        :param last_modified: datetime at which the content of the page last changed, defaults to now
+        :return: the CachedPage
+        """
+        body = body.encode() if isinstance(body, str) else body
+        if last_modified is None:
+            last_modified = datetime.now(timezone.utc)
+        elif last_modified.tzinfo is None:
+            # Naive datetimes in the database are in local time
+            last_modified = last_modified.astimezone(timezone.utc)
+        page = CachedPage(body, hashlib.sha1(body).hexdigest(), last_modified.replace(microsecond=0))
+        self.store(key, page)
+        return page
+
+    def invalidate(self, key):
+        """
+        Remove a page from the cache.
+        """
+        self.discard(key)
+
+    def stats(self):
+        """
+        :return: dict with the number of pages, their total size in bytes, the hit, miss and eviction counters
+        """
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'bytes': self.total_weight,
+                'max_entries': self.max_size,
+                'max_bytes': self.max_weight,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+def page_response(page):
+    """
+    Build the response for a cached page, answering 304 Not Modified if the browser already has it.
+    The page depends on the logged in user, so it may only be cached by the browser and is revalidated on every view.
+    """
+    response = make_response(page.body)
+    response.set_etag(page.etag)
+    response.last_modified = page.last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
@@ -0,0 +1,88 @@
+import math
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371
+
+# Add 10% to the distance to account for further distance due to road layout
+ROAD_FACTOR = 1.1
+
+# Price per kilometer for each vehicle type
+PRICE_PER_KM = {
+    'car': 0.5,
+    'van': 0.75,
+    'horse': 1.25,
+}
+
+def calculate_distance(origin, destination):
+    """
+    Calculate the distance between two points on the earth's surface.
+    :param origin: tuple of latitude and longitude of the origin point
+    :param destination: tuple of latitude and longitude of the destination point
+    :return: distance in kilometers
+    """
+    # Unpack latitude and longitude from the origin and destination
+    lat1, lon1 = origin
+    lat2, lon2 = destination
+
+    radius = EARTH_RADIUS_KM
+
+    # Calculate the distance between two points on the earth
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = (math.sin(dlat / 2) * math.sin(dlat / 2) +
+        math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) *
+        math.sin(dlon / 2) * math.sin(dlon / 2))
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    distance = radius * c
+
+    # Add 10% to the distance to account for further distance due to road layout
+    distance *= ROAD_FACTOR
+
+    return distance # in km
+
+def batch_distance(origins, destinations):
+    """
+    Calculate the distances between many pairs of points on the earth's surface.
+    Vectorized version of calculate_distance.
+    :param origins: array-like of shape (n, 2) with the latitude and longitude of each origin
+    :param destinations: array-like of shape (n, 2) with the latitude and longitude of each destination
+    :return: array of n distances in kilometers
+    The arrays are broadcast, so origins of shape (n, 1, 2) and destinations of shape (1, m, 2) give an (n, m) matrix.
+    """
+    origins = np.radians(np.asarray(origins, dtype=np.float64))
+    destinations = np.radians(np.asarray(destinations, dtype=np.float64))
+    lat1, lon1 = origins[..., 0], origins[..., 1]
+    lat2, lon2 = destinations[..., 0], destinations[..., 1]
+
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return EARTH_RADIUS_KM * c * ROAD_FACTOR
+
+def batch_price(distances, vehicle_types, price_table=None):
+    """
+    Calculate the prices of many rides.
+    Vectorized version of clients.views.calculate_price.
+    :param distances: array-like of n distances in kilometers
+    :param vehicle_types: a single vehicle type, or array-like of n vehicle types
+    :param price_table: dict of price per kilometer for each vehicle type, defaults to PRICE_PER_KM
+    :return: array of n prices, NaN where the vehicle type is unknown
+    """
+    if price_table is None:
+        price_table = PRICE_PER_KM
+    distances = np.asarray(distances, dtype=np.float64)
+    if isinstance(vehicle_types, str):
+        return distances * price_table.get(vehicle_types, np.nan)
+
+    # Look up the rate once per distinct vehicle type rather than once per ride
+    types, inverse = np.unique(np.asarray(vehicle_types), return_inverse=True)
+    rates = np.array([price_table.get(str(vehicle_type), np.nan) for vehicle_type in types], dtype=np.float64)
+    return distances * rates[inverse.reshape(distances.shape)]
+
+def batch_quote(origins, destinations, vehicle_types, price_table=None):
+    """
+    Calculate the distances and prices of many rides.
+    :return: tuple of (distances, prices) arrays
+    """
+    distances = batch_distance(origins, destinations)
+    return distances, batch_price(distances, vehicle_types, price_table)
@@ -0,0 +1,221 @@
+import secrets
+import time
+
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+from database import ConnectionPool
+from lru import LRUCache
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """
+    Session whose data is kept on the server. Only its id is sent to the browser.
+    """
+    def __init__(self, initial=None, sid=None, new=False, expires=None):
+        def on_update(session):
+            session.modified = True
+            session.accessed = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.expires = expires
+        self.modified = False
+        self.accessed = False
+        # Id the session had before regenerate, deleted from the store when the session is saved
+        self.previous_sid = None
+
+    def regenerate(self):
+        """
+        Move the session to a new random id, keeping its data.
+        """
+        if not self.new and self.previous_sid is None:
+            self.previous_sid = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.new = True
+        self.modified = True
+
+    def __getitem__(self, key):
+        self.accessed = True
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self.accessed = True
+        return super().get(key, default)
+
+    def setdefault(self, key, default=None):
+        self.accessed = True
+        return super().setdefault(key, default)
+
+class MemorySessionStore(LRUCache):
+    """
+    Sessions kept in the process memory, in a bounded LRU with a time to live.
+    Fastest, but every worker process has its own sessions.
+    """
+    # The session interface compares the expiry times with the wall clock, as for the SQLite store
+    clock = staticmethod(time.time)
+
+    def __init__(self, max_size=100000, ttl=86400):
+        super().__init__(max_size, ttl)
+
+    def load(self, sid):
+        """
+        :return: tuple of (data, expiry time), or None if the session does not exist or has expired
+        """
+        entry = self.lookup(sid)
+        if entry is None:
+            return None
+        return dict(entry[0]), entry[1]
+
+    def save(self, sid, data):
+        self.store(sid, data)
+
+    def delete(self, sid):
+        self.discard(sid)
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'max_size': self.max_size}
+
+class SQLiteSessionStore(object):
+    """
+    Sessions kept in a local SQLite file, shared by all the worker processes of a host.
+    """
+    def __init__(self, path, ttl=86400):
+        self.pool = ConnectionPool(path)
+        self.ttl = ttl
+        self.ready = False
+
+    def acquire(self):
+        connection = self.pool.acquire()
+        if not self.ready:
+            connection.execute('CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data TEXT, expires REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)')
+            connection.commit()
+            self.ready = True
+        return connection
+
+    def load(self, sid):
+        """
+        :return: tuple of (data, expiry time), or None if the session does not exist or has expired
+        """
+        connection = self.acquire()
+        try:
+            row = connection.execute('SELECT data, expires FROM sessions WHERE id = ? AND expires >= ?', (sid, time.time())).fetchone()
+        finally:
+            self.pool.release(connection)
+        if row is None:
+            return None
+        return session_json_serializer.loads(row[0]), row[1]
+
+    def save(self, sid, data):
+        connection = self.acquire()
+        try:
+            connection.execute('INSERT OR REPLACE INTO sessions (id, data, expires) VALUES (?, ?, ?)', (sid, session_json_serializer.dumps(data), time.time() + self.ttl))
+            connection.commit()
+        finally:
+            self.pool.release(connection)
+
+    def delete(self, sid):
+        connection = self.acquire()
+        try:
+            connection.execute('DELETE FROM sessions WHERE id = ?', (sid,))
+            connection.commit()
+        finally:
+            self.pool.release(connection)
+
+    def expire(self):
+        connection = self.acquire()
+        try:
+            count = connection.execute('DELETE FROM sessions WHERE expires < ?', (time.time(),)).rowcount
+            connection.commit()
+        finally:
+            self.pool.release(connection)
+        return count
+
+    def stats(self):
+        connection = self.acquire()
+        try:
+            return {'size': connection.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]}
+        finally:
+            self.pool.release(connection)
+
+class ServerSideSessionInterface(SessionInterface):
+    """
+    Keeps the session data in a store and only a signed random id in the cookie.
+    The cookie is only sent when a session is created or deleted, so updating the session does not resend it.
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def signer(self, app):
+        return Signer(app.secret_key, salt='server-side-session')
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self.signer(app).unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+            if sid:
+                stored = self.store.load(sid)
+                if stored is not None:
+                    return ServerSideSession(stored[0], sid=sid, expires=stored[1])
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add('Cookie')
+        if session.previous_sid is not None:
+            self.store.delete(session.previous_sid)
+
+        if not session:
+            if session.modified and (not session.new or session.previous_sid is not None):
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        # Unchanged sessions are written again when half of their lifetime has passed, to keep active users logged in
+        if session.modified or session.expires is None or session.expires - time.time() < self.store.ttl / 2:
+            self.store.save(session.sid, dict(session))
+        if session.new or session.permanent:
+            response.set_cookie(
+                name,
+                self.signer(app).sign(session.sid).decode(),
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+def regenerate(session):
+    """
+    Give the session a new id, so that an id obtained before logging in or out cannot be used after (session fixation).
+    Called on login and logout. Flask's signed cookie sessions have no id and are left as they are.
+    """
+    if isinstance(session, ServerSideSession):
+        session.regenerate()
+
+def init_app(app):
+    """
+    Keep the sessions on the server, in the store named by SESSION_BACKEND: 'memory', 'sqlite', or 'cookie' for Flask's signed cookies.
+    """
+    backend = app.config['SESSION_BACKEND']
+    if backend == 'memory':
+        store = MemorySessionStore(max_size=app.config['SESSION_MAX_ENTRIES'], ttl=app.config['SESSION_TTL'])
+    elif backend == 'sqlite':
+        store = SQLiteSessionStore(app.config['SESSION_SQLITE_PATH'], ttl=app.config['SESSION_TTL'])
+    elif backend == 'cookie':
+        return None
+    else:
+        raise ValueError(f"Unknown session backend '{backend}'")
+    app.session_interface = ServerSideSessionInterface(store)
+    return store
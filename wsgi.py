@@ -0,0 +1,6 @@
+# Entry point for production servers, for example: gunicorn --worker-class eventlet -w 1 wsgi:app
+# Set SOCKETIO_ASYNC_MODE to match the worker class
+from app import create_app, start_services
+
+app = create_app('production')
+start_services(app)